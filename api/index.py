@@ -3,6 +3,16 @@ import os
 
 # Add the parent directory to sys.path so we can import 'backend'
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# backend modules import their siblings directly (e.g. `import llm`), as they do
+# when started with `cd backend && uvicorn main:app`
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+# Serverless instances don't share memory between invocations, so keep sessions on disk
+os.environ.setdefault("SESSION_STORE", "sqlite")
+# ...nor keep background tasks running between them, so random reports are generated per request
+os.environ.setdefault("RANDOM_REPORT_BANK_SIZE", "0")
+# The report archive defaults to /tmp/talent_reports.db, which is per instance and gone after
+# a cold start: /archive counts only cover one instance unless REPORT_ARCHIVE_DB_PATH is shared
 
 from backend.main import app
 
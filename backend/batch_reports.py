@@ -0,0 +1,172 @@
+"""
+Offline report generation for stored transcripts, e.g. after a prompt change.
+
+    python batch_reports.py transcripts.jsonl --output reports.jsonl --workers 8
+    python batch_reports.py transcripts.jsonl --output reports.jsonl   # run again to resume
+
+Each input line is a JSON object with the conversation in `full_chat_history` (as in
+report_result.json) or `history`, and optionally an `id` (default: the line number).
+Reports are built with the same prompt, model routing and parsing as /assessment/report
+and appended to --output as they finish, one JSON object per line. The output file is
+the checkpoint: ids that already have an ok line there are skipped, so an interrupted
+run picks up where it stopped. A later line for an id supersedes earlier ones.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import main
+from metrics import metrics
+from prompts import BASE_SYSTEM_PROMPT
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+ENDPOINT = "batch_report"
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def load_done(output_path):
+    """Ids with a successful report in an earlier run's output."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # A line cut short when the last run was killed
+            if record.get("ok"):
+                done.add(record["id"])
+    return done
+
+
+def read_transcripts(path):
+    """Yield (id, history, error) per line without loading the whole file.
+
+    A line that isn't a transcript comes out as ("line-N", [], error), so it gets a failed
+    record instead of stopping the run.
+    """
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                history = item.get("full_chat_history") or item.get("history") or []
+                history = [{"role": m["role"], "content": m["content"]} for m in history]
+            except (json.JSONDecodeError, AttributeError, KeyError, TypeError) as e:
+                yield f"line-{number}", [], f"unreadable transcript: {type(e).__name__}: {e}"
+                continue
+            # Stored transcripts leave out the system prompt; the report prompt expects it first
+            if history and history[0]["role"] != "system":
+                history.insert(0, {"role": "system", "content": BASE_SYSTEM_PROMPT})
+            yield str(item.get("id") or item.get("session_id") or f"line-{number}"), history, None
+
+
+async def generate(item_id, history, attempts):
+    """One report, retried on upstream errors and unusable output; returns the output record."""
+    started = time.perf_counter()
+    error = None
+    for attempt in range(1, attempts + 1):
+        try:
+            result_content = await main.cached_report_completion(ENDPOINT, main.report_context(history))
+        except Exception as e:
+            error = str(e)
+            delay = getattr(e, "retry_after", None) or min(2 ** attempt, 30)
+        else:
+            report = main.parse_report(result_content)
+            if report is not None:
+                return {"id": item_id, "ok": True, "attempts": attempt,
+                        "seconds": round(time.perf_counter() - started, 2), "report": report}
+            error = "unparseable report"
+            delay = 0
+        metrics.inc("batch_report_retries_total")
+        if attempt < attempts:
+            await asyncio.sleep(delay)
+    return {"id": item_id, "ok": False, "attempts": attempts,
+            "seconds": round(time.perf_counter() - started, 2), "error": error}
+
+
+async def run(args):
+    done = load_done(args.output)
+    queue = asyncio.Queue(maxsize=args.workers * 2)  # Bounded, so the input is read as it's consumed
+    records = []
+    skipped = 0
+
+    async def feed():
+        nonlocal skipped
+        for item_id, history, error in read_transcripts(args.input):
+            if item_id in done:
+                skipped += 1
+                continue
+            await queue.put((item_id, history, error))
+        for _ in range(args.workers):
+            await queue.put(None)
+
+    async def work(out):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            item_id, history, error = item
+            if error or not history:
+                record = {"id": item_id, "ok": False, "attempts": 0, "seconds": 0, "error": error or "empty transcript"}
+            else:
+                record = await generate(item_id, history, args.attempts)
+            records.append(record)
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            if len(records) % args.progress_every == 0:
+                print(f"{len(records)} done, {sum(not r['ok'] for r in records)} failed", flush=True)
+
+    started = time.perf_counter()
+    with open(args.output, "a", encoding="utf-8") as out:
+        await asyncio.gather(feed(), *[work(out) for _ in range(args.workers)])
+    elapsed = time.perf_counter() - started
+
+    ok = [r for r in records if r["ok"]]
+    latencies = sorted(r["seconds"] for r in ok)
+    counters = metrics.snapshot()["counters"]
+    label = f'{{endpoint="{ENDPOINT}"}}'
+    return {
+        "processed": len(records),
+        "ok": len(ok),
+        "failed": len(records) - len(ok),
+        "partial": sum(1 for r in ok if r["report"].get("partial")),
+        "skipped": skipped,
+        "retried": sum(1 for r in records if r["attempts"] > 1),
+        "wall_seconds": round(elapsed, 2),
+        "reports_per_minute": round(len(ok) / elapsed * 60, 1) if elapsed else None,
+        "p50_seconds": percentile(latencies, 0.50),
+        "p95_seconds": percentile(latencies, 0.95),
+        "prompt_tokens": int(counters.get(f"llm_prompt_tokens_total{label}", 0)),
+        "completion_tokens": int(counters.get(f"llm_completion_tokens_total{label}", 0)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="JSONL file of transcripts")
+    parser.add_argument("--output", required=True, help="JSONL file the reports are appended to")
+    parser.add_argument("--workers", type=int, default=8, help="Reports generated at once")
+    parser.add_argument("--attempts", type=int, default=3, help="Tries per transcript")
+    parser.add_argument("--progress-every", type=int, default=20)
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    print(f"{'='*20} Batch reports {'='*20}")
+    for key, value in summary.items():
+        print(f"{key:<20} {value}")
@@ -0,0 +1,364 @@
+"""
+Full-flow benchmark: start -> chat turns -> report, for many simulated users at once.
+
+    python bench.py --spawn --latency 1 --sessions 100 --concurrency 50 --output run.json
+    python bench.py --base-url http://127.0.0.1:8000 --sessions 20 --stream
+    python bench.py --compare before.json after.json
+
+With --spawn, fake_llm.py and the backend are started as subprocesses on free ports;
+otherwise the backend at --base-url is used as is. Results (throughput, p50/p95/p99
+latency and payload sizes per endpoint) are printed and optionally saved as JSON.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ANSWERS = [
+    "小时候我经常把家里的收音机拆开，再试着装回去，一弄就是一下午。",
+    "我发现别人看不懂的流程图，我扫一眼就知道卡在哪里。",
+    "整理完一个混乱的项目文档后，虽然很累，但特别兴奋。",
+    "我嫉妒过一个同事，他能轻松地在会上把复杂的事讲清楚。",
+    "最投入的时候是把一堆零散的信息拼成一张完整的图。",
+    "我觉得是过程本身，看着系统一点点跑通特别过瘾。",
+]
+
+
+def long_answer(answer, padding):
+    """Pad an answer with more detail, for the several-hundred-character answers real users give."""
+    if padding <= 0:
+        return answer
+    detail = "具体来说，" + answer * (padding // len(answer) + 1)
+    return answer + detail[:padding]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}  # endpoint -> list of dicts
+
+    def add(self, endpoint, seconds, sent, received, ok, ttfb=None):
+        self.samples.setdefault(endpoint, []).append({
+            "seconds": seconds, "sent": sent, "received": received, "ok": ok, "ttfb": ttfb,
+        })
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for endpoint, samples in self.samples.items():
+            ok = [s for s in samples if s["ok"]]
+            latencies = sorted(s["seconds"] for s in ok)
+            ttfbs = sorted(s["ttfb"] for s in ok if s["ttfb"] is not None)
+            endpoints[endpoint] = {
+                "requests": len(samples),
+                "errors": len(samples) - len(ok),
+                "p50_ms": _ms(percentile(latencies, 0.50)),
+                "p95_ms": _ms(percentile(latencies, 0.95)),
+                "p99_ms": _ms(percentile(latencies, 0.99)),
+                "max_ms": _ms(latencies[-1] if latencies else None),
+                "ttfb_p50_ms": _ms(percentile(ttfbs, 0.50)),
+                "avg_request_bytes": round(sum(s["sent"] for s in samples) / len(samples)),
+                "avg_response_bytes": round(sum(s["received"] for s in ok) / len(ok)) if ok else 0,
+                "max_request_bytes": max(s["sent"] for s in samples),
+            }
+        total = sum(len(samples) for samples in self.samples.values())
+        return {"requests": total, "throughput_rps": round(total / elapsed, 2), "endpoints": endpoints}
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def parse_sse(body):
+    """Collapse an SSE body into the payload of its final done/error event."""
+    result = None
+    for block in body.split("\n\n"):
+        event = data = None
+        for line in block.splitlines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = line[len("data: "):]
+        if event in ("done", "error") and data:
+            result = json.loads(data)
+            if event == "error":
+                raise RuntimeError(result.get("detail", "stream error"))
+    return result
+
+
+async def call(client, recorder, endpoint, payload, stream, compress=False):
+    """POST one request; the recorded sizes are bytes on the wire, after any compression."""
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    headers = {"Content-Type": "application/json", "Accept-Encoding": "gzip" if compress else "identity"}
+    if compress:
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+    started = time.perf_counter()
+    ttfb = None
+    received = b""
+    wire_bytes = 0
+    try:
+        async with client.stream("POST", endpoint, content=body, headers=headers) as response:
+            async for chunk in response.aiter_bytes():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+                received += chunk
+            wire_bytes = response.num_bytes_downloaded
+            response.raise_for_status()
+        text = received.decode("utf-8")
+        data = parse_sse(text) if stream else json.loads(text)
+    except Exception:
+        recorder.add(endpoint, time.perf_counter() - started, len(body), wire_bytes, False, ttfb)
+        raise
+    recorder.add(endpoint, time.perf_counter() - started, len(body), wire_bytes, True, ttfb)
+    return data
+
+
+async def run_session(client, recorder, args, index):
+    """One simulated user. Returns (turns taken, session id)."""
+    start = await call(client, recorder, "/assessment/start", {
+        "mode": args.mode, "include_history": args.legacy, "stream": args.stream,
+    }, args.stream, args.compress)
+    session_id = start["session_id"]
+    history = start.get("history")
+    version = start.get("history_version")
+    turns = 0
+    finished = False
+    while turns < args.turns and not finished:
+        answer = long_answer(ANSWERS[(index + turns) % len(ANSWERS)], args.answer_padding)
+        if args.legacy and args.delta:
+            payload = {"session_id": session_id, "history_version": version, "user_message": answer}
+        elif args.legacy:
+            payload = {"history": history, "mode": args.mode, "user_message": answer}
+        else:
+            payload = {"session_id": session_id, "user_message": answer, "stream": args.stream}
+        reply = await delta_call(client, recorder, args, "/assessment/chat", payload, history)
+        turns += 1
+        finished = reply.get("is_finished", False)
+        if args.think_time and not finished:
+            await asyncio.sleep(args.think_time)
+        # A resync adopts the history into a new session when the server had lost it
+        session_id = reply.get("session_id", session_id)
+        if args.legacy and args.delta:
+            history = history + reply["history_delta"]
+            version = reply["history_version"]
+        elif args.legacy:
+            history = reply["history"]
+    if args.legacy and args.delta:
+        payload = {"session_id": session_id, "history_version": version}
+    elif args.legacy:
+        payload = {"history": history, "mode": args.mode}
+    else:
+        payload = {"session_id": session_id, "stream": args.stream}
+    await delta_call(client, recorder, args, "/assessment/report", payload, history)
+    return turns, session_id
+
+
+async def delta_call(client, recorder, args, endpoint, payload, history):
+    """call(), repeating the request with the full history when the server asks for a resync."""
+    stream = args.stream and not args.legacy
+    try:
+        return await call(client, recorder, endpoint, payload, stream, args.compress)
+    except httpx.HTTPStatusError as e:
+        if not (args.delta and e.response.status_code == 409):
+            raise
+    return await call(client, recorder, endpoint, {**payload, "history": history, "mode": args.mode}, stream, args.compress)
+
+
+async def run(args, base_url):
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    outcomes = []
+    errors = []
+
+    async def one(index):
+        async with semaphore:
+            try:
+                outcomes.append(await run_session(client, recorder, args, index))
+            except Exception as e:
+                errors.append(repr(e))
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(args.sessions)])
+        elapsed = time.perf_counter() - started
+        usage = await collect_usage(client, [sid for _, sid in outcomes[:50]])
+
+    results = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("compare", "output")},
+        "wall_seconds": round(elapsed, 2),
+        "sessions_completed": len(outcomes),
+        "session_errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "sessions_per_second": round(len(outcomes) / elapsed, 2),
+        "avg_turns": round(sum(t for t, _ in outcomes) / len(outcomes), 2) if outcomes else None,
+        **recorder.summary(elapsed),
+        "usage": usage,
+    }
+    return results
+
+
+async def collect_usage(client, session_ids):
+    """Average prompt/cached tokens per session, from the backend's own usage ledger."""
+    totals = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+    counted = 0
+    for session_id in session_ids:
+        try:
+            response = await client.get(f"/usage/{session_id}")
+            response.raise_for_status()
+        except httpx.HTTPError:
+            continue
+        data = response.json()
+        counted += 1
+        for key in totals:
+            totals[key] += data.get(key, 0)
+    if not counted:
+        return None
+    return {f"avg_{key}_per_session": round(value / counted) for key, value in totals.items()}
+
+
+def wait_until_up(url, attempts=100):
+    for _ in range(attempts):
+        try:
+            httpx.get(url, timeout=0.5)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def spawn(args):
+    fake_port, backend_port = free_port(), free_port()
+    fake_cmd = [
+        sys.executable, "fake_llm.py", "--port", str(fake_port),
+        "--latency", str(args.latency), "--latency-dist", args.latency_dist,
+        "--token-rate", str(args.token_rate), "--prefill-rate", str(args.prefill_rate), "--failure-rate", str(args.failure_rate),
+        "--failure-kinds", args.failure_kinds, "--reply-padding", str(args.reply_padding), "--seed", str(args.seed),
+    ]
+    if args.no_prefix_cache:
+        fake_cmd.append("--no-prefix-cache")
+    env = {
+        **os.environ,
+        "ALIYUN_API_BASE": f"http://127.0.0.1:{fake_port}/v1",
+        "ALIYUN_API_KEY": "fake",
+        # Every simulated user comes from 127.0.0.1, so per-IP limits would only measure themselves
+        "RATE_LIMIT": os.environ.get("RATE_LIMIT", "0"),
+    }
+    processes = [subprocess.Popen(fake_cmd, cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)]
+    wait_until_up(f"http://127.0.0.1:{fake_port}/docs")
+    processes.append(subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(backend_port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    ))
+    wait_until_up(f"http://127.0.0.1:{backend_port}/health")
+    return f"http://127.0.0.1:{backend_port}", processes
+
+
+def print_results(results):
+    print(f"{'='*20} Benchmark {'='*20}")
+    print(f"Sessions: {results['sessions_completed']} ok, {results['session_errors']} failed "
+          f"in {results['wall_seconds']}s ({results['sessions_per_second']} sessions/s, "
+          f"{results['throughput_rps']} req/s)")
+    print(f"Turns per completed assessment: {results['avg_turns']}")
+    if results["first_error"]:
+        print(f"First error: {results['first_error']}")
+    for endpoint, stats in results["endpoints"].items():
+        print(f"{endpoint:<22} n={stats['requests']:<5} err={stats['errors']:<3} "
+              f"p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms "
+              f"req={stats['avg_request_bytes']}B resp={stats['avg_response_bytes']}B")
+    if results["usage"]:
+        print(f"Usage per session: {results['usage']}")
+
+
+def compare(before_path, after_path):
+    with open(before_path, encoding="utf-8") as f:
+        before = json.load(f)
+    with open(after_path, encoding="utf-8") as f:
+        after = json.load(f)
+    print(f"{'':<22} {'before':>10} {'after':>10} {'change':>8}")
+    rows = [("sessions/s", before["sessions_per_second"], after["sessions_per_second"]),
+            ("turns/assessment", before.get("avg_turns"), after.get("avg_turns"))]
+    for endpoint, stats in after["endpoints"].items():
+        old = before["endpoints"].get(endpoint)
+        if not old:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms", "avg_request_bytes", "avg_response_bytes"):
+            rows.append((f"{endpoint.rsplit('/', 1)[-1]} {key}", old[key], stats[key]))
+    for key in ("avg_prompt_tokens_per_session", "avg_cached_tokens_per_session"):
+        if before.get("usage") and after.get("usage"):
+            rows.append((key.replace("avg_", "").replace("_per_session", "/session"),
+                         before["usage"][key], after["usage"][key]))
+    for label, old, new in rows:
+        change = f"{(new - old) / old * 100:+.0f}%" if old and new is not None else "-"
+        print(f"{label:<22} {old!s:>10} {new!s:>10} {change:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--spawn", action="store_true", help="Start fake_llm.py and the backend on free ports")
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=10, help="Max chat turns per session")
+    parser.add_argument("--mode", default="normal", choices=["normal", "quick"])
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--legacy", action="store_true", help="Resend full history instead of session_id")
+    parser.add_argument("--delta", action="store_true", help="With --legacy, send only the history version and receive deltas")
+    parser.add_argument("--compress", action="store_true", help="gzip request bodies and accept gzip responses")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--answer-padding", type=int, default=0, help="Extra characters per user answer")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Seconds a user takes before each answer")
+    # Only used with --spawn, passed through to fake_llm.py
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--latency-dist", default="fixed")
+    parser.add_argument("--token-rate", type=float, default=0.0)
+    parser.add_argument("--prefill-rate", type=float, default=0.0)
+    parser.add_argument("--no-prefix-cache", action="store_true")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-kinds", default="500")
+    parser.add_argument("--reply-padding", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Diff two saved runs")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    processes = []
+    base_url = args.base_url
+    if args.spawn:
+        base_url, processes = spawn(args)
+    try:
+        results = asyncio.run(run(args, base_url))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+    print_results(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
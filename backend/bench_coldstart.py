@@ -0,0 +1,132 @@
+"""
+Cold-start benchmark for the serverless entry point.
+
+Measures (1) `python -X importtime` for `import main` and (2) time-to-first-response:
+a fresh interpreter imports the app and serves one /assessment/start against a local
+fake_llm.py, the way a Vercel cold start would.
+
+    python bench_coldstart.py --runs 5 --output coldstart.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FIRST_RESPONSE_SNIPPET = """
+import json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+client = TestClient(main.app)  # No lifespan: serverless runtimes may not run it
+response = client.post("/assessment/start", json={"mode": "normal", "include_history": False})
+done = time.perf_counter()
+print(json.dumps({
+    "status": response.status_code,
+    "import_ms": (imported - started) * 1000,
+    "first_request_ms": (done - imported) * 1000,
+}))
+"""
+
+
+def parse_importtime(stderr):
+    """Return {module: cumulative_us} from -X importtime output."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        try:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            modules[name.strip()] = int(cumulative)
+        except ValueError:
+            continue  # Header line
+    return modules
+
+
+def measure_import(runs):
+    totals = []
+    modules = {}
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import main"],
+            cwd=BACKEND_DIR, capture_output=True, text=True,
+        )
+        modules = parse_importtime(result.stderr)
+        totals.append(modules.get("main", 0) / 1000)
+    top_level = {name: us for name, us in modules.items() if "." not in name and name != "main"}
+    heaviest = sorted(top_level.items(), key=lambda item: item[1], reverse=True)[:10]
+    return {
+        "import_main_ms_median": round(statistics.median(totals), 1),
+        "import_main_ms_runs": [round(t, 1) for t in totals],
+        "heaviest_top_level_modules_ms": {name: round(us / 1000, 1) for name, us in heaviest},
+        "openai_imported": "openai" in modules,
+        "uvicorn_imported": "uvicorn" in modules,
+    }
+
+
+def measure_first_response(runs, fake_port):
+    fake = subprocess.Popen(
+        [sys.executable, "fake_llm.py", "--port", str(fake_port), "--latency", "0"],
+        cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(50):
+            try:
+                httpx.get(f"http://127.0.0.1:{fake_port}/docs", timeout=0.5)
+                break
+            except httpx.HTTPError:
+                time.sleep(0.1)
+        env = {
+            **os.environ,
+            "ALIYUN_API_BASE": f"http://127.0.0.1:{fake_port}/v1",
+            "ALIYUN_API_KEY": "fake",
+        }
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            result = subprocess.run(
+                [sys.executable, "-c", FIRST_RESPONSE_SNIPPET],
+                cwd=BACKEND_DIR, env=env, capture_output=True, text=True,
+            )
+            wall_ms = (time.perf_counter() - started) * 1000
+            child = json.loads(result.stdout.strip().splitlines()[-1])
+            child["wall_ms"] = wall_ms
+            samples.append(child)
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    def median(key):
+        return round(statistics.median(s[key] for s in samples), 1)
+
+    return {
+        "statuses": [s["status"] for s in samples],
+        "process_to_first_response_ms_median": median("wall_ms"),
+        "import_ms_median": median("import_ms"),
+        "first_request_ms_median": median("first_request_ms"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--fake-port", type=int, default=9100)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {
+        "python": sys.version.split()[0],
+        "importtime": measure_import(args.runs),
+        "first_response": measure_first_response(args.runs, args.fake_port),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
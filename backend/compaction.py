@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+
+from metrics import metrics
+from prompts import summary_block, with_tail
+
+logger = logging.getLogger(__name__)
+
+HISTORY_COMPACTION = os.getenv("HISTORY_COMPACTION", "1") == "1"
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", "2"))  # Question/answer pairs kept verbatim
+HISTORY_FOLD_BATCH = int(os.getenv("HISTORY_FOLD_BATCH", "2"))  # Pairs folded per summary update
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+HISTORY_MAX_SESSIONS = 10000
+
+# System prompt and opening user turn; the summary is attached to the latter
+HEAD = 2
+
+
+def estimate_tokens(text):
+    """Rough count: one token per CJK character, four characters per token otherwise."""
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def messages_tokens(messages):
+    return sum(estimate_tokens(m["content"]) + 4 for m in messages)
+
+
+class HistoryCompactor:
+    """Keeps long conversations inside a prompt token budget.
+
+    Older turns are folded into a rolling summary (organised by the four assessment
+    dimensions) by a background call after a turn completes. A request over budget is
+    then sent as system prompt + opening turn with the summary + the turns the summary
+    doesn't cover yet, verbatim. The stored history itself is never changed.
+
+    The summary lives in session["meta"]["summary"] as {"text", "covered"}, where
+    `covered` is the number of history messages it replaces. It only moves forward in
+    batches of `fold_batch` turns, and only when a new turn starts (`apply`), so the
+    compacted prefix stays stable (and cacheable by the provider) for several requests
+    in a row, and the report is built on the same prefix as the last turn.
+    """
+
+    def __init__(self, summarize, keep_turns=HISTORY_KEEP_TURNS, fold_batch=HISTORY_FOLD_BATCH,
+                 budget=HISTORY_TOKEN_BUDGET, enabled=HISTORY_COMPACTION):
+        self.summarize = summarize  # async (previous summary text, messages, session_id) -> text
+        self.keep_turns = keep_turns
+        self.fold_batch = fold_batch
+        self.budget = budget
+        self.enabled = enabled
+        self._tasks = {}  # session id -> running fold
+        self._results = OrderedDict()  # session id -> latest summary, for stores that hand out copies
+        self._folds = 0
+        self._compacted = 0
+        self._tokens_saved = 0
+
+    def compact(self, history, session=None):
+        """Messages to send for `history`: verbatim when within budget, else summary + recent turns."""
+        summary = (session or {}).get("meta", {}).get("summary")
+        if not self.enabled or summary is None or len(history) < summary["covered"]:
+            return history
+        full_tokens = messages_tokens(history)
+        if full_tokens <= self.budget:
+            return history
+        messages = self._with_summary(history, summary)
+        saved = full_tokens - messages_tokens(messages)
+        self._compacted += 1
+        self._tokens_saved += saved
+        metrics.inc("history_compactions_total")
+        metrics.inc("history_tokens_saved_total", saved)
+        return messages
+
+    def _with_summary(self, history, summary):
+        opening = history[1]
+        return [
+            history[0],
+            {"role": opening["role"], "content": with_tail(opening["content"], summary_block(summary["text"]))},
+            *history[summary["covered"]:],
+        ]
+
+    def apply(self, session):
+        """Move a summary finished in the background into the session, at the start of a turn."""
+        local = self._results.get(session["id"])
+        stored = session.get("meta", {}).get("summary")
+        if local and (stored is None or local["covered"] > stored["covered"]):
+            session.setdefault("meta", {})["summary"] = local
+
+    def settle(self, session_id):
+        """Stop folding once the conversation is over; the report keeps the last turn's summary."""
+        task = self._tasks.pop(session_id, None)
+        if task is not None:
+            task.cancel()
+        self._results.pop(session_id, None)
+
+    def schedule(self, session):
+        """Fold older turns into the summary in the background once enough have piled up."""
+        if not self.enabled or session["id"] in self._tasks:
+            return
+        history = list(session["history"])
+        if len(history) <= HEAD or history[1]["role"] != "user":
+            return
+        summary = session.get("meta", {}).get("summary")
+        covered = summary["covered"] if summary else HEAD
+        # Keep the last keep_turns pairs; the boundary must land on an assistant turn
+        boundary = len(history) - 2 * self.keep_turns
+        boundary -= (boundary - HEAD) % 2
+        if boundary - covered < 2 * self.fold_batch:
+            return
+        # Short conversations never need a summary; start folding when half the budget is used
+        if messages_tokens(history) <= self.budget // 2:
+            return
+        task = asyncio.get_running_loop().create_task(
+            self._fold(session["id"], summary, history[covered:boundary], boundary)
+        )
+        self._tasks[session["id"]] = task
+        task.add_done_callback(lambda t: self._forget(session["id"], t))
+
+    def _forget(self, session_id, task):
+        # A fold settled (cancelled) for a newer one must not remove the newer one's entry
+        if self._tasks.get(session_id) is task:
+            del self._tasks[session_id]
+
+    async def _fold(self, session_id, summary, turns, boundary):
+        try:
+            text = await self.summarize(summary["text"] if summary else None, turns, session_id)
+        except Exception as e:
+            metrics.inc("history_summary_errors_total")
+            logger.warning(f"History summary failed for session {session_id}: {e}")
+            return
+        if not text or not text.strip():
+            return
+        self._folds += 1
+        metrics.inc("history_summaries_total")
+        self._results[session_id] = {"text": text.strip(), "covered": boundary}
+        self._results.move_to_end(session_id)
+        while len(self._results) > HISTORY_MAX_SESSIONS:
+            self._results.popitem(last=False)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "budget": self.budget,
+            "keep_turns": self.keep_turns,
+            "running": len(self._tasks),
+            "summaries": self._folds,
+            "compacted_requests": self._compacted,
+            "estimated_tokens_saved": self._tokens_saved,
+        }
@@ -0,0 +1,149 @@
+import json
+import os
+import re
+
+from metrics import metrics
+from prompts import coverage_instruction
+
+COVERAGE_TRACKING = os.getenv("COVERAGE_TRACKING", "1") == "1"
+# Shorter answers (or short evasions like "不知道") don't count as covering a dimension
+COVERAGE_MIN_ANSWER_CHARS = int(os.getenv("COVERAGE_MIN_ANSWER_CHARS", "8"))
+# Mode -> (answers before the session may end once covered, answers after which it always ends)
+DEFAULT_TURN_BUDGETS = {"normal": (4, 10), "quick": (3, 3)}
+# e.g. COVERAGE_TURN_BUDGETS='{"normal": [5, 8]}'
+TURN_BUDGETS = {**DEFAULT_TURN_BUDGETS,
+                **{k: tuple(v) for k, v in json.loads(os.getenv("COVERAGE_TURN_BUDGETS", "{}")).items()}}
+# Without tracking: the old cap on stored messages
+LEGACY_MAX_MESSAGES = 20
+
+TURN_BUCKETS = (1, 2, 3, 4, 5, 6, 7, 8, 10, 12, 15)
+
+# Dimension -> (cues in the counsellor's question that it asks about this dimension,
+#               cues in an answer that volunteer it unasked)
+DIMENSIONS = {
+    "童年冲动": (("16岁", "童年", "小时候", "儿时", "小学", "废寝忘食", "缺点", "被批评"),
+                ("小时候", "童年", "儿时", "上小学")),
+    "无意识胜任": (("常识", "理所当然", "轻而易举", "不费力", "别人却觉得", "别人觉得很难", "天生就会"),
+                  ("常识", "理所当然", "轻而易举", "不费力")),
+    "能量审计": (("回血", "亢奋", "累", "精力", "能量", "充电"),
+                ("回血", "亢奋", "充电")),
+    "嫉妒镜像": (("嫉妒", "羡慕", "眼红", "不服气"),
+                ("嫉妒", "羡慕", "眼红")),
+}
+# Groups of dimensions a mode must cover, one dimension per group. Quick mode's second
+# question asks about unconscious competence or energy, not both.
+REQUIRED = {
+    "normal": [("童年冲动",), ("无意识胜任",), ("能量审计",), ("嫉妒镜像",)],
+    "quick": [("童年冲动",), ("无意识胜任", "能量审计"), ("嫉妒镜像",)],
+}
+EVASIONS = ("不知道", "不清楚", "想不起", "说不上来", "没有", "跳过", "没想过")
+
+SENTENCE_END_RE = re.compile(r"(?<=[。！!？?\n])")
+
+
+def _question(text):
+    """The part of an assistant turn that asks the next question: its last sentence with a question mark."""
+    questions = [s for s in SENTENCE_END_RE.split(text) if "？" in s or "?" in s]
+    return questions[-1] if questions else text[-80:]
+
+
+def _substantive(answer):
+    answer = answer.strip()
+    if len(answer) < COVERAGE_MIN_ANSWER_CHARS:
+        return False
+    return not (len(answer) < 2 * COVERAGE_MIN_ANSWER_CHARS and any(e in answer for e in EVASIONS))
+
+
+def _asks_question(reply):
+    return any(mark in reply.strip()[-40:] for mark in ("？", "?"))
+
+
+class CoverageTracker:
+    """Decides from the conversation itself which assessment dimensions are covered.
+
+    Keyword heuristics, no model call: an assistant turn whose question carries a
+    dimension's cue words asks about that dimension, and a substantive user answer to
+    it covers it; an answer can also volunteer a dimension (e.g. mentions 嫉妒 unasked).
+    The result steers the next request through the session tail (which dimension to ask
+    next, or to wrap up) and ends the session as soon as every required dimension is
+    covered and the mode's minimum number of answers is reached, instead of waiting for
+    the model's 【DONE】 alone. Coverage is recomputed from the history on every turn,
+    so it works the same for session, legacy and delta clients.
+    """
+
+    def __init__(self, budgets=TURN_BUDGETS, enabled=COVERAGE_TRACKING):
+        self.budgets = budgets
+        self.enabled = enabled
+        self._finished = {}  # reason -> sessions
+        self._turns = 0
+
+    def assess(self, history, mode):
+        """Coverage of `history`, which ends with the user's latest answer; None when disabled."""
+        if not self.enabled:
+            return None
+        mode = mode if mode in REQUIRED else "normal"
+        covered = []
+        answers = 0
+        asked = ()
+        opening_seen = False
+        for message in history:
+            if message["role"] == "assistant":
+                question = _question(message["content"])
+                asked = tuple(name for name, (cues, _) in DIMENSIONS.items() if any(c in question for c in cues))
+            elif message["role"] == "user":
+                if not opening_seen:
+                    opening_seen = True  # The canned opening turn, not an answer
+                    continue
+                answers += 1
+                content = message["content"]
+                found = [name for name, (_, cues) in DIMENSIONS.items() if any(c in content for c in cues)]
+                if _substantive(content):
+                    found += asked
+                covered += [name for name in found if name not in covered]
+                asked = ()
+        missing = [group for group in REQUIRED[mode] if not any(name in covered for name in group)]
+        minimum, maximum = self.budgets.get(mode, self.budgets["normal"])
+        complete = not missing
+        return {
+            "mode": mode,
+            "covered": [name for name in DIMENSIONS if name in covered],
+            "missing": [group[0] for group in missing],
+            "answers": answers,
+            "complete": complete,
+            "wrap_up": (complete and answers >= minimum) or answers >= maximum,
+            "cap": answers >= maximum,
+        }
+
+    def tail(self, coverage):
+        """Instruction for the next request, appended to the session tail."""
+        if coverage is None:
+            return None
+        return coverage_instruction(coverage["covered"], coverage["missing"], coverage["wrap_up"])
+
+    def finished(self, coverage, reply, messages):
+        """Whether the turn that produced `reply` ends the session."""
+        if coverage is None:
+            return "【DONE】" in reply or len(messages) > LEGACY_MAX_MESSAGES
+        if "【DONE】" in reply:
+            reason = "done_marker"
+        elif coverage["wrap_up"] and coverage["complete"] and not _asks_question(reply):
+            reason = "coverage"  # Told to wrap up and did, but left out the marker
+        elif coverage["cap"]:
+            reason = "turn_cap"
+        else:
+            return False
+        self._finished[reason] = self._finished.get(reason, 0) + 1
+        self._turns += coverage["answers"]
+        metrics.inc("assessment_finished_total", mode=coverage["mode"], reason=reason,
+                    complete=str(coverage["complete"]).lower())
+        metrics.observe("assessment_turns", coverage["answers"], buckets=TURN_BUCKETS, mode=coverage["mode"])
+        return True
+
+    def stats(self):
+        finished = sum(self._finished.values())
+        return {
+            "enabled": self.enabled,
+            "turn_budgets": {mode: {"min": lo, "max": hi} for mode, (lo, hi) in self.budgets.items()},
+            "finished": dict(self._finished),
+            "avg_turns": round(self._turns / finished, 2) if finished else None,
+        }
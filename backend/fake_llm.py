@@ -0,0 +1,283 @@
+"""
+Local OpenAI-compatible stand-in for DeepSeek, used for load testing and benchmarks.
+
+    python fake_llm.py --port 9000 --latency 2.0
+    python fake_llm.py --latency 1.5 --latency-dist lognormal --token-rate 40 \
+        --failure-rate 0.05 --failure-kinds 500,429,hang --seed 7
+
+Then start the backend with ALIYUN_API_BASE=http://127.0.0.1:9000/v1 ALIYUN_API_KEY=fake.
+
+Replies are deterministic: the text only depends on the request. Latency and injected
+failures come from a seeded RNG, so two runs with the same --seed see the same sequence.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+app = FastAPI()
+
+CONFIG = {
+    "latency": 2.0,  # Seconds to first token (or per completion when token_rate is 0)
+    "latency_dist": "fixed",  # fixed | uniform | exponential | lognormal
+    "latency_spread": 0.5,  # Relative spread for uniform/lognormal
+    "token_rate": 0.0,  # Tokens per second after the first token; 0 = fold into latency
+    "prefill_rate": 0.0,  # Uncached prompt tokens per second added to TTFT; 0 = free
+    "prefix_cache": True,  # Off mimics gateways that don't cache prompt prefixes
+    "failure_rate": 0.0,
+    "failure_kinds": ["500"],  # 500 | 429 | hang | truncate | malformed
+    "hang_seconds": 120.0,
+    "done_after": 8,  # User turns before a normal-mode session ends with 【DONE】
+    "quick_done_after": 4,
+    "reply_padding": 0,  # Characters of analysis put before each question, like the real verbose replies
+}
+rng = random.Random(0)
+
+# Hashes of every message prefix seen so far, to mimic the provider's prefix cache
+_seen_prefixes = set()
+
+FAKE_REPORT = {
+    "core_traits": ["系统直觉", "机械共情力", "视觉思维"],
+    "deep_analysis": "这是一段用于压测的深度解析。\n" * 20,
+    "action_guide": "每周进行一次思维拆解练习。",
+    "careers": [{"title": f"测试职业{i}", "reason": "压测占位"} for i in range(1, 6)],
+    "not_suitable": "重复性高、缺少系统思考空间的工作。",
+}
+
+ANALYSIS = "从你的描述里能看到一种反复出现的模式：你在意的不是结果本身，而是把混乱理顺的那个过程。"
+
+# History summaries (the backend's compaction) say how many answers they fold in, so the
+# script still knows which turn it is on when older turns are no longer sent verbatim
+SECTION_RE = re.compile(r'中的一个部分.*?【JSON 结构模板】\s*\{"(\w+)"', re.S)
+FOLDED_RE = re.compile(r"已整理 (\d+) 轮回答")
+FOCUS_RE = re.compile(r"优先探索“(.+?)”")
+
+QUESTIONS = [
+    "欢迎来到天赋探索。请告诉我：16岁前你最愿意废寝忘食去做的一件事是什么？",
+    "谢谢你的分享。成年后，有哪些事你觉得“这不就是常识吗”，别人却觉得很难？",
+    "很有意思。哪些事做完后虽然累，但精神极度亢奋，有一种回血感？",
+    "我注意到一个细节。坦诚地说，你曾对谁产生过强烈的嫉妒？",
+    "这个回答很真实。能再具体讲讲那次经历里最让你投入的瞬间吗？",
+    "我们再往深处走一步：当时让你停不下来的，究竟是结果还是过程本身？",
+]
+FOCUS_QUESTIONS = {"童年冲动": 0, "无意识胜任": 1, "能量审计": 2, "嫉妒镜像": 3}
+
+
+def sample_latency():
+    base = CONFIG["latency"]
+    spread = CONFIG["latency_spread"]
+    dist = CONFIG["latency_dist"]
+    if dist == "uniform":
+        return max(0.0, rng.uniform(base * (1 - spread), base * (1 + spread)))
+    if dist == "exponential":
+        return rng.expovariate(1 / base) if base > 0 else 0.0
+    if dist == "lognormal":
+        # Median = base; spread is sigma of the underlying normal
+        return base * math.exp(rng.gauss(0, spread)) if base > 0 else 0.0
+    return base
+
+
+def _folded(text):
+    match = FOLDED_RE.search(text)
+    return int(match.group(1)) if match else 0
+
+
+def _summary_for(messages):
+    request = messages[-1].get("content", "")
+    folded = _folded(request) + request.count("用户：")
+    return (
+        "【童年冲动】喜欢拆装收音机，能长时间专注于弄懂东西如何运转。\n"
+        "【无意识胜任】一眼看出流程卡点，自己觉得是常识。\n"
+        "【能量审计】整理混乱信息后疲惫但兴奋。\n"
+        "【嫉妒镜像】嫉妒同事能把复杂的事讲清楚。\n"
+        f"【其他线索】已整理 {folded} 轮回答。"
+    )
+
+
+def _malformed(content):
+    """A report with the defects real models produce: a fence, raw newlines, a trailing comma, a lost section."""
+    report = json.loads(content)
+    if len(report) > 1:
+        report.pop("action_guide", None)
+    text = json.dumps(report, ensure_ascii=False, indent=2).replace("\\n", "\n")
+    return "```json\n" + text[:-1].rstrip() + ",\n}\n```"
+
+
+def _reply_for(body):
+    messages = body.get("messages", [])
+    if body.get("response_format", {}).get("type") == "json_object":
+        section = SECTION_RE.search(messages[-1].get("content", "")) if messages else None
+        if section and section.group(1) in FAKE_REPORT:
+            # Sectioned report mode asks for one key at a time
+            return json.dumps({section.group(1): FAKE_REPORT[section.group(1)]}, ensure_ascii=False)
+        return json.dumps(FAKE_REPORT, ensure_ascii=False)
+    if messages and "咨询记录员" in messages[0].get("content", ""):
+        return _summary_for(messages)
+    user_turns = sum(1 for m in messages if m.get("role") == "user")
+    user_turns += max((_folded(m.get("content", "")) for m in messages if m.get("role") == "user"), default=0)
+    last = messages[-1].get("content", "") if messages else ""
+    done_after = CONFIG["quick_done_after"] if "极速体验模式" in last else CONFIG["done_after"]
+    if user_turns >= done_after or "请不要再提问" in last:
+        return "感谢你坦诚的分享，信息已经足够，我们开始生成你的《天赋说明书》。【DONE】"
+    focus = FOCUS_RE.search(last)
+    if focus and focus.group(1) in FOCUS_QUESTIONS:
+        # Follows the server's coverage hint, like a model reading the tail would
+        question = QUESTIONS[FOCUS_QUESTIONS[focus.group(1)]]
+    else:
+        question = QUESTIONS[(user_turns - 1) % len(QUESTIONS)]
+    if user_turns > 1 and CONFIG["reply_padding"]:
+        padding = ANALYSIS * (CONFIG["reply_padding"] // len(ANALYSIS) + 1)
+        question = padding[:CONFIG["reply_padding"]] + question
+    return question
+
+
+def _usage(body, content):
+    # One "token" per character is close enough for Chinese text
+    messages = body.get("messages", [])
+    cached_tokens = running = 0
+    key = ""
+    for m in messages:
+        key = str(hash((key, m.get("role"), m.get("content", ""))))
+        running += len(m.get("content", ""))
+        if CONFIG["prefix_cache"] and key in _seen_prefixes:
+            cached_tokens = running
+        _seen_prefixes.add(key)
+    prompt_tokens = running
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(content),
+        "total_tokens": prompt_tokens + len(content),
+        "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        "prompt_cache_hit_tokens": cached_tokens,
+        "prompt_cache_miss_tokens": prompt_tokens - cached_tokens,
+    }
+
+
+def _timings(content, usage):
+    """(seconds to first token, seconds for the rest of the completion)."""
+    latency = sample_latency()
+    prefill = usage["prompt_cache_miss_tokens"] / CONFIG["prefill_rate"] if CONFIG["prefill_rate"] > 0 else 0.0
+    if CONFIG["token_rate"] > 0:
+        return latency + prefill, len(content) / CONFIG["token_rate"]
+    return latency * 0.1 + prefill, latency * 0.9
+
+
+def _pick_failure():
+    if CONFIG["failure_rate"] > 0 and rng.random() < CONFIG["failure_rate"]:
+        return rng.choice(CONFIG["failure_kinds"])
+    return None
+
+
+def _chunk(completion_id, model, delta, finish_reason=None, usage=None):
+    choices = [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    return "data: " + json.dumps({
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": choices,
+        "usage": usage,
+    }, ensure_ascii=False) + "\n\n"
+
+
+async def _stream(body, content, usage, ttft, generation, truncate=False, chunk_chars=4):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    model = body.get("model", "fake")
+    pieces = [content[i:i + chunk_chars] for i in range(0, len(content), chunk_chars)]
+    if truncate:
+        pieces = pieces[:len(pieces) // 2]
+    await asyncio.sleep(ttft)
+    yield _chunk(completion_id, model, {"role": "assistant", "content": ""})
+    for piece in pieces:
+        await asyncio.sleep(generation / max(len(pieces), 1))
+        yield _chunk(completion_id, model, {"content": piece})
+    if truncate:
+        return  # Connection drops mid-stream
+    yield _chunk(completion_id, model, {}, finish_reason="stop")
+    if body.get("stream_options", {}).get("include_usage"):
+        yield _chunk(completion_id, model, None, usage=usage)
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    content = _reply_for(body)
+    usage = _usage(body, content)
+    ttft, generation = _timings(content, usage)
+    failure = _pick_failure()
+    if failure == "malformed" and body.get("response_format", {}).get("type") == "json_object":
+        content = _malformed(content)
+        usage = _usage(body, content)
+
+    if failure == "500":
+        await asyncio.sleep(ttft)
+        return JSONResponse({"error": {"message": "Injected failure", "type": "server_error"}}, status_code=500)
+    if failure == "429":
+        return JSONResponse({"error": {"message": "Injected rate limit", "type": "rate_limit"}},
+                            status_code=429, headers={"Retry-After": "1"})
+    if failure == "hang":
+        await asyncio.sleep(CONFIG["hang_seconds"])
+
+    if body.get("stream"):
+        return StreamingResponse(
+            _stream(body, content, usage, ttft, generation, truncate=failure == "truncate"),
+            media_type="text/event-stream",
+        )
+    await asyncio.sleep(ttft + generation)
+    if failure == "truncate":
+        content = content[:len(content) // 2]
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "length" if failure == "truncate" else "stop",
+        }],
+        "usage": usage,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=2.0,
+                        help="Seconds to first token (whole completion when --token-rate is 0)")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "exponential", "lognormal"], default="fixed")
+    parser.add_argument("--latency-spread", type=float, default=0.5)
+    parser.add_argument("--token-rate", type=float, default=0.0, help="Tokens per second after the first token")
+    parser.add_argument("--prefill-rate", type=float, default=0.0, help="Uncached prompt tokens per second")
+    parser.add_argument("--no-prefix-cache", action="store_true", help="Never report cached prompt tokens")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-kinds", default="500", help="Comma-separated: 500,429,hang,truncate,malformed")
+    parser.add_argument("--hang-seconds", type=float, default=120.0)
+    parser.add_argument("--done-after", type=int, default=8, help="User turns before a normal session ends")
+    parser.add_argument("--reply-padding", type=int, default=0, help="Characters of analysis added to each reply")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    CONFIG.update(
+        latency=args.latency,
+        latency_dist=args.latency_dist,
+        latency_spread=args.latency_spread,
+        token_rate=args.token_rate,
+        prefill_rate=args.prefill_rate,
+        prefix_cache=not args.no_prefix_cache,
+        failure_rate=args.failure_rate,
+        failure_kinds=args.failure_kinds.split(","),
+        hang_seconds=args.hang_seconds,
+        done_after=args.done_after,
+        reply_padding=args.reply_padding,
+    )
+    rng.seed(args.seed)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,379 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+
+from metrics import metrics
+from request_context import DeadlineExceeded, current_request
+from routing import ModelRouter
+from tracing import record
+from transport import Transport, build_http_client
+from usage import usage_ledger
+
+logger = logging.getLogger(__name__)
+
+# Max upstream calls one process keeps in flight; extra callers wait in the gate queue
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "256"))
+# Callers allowed to wait, and for how long, before they are turned away with 503
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "512"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "15"))
+
+# Lower runs first. Turns of assessments in progress and their reports outrank new
+# starts; background work and debug endpoints go last.
+ENDPOINT_PRIORITIES = {
+    "chat": 0,
+    "report": 0,
+    "report_prefetch": 1,
+    "start": 1,
+    "compact": 2,
+    "random_report": 3,
+    "batch_report": 3,
+    "start_pool": 3,
+    "random_report_pool": 3,
+    "debug_chat": 4,
+    "debug_start": 4,
+}
+
+
+# Calls made for the client that is waiting on the response: bound by its deadline and
+# abandoned when it disconnects. Background work outlives the request that started it.
+FOREGROUND_ENDPOINTS = {"chat", "report", "start", "random_report", "debug_chat", "debug_start"}
+# A foreground call with less time than this left before the deadline is not started
+LLM_MIN_CALL_SECONDS = float(os.getenv("LLM_MIN_CALL_SECONDS", "2"))
+
+
+class OverloadedError(Exception):
+    """Raised when the gate queue is full or a caller waited too long for a slot."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Server busy ({reason}); retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class ConcurrencyGate:
+    """Bounded priority queue in front of the upstream concurrency limit.
+
+    Waiters are ordered by endpoint priority, then by how many calls their client
+    already has queued (so one session can't crowd out the others), then by arrival.
+    A full queue sheds its lowest-priority waiter for a more important arrival, or
+    rejects the arrival; nobody waits longer than `queue_timeout`.
+    """
+
+    def __init__(self, limit, max_queue=LLM_MAX_QUEUE, queue_timeout=LLM_QUEUE_TIMEOUT):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.peak_waiting = 0
+        self._waiters = {}  # future -> ((priority, queued calls of the client, seq), client)
+        self._queued_by_client = {}
+        self._seq = 0
+        self._shed = 0
+        self._timed_out = 0
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    @asynccontextmanager
+    async def slot(self, endpoint, client=None, max_wait=None):
+        queued = time.perf_counter()
+        await self._acquire(ENDPOINT_PRIORITIES.get(endpoint, 2), client, endpoint, max_wait)
+        record("llm.queue", queued, endpoint=endpoint)
+        try:
+            yield self
+        finally:
+            self._release()
+
+    async def _acquire(self, priority, client, endpoint, max_wait=None):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            self._publish()
+            return
+        self._seq += 1
+        rank = (priority, self._queued_by_client.get(client, 0), self._seq)
+        if len(self._waiters) >= self.max_queue:
+            worst = max(self._waiters, key=self._rank)
+            if self._rank(worst) <= rank:
+                self._reject("queue_full", endpoint)
+            self._drop(worst)
+            worst.set_exception(OverloadedError("shed", self.queue_timeout))
+            self._shed += 1
+            metrics.inc("llm_gate_rejections_total", reason="shed")
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[future] = (rank, client)
+        if client is not None:
+            self._queued_by_client[client] = self._queued_by_client.get(client, 0) + 1
+        self.peak_waiting = max(self.peak_waiting, len(self._waiters))
+        self._publish()
+        try:
+            wait = self.queue_timeout if max_wait is None else min(self.queue_timeout, max_wait)
+            await asyncio.wait_for(asyncio.shield(future), wait)
+        except asyncio.TimeoutError:
+            if future.done() and not future.exception():
+                return  # Granted at the last moment
+            self._drop(future)
+            self._timed_out += 1
+            if max_wait is not None and max_wait < self.queue_timeout:
+                # Waited until the request's deadline, not the queue's: a 504, not a 503
+                metrics.inc("llm_gate_rejections_total", reason="deadline", endpoint=endpoint)
+                self._publish()
+                raise DeadlineExceeded(endpoint, LLM_MIN_CALL_SECONDS)
+            self._reject("queue_timeout", endpoint)
+        except BaseException:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # Slot was granted but the caller went away: pass it on
+                self._release()
+            else:
+                self._drop(future)
+            raise
+
+    def _reject(self, reason, endpoint):
+        metrics.inc("llm_gate_rejections_total", reason=reason, endpoint=endpoint)
+        self._publish()
+        raise OverloadedError(reason, self.queue_timeout)
+
+    def _rank(self, future):
+        return self._waiters[future][0]
+
+    def _drop(self, future):
+        entry = self._waiters.pop(future, None)
+        if entry is None:
+            return
+        client = entry[1]
+        if client is not None:
+            remaining = self._queued_by_client.get(client, 1) - 1
+            if remaining:
+                self._queued_by_client[client] = remaining
+            else:
+                self._queued_by_client.pop(client, None)
+
+    def _release(self):
+        self.in_flight -= 1
+        if self._waiters and self.in_flight < self.limit:
+            best = min(self._waiters, key=self._rank)
+            self._drop(best)
+            self.in_flight += 1
+            best.set_result(None)
+        self._publish()
+
+    def _publish(self):
+        metrics.set_gauge("llm_queue_depth", len(self._waiters))
+        metrics.set_gauge("llm_in_flight", self.in_flight)
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "peak_waiting": self.peak_waiting,
+            "max_queue": self.max_queue,
+            "shed": self._shed,
+            "timed_out": self._timed_out,
+        }
+
+
+class CancellationLedger:
+    """Counts upstream calls abandoned before they finished and estimates the tokens saved.
+
+    Estimates use a moving average of each endpoint's usage: a call that never started
+    saves its typical prompt and completion tokens, one cut off part-way the completion
+    tokens it had yet to produce.
+    """
+
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+        self._typical = {}  # endpoint -> [prompt tokens, completion tokens]
+        self._counts = {}  # (endpoint, reason) -> calls
+        self._saved = 0
+
+    def observe(self, endpoint, usage):
+        if usage is None:
+            return
+        typical = self._typical.get(endpoint)
+        if typical is None:
+            self._typical[endpoint] = [usage["prompt_tokens"], usage["completion_tokens"]]
+            return
+        typical[0] += self.alpha * (usage["prompt_tokens"] - typical[0])
+        typical[1] += self.alpha * (usage["completion_tokens"] - typical[1])
+
+    def record(self, endpoint, reason, started=True, generated=0):
+        prompt, completion = self._typical.get(endpoint, (0, 0))
+        saved = round(max(completion - generated, 0) + (0 if started else prompt))
+        self._counts[(endpoint, reason)] = self._counts.get((endpoint, reason), 0) + 1
+        self._saved += saved
+        metrics.inc("llm_cancelled_total", endpoint=endpoint, reason=reason)
+        metrics.inc("llm_tokens_saved_total", saved, endpoint=endpoint)
+
+    def stats(self):
+        return {
+            "cancelled": {f"{endpoint}:{reason}": n for (endpoint, reason), n in sorted(self._counts.items())},
+            "estimated_tokens_saved": self._saved,
+        }
+
+
+def call_deadline(endpoint):
+    """Deadline (monotonic) of the request a foreground call is made for, or None.
+
+    Raises DeadlineExceeded when too little time is left for the call to be worth starting.
+    """
+    context = current_request.get()
+    if context is None or context.deadline is None or endpoint not in FOREGROUND_ENDPOINTS:
+        return None
+    remaining = context.remaining()
+    if remaining < LLM_MIN_CALL_SECONDS:
+        cancellations.record(endpoint, "deadline", started=False)
+        raise DeadlineExceeded(endpoint, remaining)
+    return context.deadline
+
+
+def cancel_reason():
+    context = current_request.get()
+    return "client_disconnect" if context is not None and context.disconnected else "cancelled"
+
+
+gate = ConcurrencyGate(LLM_MAX_CONCURRENCY)
+
+cancellations = CancellationLedger()
+
+# Timeouts, retries, hedging and the circuit breaker; the SDK's own retries are off
+transport = Transport()
+
+# Model choice per endpoint/mode, A/B arms and latency-aware fallback
+router = ModelRouter()
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:  # preload_sdk may be building it in a thread
+            if _client is None:
+                # Deferred: importing the SDK costs ~0.5 s, which cold starts shouldn't pay up front
+                from openai import AsyncOpenAI
+                _client = AsyncOpenAI(
+                    api_key=os.getenv("ALIYUN_API_KEY"),
+                    base_url=os.getenv("ALIYUN_API_BASE"),
+                    http_client=build_http_client(),
+                    max_retries=0,
+                )
+    return _client
+
+
+def preload_sdk():
+    """Build the client (SDK import and its lazily loaded chat resource) ahead of the first call.
+
+    Run it in a thread, so the event loop keeps serving meanwhile.
+    """
+    get_client().chat.completions
+
+
+def _max_wait(endpoint, deadline):
+    """Seconds a call may wait for a gate slot and still have LLM_MIN_CALL_SECONDS to run."""
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= LLM_MIN_CALL_SECONDS:
+        # Time ran out since call_deadline(): no point queueing for a call that can't finish
+        cancellations.record(endpoint, "deadline", started=False)
+        raise DeadlineExceeded(endpoint, remaining)
+    return remaining - LLM_MIN_CALL_SECONDS
+
+
+async def chat_completion(endpoint, session_id=None, **kwargs):
+    """Run one chat completion through the shared async client and the concurrency gate.
+
+    Cancelling the caller (the client disconnected, the last waiter went away) aborts
+    the upstream request.
+    """
+    deadline = call_deadline(endpoint)
+    started = None
+    try:
+        async with gate.slot(endpoint, session_id, _max_wait(endpoint, deadline)):
+            started = time.perf_counter()
+            try:
+                completion = await transport.call(
+                    endpoint,
+                    lambda timeout: get_client().chat.completions.create(timeout=timeout, **kwargs),
+                    deadline=deadline,
+                )
+            except Exception:
+                metrics.inc("llm_errors_total", endpoint=endpoint)
+                router.record(endpoint, kwargs.get("model"), time.perf_counter() - started, session_id=session_id, ok=False)
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                metrics.inc("llm_seconds_total", elapsed, endpoint=endpoint)
+                metrics.observe("llm_request_seconds", elapsed, endpoint=endpoint)
+                record("llm.call", started, endpoint=endpoint, model=kwargs.get("model"))
+    except asyncio.CancelledError:
+        cancellations.record(endpoint, cancel_reason(), started=started is not None)
+        raise
+    metrics.inc("llm_requests_total", endpoint=endpoint)
+    usage = usage_ledger.record(endpoint, completion.usage, session_id)
+    cancellations.observe(endpoint, usage)
+    router.record(endpoint, kwargs.get("model"), elapsed, usage, session_id)
+    return completion
+
+
+async def stream_completion(endpoint, session_id=None, **kwargs):
+    """Stream content deltas for one chat completion; the gate slot is held until the stream ends.
+
+    If the consumer is cancelled or stops iterating, the upstream stream is closed.
+    """
+    deadline = call_deadline(endpoint)
+    started = None
+    generated = 0
+    try:
+        async with gate.slot(endpoint, session_id, _max_wait(endpoint, deadline)):
+            started = time.perf_counter()
+            first_token_at = None
+            usage = None
+            stream = None
+            try:
+                # Only opening the stream is retried; a stream that breaks mid-way is not replayed
+                stream = await transport.call(
+                    endpoint,
+                    lambda timeout: get_client().chat.completions.create(
+                        stream=True, stream_options={"include_usage": True}, timeout=timeout, **kwargs
+                    ),
+                    hedgeable=False,
+                    deadline=deadline,
+                )
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        usage = usage_ledger.record(endpoint, chunk.usage, session_id)
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                            metrics.inc("llm_first_token_seconds_total", first_token_at - started, endpoint=endpoint)
+                            metrics.observe("llm_first_token_seconds", first_token_at - started, endpoint=endpoint)
+                        generated += 1  # Roughly one token per chunk
+                        yield delta
+            except Exception:
+                metrics.inc("llm_errors_total", endpoint=endpoint)
+                router.record(endpoint, kwargs.get("model"), time.perf_counter() - started, usage, session_id, ok=False)
+                raise
+            finally:
+                if stream is not None:
+                    # Drops the upstream connection if the stream was abandoned part-way
+                    await stream.close()
+                elapsed = time.perf_counter() - started
+                metrics.inc("llm_seconds_total", elapsed, endpoint=endpoint)
+                metrics.observe("llm_request_seconds", elapsed, endpoint=endpoint)
+                # Spans the whole stream; a span can't stay open across this generator's yields
+                record("llm.stream", started, endpoint=endpoint, model=kwargs.get("model"), chunks=generated,
+                       first_token_ms=round((first_token_at - started) * 1000, 1) if first_token_at else None)
+            metrics.inc("llm_requests_total", endpoint=endpoint)
+            cancellations.observe(endpoint, usage)
+            router.record(endpoint, kwargs.get("model"), elapsed, usage, session_id)
+    except (asyncio.CancelledError, GeneratorExit):
+        cancellations.record(endpoint, cancel_reason(), started=started is not None, generated=generated)
+        raise
@@ -0,0 +1,64 @@
+"""
+Concurrency load test for the backend, meant to run against fake_llm.py.
+
+    python fake_llm.py --latency 2 &
+    ALIYUN_API_BASE=http://127.0.0.1:9000/v1 ALIYUN_API_KEY=fake uvicorn main:app --port 8000 &
+    python load_test.py --concurrency 200 --requests 400
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import httpx
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+
+async def worker(client, url, queue, latencies, errors):
+    while True:
+        try:
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        started = time.perf_counter()
+        try:
+            response = await client.post(url, json={"message": "Hello from load test"})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            errors.append(repr(e))
+
+
+async def run(base_url, endpoint, concurrency, total):
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            worker(client, f"{base_url}{endpoint}", queue, latencies, errors)
+            for _ in range(concurrency)
+        ])
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"{'='*20} Load Test: {endpoint} {'='*20}")
+    print(f"Requests: {total}  Concurrency: {concurrency}  Errors: {len(errors)}")
+    print(f"Wall time: {elapsed:.2f}s  Throughput: {len(latencies) / elapsed:.1f} req/s")
+    if latencies:
+        print(f"Latency p50: {latencies[len(latencies) // 2]:.2f}s  max: {latencies[-1]:.2f}s")
+    if errors:
+        print(f"First error: {errors[0]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--endpoint", default="/chat")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=400)
+    args = parser.parse_args()
+    asyncio.run(run(args.base_url, args.endpoint, args.concurrency, args.requests))
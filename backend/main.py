@@ -1,29 +1,91 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
+import asyncio
 import os
 from typing import List, Dict, Optional
 import json
-from openai import OpenAI
 import logging
-import uvicorn
+import hashlib
+import inspect
+import random
+import time
+
+# Load .env before the modules below read their settings from the environment.
+# Importing this module must stay cheap: it is on every serverless cold start, so the
+# OpenAI SDK, the HTTP pool and uvicorn are only loaded when actually needed.
+load_dotenv()
+
+import llm
+from transport import CircuitOpenError
+from request_context import DeadlineExceeded, RequestContextMiddleware, current_request
+from metrics import RequestMetricsMiddleware, metrics
+from wire import CompressionMiddleware, history_delta, history_version, version_matches
+from session_store import create_store, new_session
+from streaming import DoneMarkerFilter, SSE_HEADERS, sse_event
+from report_parser import LEGACY_KEYS, REPORT_KEYS, ReportStreamParser, analyze_report
+from prompts import (
+    BASE_SYSTEM_PROMPT, DEBUG_CHAT_SYSTEM_PROMPT, DEBUG_START_MESSAGE, RANDOM_REPORT_PROMPT,
+    assemble, history_mode, mode_instruction, report_messages, report_section_messages, session_tail, start_history,
+    summary_messages,
+)
+from usage import usage_ledger
+from report_prefetch import ReportPrefetcher, history_key
+from report_cache import ReportCache, cache_key
+from compaction import HistoryCompactor
+from dimension_coverage import CoverageTracker
+from rate_limit import RateLimited, RateLimiter
+from sectioned_report import REPORT_SECTIONED, SectionedReport
+from opening_pool import OPENING_POOL_WARM_START, OpeningPool
+from report_bank import ReportBank
+from report_archive import ReportArchive
+from tracing import TraceMiddleware, TracedRoute, detach, exporter as trace_exporter, span, tag_session
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-
-# DEBUG: Print loaded config
-print("--- BACKEND STARTUP DEBUG ---")
-print(f"API Base: {os.getenv('ALIYUN_API_BASE')}")
-print(f"Model: {os.getenv('ALIYUN_MODEL_NAME')}")
-key = os.getenv("ALIYUN_API_KEY")
-print(f"API Key: {key[:6]}...{key[-4:] if key else 'None'}")
-print("-----------------------------")
-
-app = FastAPI(root_path="/api")
+# Fraction of sessions whose full messages and replies are logged; off by default
+LOG_CONTENT_SAMPLE = float(os.getenv("LOG_CONTENT_SAMPLE", "0"))
+# Regenerate only the broken sections of a report instead of serving it partial
+REPORT_REPAIR = os.getenv("REPORT_REPAIR", "1") == "1"
+
+def log_content(label: str, text: str, session_id: Optional[str] = None):
+    """Log conversation text for debugging, for a sample of sessions only.
+
+    A session is in or out of the sample as a whole, so a sampled conversation can be followed turn by turn.
+    """
+    if LOG_CONTENT_SAMPLE <= 0:
+        return
+    if session_id:
+        bucket = int(hashlib.sha1(session_id.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+    else:
+        bucket = random.random()
+    if bucket < LOG_CONTENT_SAMPLE:
+        logger.info(f"[content] {label} (session {session_id}): {text}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    key = os.getenv("ALIYUN_API_KEY")
+    logger.info(f"API Base: {os.getenv('ALIYUN_API_BASE')}, Model: {os.getenv('ALIYUN_MODEL_NAME')}, "
+                f"API Key: {key[:6] + '...' + key[-4:] if key else 'None'}")
+    # The opening pool fills on the first /assessment/start of each mode, unless asked to warm up now
+    if OPENING_POOL_WARM_START:
+        opening_pool.refill()
+    # The random report bank starts filling on the first /assessment/random_report.
+    # Nothing is generated at startup, so build the SDK client now (~1 s, off the event loop)
+    # rather than inside the first users' requests; serverless runtimes may skip lifespan
+    # and build it on demand
+    await asyncio.get_running_loop().run_in_executor(None, llm.preload_sdk)
+    yield
+    trace_exporter.flush()
+
+app = FastAPI(root_path="/api", lifespan=lifespan)
+# Every endpoint below records a `handler` span when its request is traced
+app.router.route_class = TracedRoute
 
 # Add CORS middleware
 app.add_middleware(
@@ -33,6 +95,14 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# gzip/br for request and response bodies, negotiated per request (WIRE_COMPRESSION)
+app.add_middleware(CompressionMiddleware)
+# Cancels the handler (and its upstream call) when the client goes away; request deadlines
+app.add_middleware(RequestContextMiddleware)
+# Outermost, so the timings include CORS handling and the whole streamed body
+app.add_middleware(RequestMetricsMiddleware)
+# Per-session span traces (TRACE_SAMPLE, or X-Trace with TRACE_HEADER=1); outermost of all
+app.add_middleware(TraceMiddleware)
 
 class ChatMessage(BaseModel):
     role: str
@@ -40,83 +110,150 @@ class ChatMessage(BaseModel):
 
 class AssessmentStartResponse(BaseModel):
     message: str
-    history: List[ChatMessage]
+    session_id: str
+    history: Optional[List[ChatMessage]] = None
+    history_version: Optional[str] = None
 
 class AssessmentStartRequest(BaseModel):
     mode: str = "normal" # "normal" or "quick"
+    include_history: bool = True # Session-aware clients set False and only keep session_id
+    stream: bool = False # Reply as Server-Sent Events instead of one JSON body
 
 class AssessmentChatRequest(BaseModel):
-    user_message: str
-    history: List[ChatMessage]
+    # Either session_id (history kept server-side) or the legacy full history
+    session_id: Optional[str] = None
+    user_message: str = ""
+    history: Optional[List[ChatMessage]] = None
+    # Delta clients keep the history too, but send only the version of the copy they hold;
+    # the reply then carries just the new messages (history_delta) and the next version
+    history_version: Optional[str] = None
+    # Sent with the full history, so a session adopted from it keeps the mode it was started in
+    mode: Optional[str] = None
+    stream: bool = False # Reply as Server-Sent Events instead of one JSON body
 
 class AssessmentChatResponse(BaseModel):
     message: str
-    history: List[ChatMessage]
+    session_id: str
+    history: Optional[List[ChatMessage]] = None
+    history_delta: Optional[List[ChatMessage]] = None
+    history_version: Optional[str] = None
     is_finished: bool = False
 
 class DebugChatInput(BaseModel):
     message: str
 
-# Configure OpenAI client for Aliyun/DeepSeek
-client = OpenAI(
-    api_key=os.getenv("ALIYUN_API_KEY"),
-    base_url=os.getenv("ALIYUN_API_BASE"),
-)
-
-# Load System Prompt
-BASE_SYSTEM_PROMPT = """
-天赋咨询机器人：系统提示词（System Prompt）
-# 角色定位 你是一位融合了“流理论”与“荣格心理学”的顶级生涯咨询师。你的任务是通过深度对话，挖掘用户潜意识中被遮蔽的天赋底层能力。
-
-# 核心对话准则（必须严格遵守）
-
-单次单问： 严禁一次性抛出多个问题。必须采用“你问 -> 用户答 -> 你简短反馈并分析 -> 你提下一个问题”的模式。
-
-追问机制： 必问问题有 4 个（见下文），但你可以根据用户的回答细节，进行 1-3 次即兴深度追问。总对话轮数控制在 6-10 轮。
-
-反馈艺术： 每一轮反馈都要体现出“温暖而犀利”。要能指出用户回答中隐藏的矛盾、逻辑漏洞或潜意识信号。
-
-# 必问的四个维度
-
-童年冲动： 16岁前无视奖励也愿意废寝忘食做的事，或被批评的“顽固缺点”。
-
-无意识胜任： 成年后觉得“这不就是常识吗”但别人觉得很难的事。
-
-能量审计： 哪些事做完后虽然累，但精神极度亢奋（回血感）。
-
-嫉妒镜像： 坦诚面对曾产生过的强烈嫉妒感（嫉妒是天赋被压抑的背面）。
-
-# 任务流阶段
-
-阶段 1：开场白。 用温暖共情的语气欢迎用户，解释流程（约10轮对话），告知目标是生成《天赋说明书》。然后抛出第一个问题。
-
-阶段 2：交互挖掘。 执行多轮对话，确保覆盖上述四个维度。
-
-阶段 3：总结报告。 当你认为信息收集充分或达到轮数上限时，通知用户开始生成报告，并输出指令符 【DONE】。
-
-# 报告输出格式要求 (核心) 报告必须包含以下模块，缺一不可：
-
-天赋核心词（三个）： 用 2-4 字的词语精准概括（如：跨界连接者、深海潜行者、情感调频师）。
-
-职业适配指南（五个）：
+# The Aliyun/DeepSeek client lives in llm.py: one shared AsyncOpenAI client behind
+# a per-process priority gate (LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE)
+
+def upstream_error(e: Exception):
+    # Fail fast with 503 while the circuit breaker is open or the gate is full, so clients back off
+    if isinstance(e, (CircuitOpenError, llm.OverloadedError)):
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(max(1, int(e.retry_after)))})
+    context = current_request.get()
+    remaining = context.remaining() if context is not None else None
+    if isinstance(e, DeadlineExceeded) or (remaining is not None and remaining <= 0):
+        # Out of time, whether before the call or while it ran
+        return HTTPException(status_code=504, detail=str(e))
+    return HTTPException(status_code=500, detail=str(e))
+
+# Token buckets per client and endpoint class; RATE_LIMIT_BACKEND=memory (default) or sqlite
+limiter = RateLimiter()
+# Which assessment dimensions each conversation has covered; steers and ends chat turns (COVERAGE_TRACKING)
+coverage_tracker = CoverageTracker()
+# Behind Vercel's proxy the client address is in X-Forwarded-For; elsewhere it can be forged
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "1" if os.getenv("VERCEL") else "0") == "1"
+
+@app.exception_handler(RateLimited)
+async def rate_limited_handler(request: Request, e: RateLimited):
+    return JSONResponse(status_code=429, content={"detail": str(e)}, headers={"Retry-After": str(int(e.retry_after))})
+
+def client_ip(request: Request):
+    forwarded = request.headers.get("X-Forwarded-For") if RATE_LIMIT_TRUST_PROXY else None
+    if forwarded:
+        return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "anonymous"
+
+def check_client_limit(endpoint_class: str, request: Request):
+    """Limit a device (X-Client-Id) and, with a higher `<class>_ip` ceiling, its whole IP.
+
+    Clients without the header only count against the IP ceiling, so a shared address
+    isn't throttled like a single user.
+    """
+    ip = client_ip(request)
+    client_id = request.headers.get("X-Client-Id")
+    if client_id:
+        limiter.check(endpoint_class, f"client:{ip}:{client_id[:64]}")
+    limiter.check(f"{endpoint_class}_ip", f"ip:{ip}")
+
+def session_rate_key(request: Request, input: "AssessmentChatRequest", session):
+    # Only server-issued sessions get their own bucket; legacy full-history requests count against the IP
+    return f"session:{session['id']}" if input.history is None else f"ip:{client_ip(request)}"
+
+# Assessment history is kept server-side; SESSION_STORE=memory (default) or sqlite
+sessions = create_store()
+
+async def load_session(input: AssessmentChatRequest):
+    """Resolve the conversation for a chat/report request.
+
+    Session-aware clients send only session_id. Legacy clients send the full history,
+    which is adopted into a fresh session (with an id issued here, never the client's)
+    so the next turn can switch to the id. Delta
+    clients send session_id and history_version; when the server's copy is gone or
+    differs they get a 409 `history_resync` and repeat the request with the full history,
+    which then replaces the server's copy.
+    """
+    if input.session_id:
+        tag_session(input.session_id)
+        with span("session.load"):
+            session = await sessions.get_async(input.session_id)
+        if session is not None:
+            if input.history is not None:
+                adopt_history(session, [{"role": m.role, "content": m.content} for m in input.history])
+            elif input.history_version is not None:
+                check_history_version(session, input.history_version)
+            return session
+        if input.history is None and input.history_version is not None:
+            raise history_resync("Session not found on this server", None)
+        if input.history is None:
+            raise HTTPException(status_code=404, detail="Session not found or expired. Please restart the assessment.")
+    if input.history is None:
+        raise HTTPException(status_code=400, detail="Either session_id or history is required.")
+    history = [{"role": m.role, "content": m.content} for m in input.history]
+    session = new_session(history, mode=input.mode or history_mode(history))
+    tag_session(session["id"])
+    return session
+
+def adopt_history(session, history):
+    """Replace a session's stored history with the client's copy when they differ.
+
+    The client's copy wins: after a 409 it holds the turns that went through another
+    instance (or that this one lost). Replacing the messages changes the history version.
+    """
+    stored = session["history"]
+    if history_version(history) == history_version(stored):
+        return
+    metrics.inc("history_adopted_total")
+    if history[:len(stored)] != stored:
+        # Not a continuation: the rolling summary and any prefetched report were for another conversation
+        session.get("meta", {}).pop("summary", None)
+        history_compactor.settle(session["id"])
+        report_prefetcher.cancel_session(session["id"], reason="superseded")
+    session["history"] = history
+
+def history_resync(reason: str, server_version: Optional[str]):
+    metrics.inc("history_resyncs_total")
+    return HTTPException(status_code=409, detail={
+        "code": "history_resync",
+        "message": f"{reason}; resend the request with the full history",
+        "history_version": server_version,
+    })
+
+def check_history_version(session, client_version: str):
+    # The client's copy must be exactly the stored history, not just a prefix of it
+    server_version = history_version(session["history"])
+    if client_version != server_version:
+        raise history_resync("History version mismatch", server_version)
 
-按照适配度由高到低排序。
-
-每一项需注明：【职业名称】+【适配原因深度解析】。
-
-天赋特征详述（深度模块）： * 必须不少于 1000 字。
-
-内容需涵盖：天赋的底层逻辑、它是如何在用户生活中起作用的、它如何解释用户过去的困惑、以及如何应对天赋带来的负面效应（阴影面）。
-
-行动指南（具体建议）： 包含可执行清单与节奏建议，工具/练习/里程碑。
-
-不适合的事情（避坑指南）： 列举不匹配的工作方式/环境/角色，说明原因与风险。
-
-# 初始指令 现在，请开始第一阶段：用温暖的语调开场，并直接提出第一个关于“童年/缺点”的问题。
-
-# 语言风格特别要求
-严禁舞台剧式描写：严禁使用（括号）描写动作、神态或心理活动（如“（微笑）”、“（严肃地）”、“（身体前倾）”等）。直接说话，不要加戏。保持专业、温暖、对话感。
-"""
 
 @app.get("/")
 def read_root():
@@ -128,278 +265,522 @@ def health_check():
     logger.info("Health check hit")
     return {"status": "ok", "model": os.getenv("ALIYUN_MODEL_NAME")}
 
+@app.get("/stats")
+def get_stats():
+    return {"llm_gate": llm.gate.stats(), "transport": llm.transport.stats(), "report_prefetch": report_prefetcher.stats(),
+            "report_cache": report_cache.stats(), "history_compaction": history_compactor.stats(),
+            "coverage": coverage_tracker.stats(), "report_archive": report_archive.stats(),
+            "tracing": trace_exporter.stats(),
+            "model_routing": llm.router.stats(),
+            "opening_pool": opening_pool.stats(), "random_report_bank": random_report_bank.stats(),
+            "rate_limit": limiter.stats(), "cancellations": llm.cancellations.stats(),
+            # Component state above is this worker's; the metrics below add up all of serve.py's workers
+            "worker_pid": os.getpid(), **metrics.collect().snapshot()}
+
+@app.get("/metrics")
+def get_metrics():
+    # Prometheus text format; /stats has the same numbers plus component state as JSON
+    return PlainTextResponse(metrics.collect().render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/usage/{session_id}")
+def get_session_usage(session_id: str):
+    usage = usage_ledger.session(session_id)
+    if usage is None:
+        raise HTTPException(status_code=404, detail="No usage recorded for this session.")
+    return usage
+
+# Aggregates over archived reports; `days` limits them to recent reports
+@app.get("/archive/traits")
+def archive_traits(request: Request, limit: int = 20, source: Optional[str] = None, days: Optional[float] = None):
+    limiter.check("debug", f"ip:{client_ip(request)}")
+    return report_archive.top_traits(min(limit, 500), source, time.time() - days * 86400 if days else None)
+
+@app.get("/archive/careers")
+def archive_careers(request: Request, limit: int = 20, source: Optional[str] = None, days: Optional[float] = None,
+                    trait: Optional[str] = None):
+    limiter.check("debug", f"ip:{client_ip(request)}")
+    since = time.time() - days * 86400 if days else None
+    if trait:
+        return report_archive.careers_for_trait(trait, min(limit, 500), source, since)
+    return report_archive.top_careers(min(limit, 500), source, since)
+
 @app.post("/chat")
-def chat_with_ai(input: DebugChatInput):
-    logger.info(f"Chat endpoint hit with message: {input.message}")
+async def chat_with_ai(input: DebugChatInput, request: Request):
+    limiter.check("debug", f"ip:{client_ip(request)}")
+    log_content("Debug chat message", input.message)
     try:
-        completion = client.chat.completions.create(
-            model=os.getenv("ALIYUN_MODEL_NAME", "deepseek-v3"),
+        completion = await llm.chat_completion(
+            "debug_chat",
+            model=llm.router.choose("debug_chat"),
             messages=[
-                {'role': 'system', 'content': "You are a helpful assistant. Keep answers short."},
+                {'role': 'system', 'content': DEBUG_CHAT_SYSTEM_PROMPT},
                 {'role': 'user', 'content': input.message}
             ],
             temperature=0.7
         )
         reply = completion.choices[0].message.content
-        logger.info(f"AI Reply: {reply}")
+        log_content("Debug chat reply", reply)
         return {"reply": reply}
     except Exception as e:
         logger.error(f"Chat Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise upstream_error(e)
 
 @app.post("/debug/start")
-def start_debug_chat():
+async def start_debug_chat(request: Request):
+    limiter.check("debug", f"ip:{client_ip(request)}")
     logger.info("Starting debug chat session with System Prompt")
     try:
         messages = [{'role': 'system', 'content': BASE_SYSTEM_PROMPT}]
-        messages.append({'role': 'user', 'content': "你好，请开始你的工作。"})
+        messages.append({'role': 'user', 'content': DEBUG_START_MESSAGE})
 
-        completion = client.chat.completions.create(
-            model=os.getenv("ALIYUN_MODEL_NAME", "deepseek-v3"),
+        completion = await llm.chat_completion(
+            "debug_start",
+            model=llm.router.choose("debug_start"),
             messages=messages,
             temperature=0.7
         )
         
         reply = completion.choices[0].message.content
-        logger.info(f"Debug Chat Started. AI: {reply}")
+        log_content("Debug chat started", reply)
         
         return {"reply": reply}
     except Exception as e:
         logger.error(f"Start Debug Chat Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise upstream_error(e)
+
+async def finish_start(session, reply: str, include_history: bool):
+    # Store the AI's reply in the history and return it with the session id
+    session["history"].append({'role': 'assistant', 'content': reply})
+    with span("session.save"):
+        await sessions.save_async(session)
+
+    response = {
+        "message": reply,
+        "session_id": session["id"]
+    }
+    if include_history:
+        response["history"] = session["history"]
+        response["history_version"] = history_version(session["history"])
+    return response
+
+async def finish_chat_turn(session, messages, reply: str, legacy: bool, client_version: Optional[str] = None,
+                     coverage: Optional[dict] = None):
+    # Remove [DONE] token from AI reply if present before sending to frontend
+    reply_to_user = reply.replace("【DONE】", "").strip()
+
+    messages.append({'role': 'assistant', 'content': reply})
+
+    # 【DONE】, or once the tracker has seen every dimension covered / the turn budget used up
+    is_finished = coverage_tracker.finished(coverage, reply, messages)
+
+    session["history"] = messages
+    with span("session.save"):
+        await sessions.save_async(session)
+    if is_finished:
+        history_compactor.settle(session["id"])
+        report_prefetcher.schedule(session["id"], messages)
+    else:
+        # The conversation went on after a finished turn: a report prefetched then is stale
+        report_prefetcher.cancel_session(session["id"], reason="superseded")
+        history_compactor.schedule(session)
+
+    response = {
+        "message": reply_to_user,
+        "session_id": session["id"],
+        "is_finished": is_finished
+    }
+    # Delta clients get the messages they don't have yet; legacy clients keep posting the
+    # full history back; session clients don't need it
+    if client_version is not None and version_matches(messages, client_version):
+        response["history_delta"] = history_delta(messages, client_version)
+        response["history_version"] = history_version(messages)
+    elif legacy:
+        response["history"] = messages
+    return response
+
+def parse_report(result_content: str):
+    """Parse a report completion, salvaging what it can; None if nothing was usable."""
+    with span("report.parse", chars=len(result_content)):
+        parsed_json, broken, repairs = analyze_report(result_content)
+    for kind in repairs:
+        metrics.inc("report_repairs_total", kind=kind)
+    if parsed_json is None:
+        logger.error(f"Report JSON could not be parsed ({len(result_content)} chars)")
+        log_content("Unparseable report", result_content)
+        metrics.inc("report_parse_failures_total")
+        return None
+    if broken:
+        # Keep the sections we did get instead of throwing away the whole generation
+        logger.warning(f"Salvaged partial report. Broken sections: {broken}")
+        metrics.inc("report_salvaged_total")
+        parsed_json["partial"] = True
+        parsed_json["missing_sections"] = broken
+    return parsed_json
+
+def build_report(result_content: str, history, session=None):
+    parsed_json = parse_report(result_content)
+    metrics.inc("reports_built_total", kind="assessment")
+    if parsed_json is None:
+        metrics.inc("report_fallbacks_total", kind="assessment")
+        return {
+            "core_traits": ["生成失败", "请重试", "格式错误"],
+            "deep_analysis": f"报告生成时出现格式错误。原始内容: {result_content[:500]}...",
+            "not_suitable": "请联系管理员查看日志。",
+            "action_guide": "刷新页面重试。",
+            "careers": [],
+            "full_chat_history": []
+        }
+    report_archive.add(parsed_json, "assessment", session["id"] if session else None, session["mode"] if session else None)
+    # Inject full chat history into the response
+    parsed_json["full_chat_history"] = [
+        {"role": m["role"], "content": m["content"]}
+        for m in history
+        if m["role"] != "system" # Exclude system prompt from frontend view
+    ]
+    return parsed_json
+
+async def finish_report(result_content: str, history, session, context):
+    # Cached and prefetched completions are repaired already; a live stream may not be
+    return build_report(await repaired_report("report", result_content, context), history, session)
+
+def stream_sse(deltas, on_complete, session_id: str, done_filter=None, section_parser=None):
+    """Relay an async iterator of text deltas as SSE `delta` events, then a final `done` event built by on_complete(full_text).
+
+    With a section_parser, each completed top-level report key is also sent as a `section` event.
+    """
+    async def events():
+        yield sse_event("start", {"session_id": session_id})
+        parts = []
+        try:
+            async for delta in deltas:
+                parts.append(delta)
+                text = done_filter.feed(delta) if done_filter else delta
+                if text:
+                    yield sse_event("delta", {"content": text})
+                if section_parser:
+                    for key, value in section_parser.feed(delta):
+                        yield sse_event("section", {"key": LEGACY_KEYS.get(key, key), "value": value})
+            if done_filter:
+                tail = done_filter.flush()
+                if tail:
+                    yield sse_event("delta", {"content": tail})
+            result = on_complete("".join(parts))
+            if inspect.isawaitable(result):
+                result = await result
+            yield sse_event("done", result)
+        except Exception as e:
+            logger.error(f"Stream Error: {e}")
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+async def summarize_history(previous_summary, turns, session_id):
+    detach()  # Runs in the background (HistoryCompactor); not part of the request that scheduled it
+    completion = await llm.chat_completion(
+        "compact",
+        session_id=session_id,
+        model=llm.router.choose("compact", session_id=session_id),
+        messages=summary_messages(previous_summary, turns),
+        temperature=0.2,
+        max_tokens=800
+    )
+    return completion.choices[0].message.content
+
+# Long conversations are sent as a rolling summary plus the most recent turns
+history_compactor = HistoryCompactor(summarize_history)
+
+def report_context(history, session_id=None, session=None):
+    """What every call for one report shares: the (compacted) conversation and the model.
+
+    Resolved once per report, so the cache key, the generation and any section repairs
+    use the same prompt, and the compaction is done (and counted) only once.
+    """
+    return {
+        "session_id": session_id,
+        "conversation": history_compactor.compact(history, session),
+        "model": llm.router.choose("report", mode=session["mode"] if session else None, session_id=session_id),
+    }
+
+def report_llm_kwargs(context, section=None, core_traits=None):
+    if section:
+        messages = report_section_messages(context["conversation"], section, core_traits)
+    else:
+        messages = report_messages(context["conversation"])
+    return {
+        "model": context["model"],
+        "messages": messages,
+        "temperature": 0.1, # Low temp for deterministic formatting
+        "response_format": { "type": "json_object" }
+    }
+
+def cacheable_report(result_content: str):
+    """Only complete, valid reports are cached; partial ones are worth regenerating."""
+    parsed_json, broken, _ = analyze_report(result_content)
+    return parsed_json is not None and not broken
+
+# Identical report requests (refresh, re-click, retry) share one upstream call and its result
+report_cache = ReportCache(cacheable_report)
+
+def report_cache_key(context):
+    return cache_key(report_llm_kwargs(context), variant="sectioned" if REPORT_SECTIONED else None)
+
+def section_generator(endpoint, context):
+    async def generate_section(section, core_traits):
+        llm_kwargs = report_llm_kwargs(context, section, core_traits)
+        completion = await llm.chat_completion(endpoint, session_id=context["session_id"], **llm_kwargs)
+        return completion.choices[0].message.content
+
+    return generate_section
+
+def sectioned_report_deltas(endpoint, context):
+    """The report as concurrent per-section requests, yielded as JSON text (see SectionedReport)."""
+    return SectionedReport(section_generator(endpoint, context)).deltas()
+
+async def repaired_report(endpoint, result_content: str, context):
+    """The completion with its missing, invalid or cut-off sections regenerated one by one.
+
+    Returns the completion unchanged when it is clean (or repair is off), else the
+    merged report as JSON text. A follow-up call per broken section is much cheaper than
+    generating the whole report again.
+    """
+    with span("report.validate", chars=len(result_content)):
+        parsed_json, broken, repairs = analyze_report(result_content)
+    if not REPORT_REPAIR or not (broken or repairs):
+        return result_content
+    report = {key: parsed_json[key] for key in REPORT_KEYS if key not in broken} if parsed_json else {}
+    if broken:
+        unrepaired = await SectionedReport(section_generator(endpoint, context)).fill(report, broken)
+        for section in broken:
+            outcome = "failed" if section in unrepaired else "filled"
+            metrics.inc("report_section_repairs_total", section=section, outcome=outcome)
+        logger.info(f"Repaired report sections {[s for s in broken if s not in unrepaired]}, still missing {unrepaired}")
+    if not report:
+        return result_content
+    # Rewritten as clean JSON, so the syntax repairs are counted here and not again on every parse
+    for kind in repairs:
+        metrics.inc("report_repairs_total", kind=kind)
+    return json.dumps(report, ensure_ascii=False)
+
+async def cached_report_completion(endpoint, context):
+    async def generate():
+        if REPORT_SECTIONED:
+            return "".join([delta async for delta in sectioned_report_deltas(endpoint, context)])
+        completion = await llm.chat_completion(endpoint, session_id=context["session_id"], **report_llm_kwargs(context))
+        return await repaired_report(endpoint, completion.choices[0].message.content, context)
+
+    return await report_cache.get_or_create(report_cache_key(context), generate)
+
+async def prefetch_report_completion(history, session_id):
+    detach()
+    session = await sessions.get_async(session_id)
+    return await cached_report_completion("report_prefetch", report_context(history, session_id, session))
+
+# Report generation starts in the background as soon as a conversation finishes
+report_prefetcher = ReportPrefetcher(prefetch_report_completion)
+
+async def prefetched_deltas(history, context):
+    """Yield a prefetched or cached report as one delta, or stream it live if there is none."""
+    key = report_cache_key(context)
+    with span("report.prefetch"):
+        result_content = await report_prefetcher.take(history)
+    if result_content is None:
+        result_content = await report_cache.lookup(key)
+    if result_content is not None:
+        yield result_content
+        return
+    if REPORT_SECTIONED:
+        live = sectioned_report_deltas("report", context)
+    else:
+        live = llm.stream_completion("report", session_id=context["session_id"], **report_llm_kwargs(context))
+    deltas = []
+    async for delta in live:
+        deltas.append(delta)
+        yield delta
+    report_cache.put(key, "".join(deltas))
+
+def start_llm_kwargs(mode: str, session_id: Optional[str] = None):
+    # Pooled openings are made ahead of any session, so they always use the primary model
+    model = llm.router.choose("start", mode, session_id) if session_id else llm.router.primary("start", mode)
+    return {
+        "model": model,
+        "messages": assemble(start_history(), tail=mode_instruction(mode)),
+        "temperature": 0.7
+    }
+
+async def generate_opening(mode: str):
+    detach()
+    completion = await llm.chat_completion("start_pool", **start_llm_kwargs(mode))
+    return completion.choices[0].message.content
+
+def opening_fingerprint(mode: str):
+    llm_kwargs = start_llm_kwargs(mode)
+    return history_key(llm_kwargs["messages"]) + llm_kwargs["model"]
+
+# The opening turn is the same for every user of a mode, so it is pre-generated
+opening_pool = OpeningPool(generate_opening, opening_fingerprint)
+
+async def single_delta(text: str):
+    yield text
 
 @app.post("/assessment/start")
-def start_assessment(request: AssessmentStartRequest):
+async def start_assessment(request: AssessmentStartRequest, http_request: Request):
     logger.info(f"Starting new assessment session. Mode: {request.mode}")
+    check_client_limit("start", http_request)
+    session = new_session(start_history(), mode=request.mode)
+    tag_session(session["id"])
+    pooled = opening_pool.take(request.mode)
+    if pooled is not None:
+        if request.stream:
+            return stream_sse(
+                single_delta(pooled),
+                lambda reply: finish_start(session, reply, request.include_history),
+                session["id"]
+            )
+        return await finish_start(session, pooled, request.include_history)
+
+    # Pool empty: fall back to a live call
+    llm_kwargs = start_llm_kwargs(request.mode, session["id"])
+    if request.stream:
+        return stream_sse(
+            llm.stream_completion("start", session_id=session["id"], **llm_kwargs),
+            lambda reply: finish_start(session, reply, request.include_history),
+            session["id"]
+        )
     try:
-        current_prompt = BASE_SYSTEM_PROMPT
-        
-        if request.mode == "quick":
-            current_prompt += """
-            \n【重要指令变更】本次为极速体验模式。请将原定的 6-10 轮对话压缩为 **3 轮**。
-            
-            流程如下：
-            1. 你开场（询问第1个问题：童年/缺点）。
-            2. 用户回答 -> 你反馈并问第2个问题（无意识胜任/能量）。
-            3. 用户回答 -> 你反馈并问第3个问题（嫉妒/其他）。
-            4. 用户回答 -> 你反馈总结，并**必须**在回复结尾输出指令符 【DONE】。
-
-            注意：第3个问题之后，用户回答完，你就不要再问问题了！直接做总结并结束！
-            """
-        
-        # Initial call to get the first question
-        messages = [{'role': 'system', 'content': current_prompt}]
-        
-        messages.append({'role': 'user', 'content': "你好，我准备好开始探索我的天赋了。"})
+        completion = await llm.chat_completion("start", session_id=session["id"], **llm_kwargs)
 
-        completion = client.chat.completions.create(
-            model=os.getenv("ALIYUN_MODEL_NAME", "deepseek-v3"),
-            messages=messages,
-            temperature=0.7
-        )
-        
         reply = completion.choices[0].message.content
-        logger.info(f"Assessment Started. AI: {reply}")
-        
-        # Return the AI's reply and the history (including the AI's reply)
-        messages.append({'role': 'assistant', 'content': reply})
-        
-        return {
-            "message": reply,
-            "history": messages
-        }
+        log_content("Assessment started", reply, session["id"])
+
+        return await finish_start(session, reply, request.include_history)
     except Exception as e:
         logger.error(f"Start Assessment Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise upstream_error(e)
 
 @app.post("/assessment/chat")
-def assessment_chat(input: AssessmentChatRequest):
-    logger.info(f"Assessment chat. User: {input.user_message}")
+async def assessment_chat(input: AssessmentChatRequest, request: Request):
+    session = await load_session(input)
+    limiter.check("assessment", session_rate_key(request, input, session))
+    log_content("Assessment chat", input.user_message, session["id"])
+    legacy = input.history is not None
+    # Append user message to a copy, so a failed turn leaves the stored session untouched
+    messages = list(session["history"])
+    messages.append({'role': 'user', 'content': input.user_message})
+    with span("prompt.assemble", turns=len(messages)):
+        history_compactor.apply(session)
+        coverage = coverage_tracker.assess(messages, session["mode"])
+        tail = session_tail(messages, session["mode"], coverage_tracker.tail(coverage))
+        llm_kwargs = {
+            "model": llm.router.choose("chat", session["mode"], session["id"]),
+            "messages": assemble(history_compactor.compact(messages, session), tail=tail),
+            "temperature": 0.7
+        }
+    if input.stream:
+        return stream_sse(
+            llm.stream_completion("chat", session_id=session["id"], **llm_kwargs),
+            lambda reply: finish_chat_turn(session, messages, reply, legacy, input.history_version, coverage),
+            session["id"],
+            done_filter=DoneMarkerFilter()
+        )
     try:
-        # Append user message to history
-        messages = input.history
-        messages.append({'role': 'user', 'content': input.user_message})
+        completion = await llm.chat_completion("chat", session_id=session["id"], **llm_kwargs)
 
-        completion = client.chat.completions.create(
-            model=os.getenv("ALIYUN_MODEL_NAME", "deepseek-v3"),
-            messages=messages,
-            temperature=0.7
-        )
-        
         reply = completion.choices[0].message.content
-        # Remove [DONE] token from AI reply if present before sending to frontend
-        reply_to_user = reply.replace("【DONE】", "").strip()
-
-        messages.append({'role': 'assistant', 'content': reply})
-        
-        is_finished = "【DONE】" in reply
-        # Fallback check for long conversations
-        if len(messages) > 20: 
-             is_finished = True
-
-        return {
-            "message": reply_to_user,
-            "history": messages,
-            "is_finished": is_finished
-        }
+        return await finish_chat_turn(session, messages, reply, legacy, input.history_version, coverage)
     except Exception as e:
         logger.error(f"Assessment Chat Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise upstream_error(e)
 
 @app.post("/assessment/report")
-def generate_report(input: AssessmentChatRequest):
+async def generate_report(input: AssessmentChatRequest, request: Request):
     logger.info("Generating Report...")
-    try:
-        # Convert history to list of dicts to ensure compatibility
-        messages = [{"role": m.role, "content": m.content} for m in input.history]
-        
-        # Add a system instruction (as user message for stronger effect at the end) to force JSON format
-        messages.append({'role': 'user', 'content': """
-        【任务终止】请停止咨询对话。
-        【新任务】请根据上述对话历史，生成一份《天赋说明书》。
-        
-        【格式要求】
-        1. 必须输出标准的 JSON 格式。
-        2. 不要包含 markdown 代码块标记 (```json ... ```)。
-        3. 不要包含任何其他解释性文字。
-        
-        【JSON 结构模板】
-        {
-            "core_traits": ["天赋词1", "天赋词2", "天赋词3"],
-            "deep_analysis": "深度解析内容（至少800字），包含底层逻辑、生活映射、困惑解答。请使用 \\n 进行换行。",
-            "action_guide": "具体的行动建议和练习。",
-            "careers": [
-                {"title": "推荐职业1", "reason": "适配原因"},
-                {"title": "推荐职业2", "reason": "适配原因"},
-                {"title": "推荐职业3", "reason": "适配原因"},
-                {"title": "推荐职业4", "reason": "适配原因"},
-                {"title": "推荐职业5", "reason": "适配原因"}
-            ],
-            "not_suitable": "不适合从事的工作类型及原因（阴影面）。"
-        }
-        """})
-
-        completion = client.chat.completions.create(
-            model=os.getenv("ALIYUN_MODEL_NAME", "deepseek-v3"),
-            messages=messages,
-            temperature=0.1, # Low temp for deterministic formatting
-            response_format={ "type": "json_object" }
+    session = await load_session(input)
+    limiter.check("report", session_rate_key(request, input, session))
+    history = session["history"]
+    context = report_context(history, session["id"], session)
+    if input.stream:
+        return stream_sse(
+            prefetched_deltas(history, context),
+            lambda result_content: finish_report(result_content, history, session, context),
+            session["id"],
+            section_parser=ReportStreamParser()
         )
-        
-        result_content = completion.choices[0].message.content
-        logger.info(f"Report Generated: {result_content[:100]}...")
-        
-        # Robustly clean up Markdown code blocks
-        if "```json" in result_content:
-            result_content = result_content.split("```json")[1]
-            if "```" in result_content:
-                result_content = result_content.split("```")[0]
-        elif "```" in result_content:
-            result_content = result_content.split("```")[1]
-            if "```" in result_content:
-                result_content = result_content.split("```")[0]
-        
-        # Strip any leading/trailing whitespace
-        result_content = result_content.strip()
-        
-        try:
-            parsed_json = json.loads(result_content)
-            
-            # Map old keys to new keys if AI uses old format fallback
-            if "keywords" in parsed_json and "core_traits" not in parsed_json:
-                parsed_json["core_traits"] = parsed_json["keywords"]
-            if "analysis" in parsed_json and "deep_analysis" not in parsed_json:
-                parsed_json["deep_analysis"] = parsed_json["analysis"]
-            if "shadow_transformation" in parsed_json and "not_suitable" not in parsed_json:
-                parsed_json["not_suitable"] = parsed_json["shadow_transformation"]
-                
-            # Inject full chat history into the response
-            parsed_json["full_chat_history"] = [
-                {"role": m.role, "content": m.content} 
-                for m in input.history 
-                if m.role != "system" # Exclude system prompt from frontend view
-            ]
-            return parsed_json
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON Decode Error: {e}. Content: {result_content}")
-            # Try to fix common JSON errors or return error structure
-            return {
-                "core_traits": ["生成失败", "请重试", "格式错误"],
-                "deep_analysis": f"报告生成时出现格式错误。原始内容: {result_content[:500]}...",
-                "not_suitable": "请联系管理员查看日志。",
-                "action_guide": "刷新页面重试。",
-                "careers": [],
-                "full_chat_history": []
-            }
-
+    try:
+        with span("report.prefetch"):
+            result_content = await report_prefetcher.take(history)
+        if result_content is None:
+            result_content = await cached_report_completion("report", context)
+        log_content("Report generated", result_content, session["id"])
+
+        # Already repaired inside cached_report_completion
+        return build_report(result_content, history, session)
     except Exception as e:
         logger.error(f"Report Generation Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise upstream_error(e)
+
+async def generate_random_report_content(endpoint="random_report"):
+    messages = [{'role': 'system', 'content': RANDOM_REPORT_PROMPT}]
+
+    completion = await llm.chat_completion(
+        endpoint,
+        model=llm.router.choose(endpoint),
+        messages=messages,
+        temperature=0.8,
+        response_format={ "type": "json_object" }
+    )
+
+    result_content = completion.choices[0].message.content
+    log_content("Random report generated", result_content)
+    return parse_report(result_content)
+
+async def generate_banked_random_report():
+    detach()
+    return await generate_random_report_content("random_report_pool")
+
+# Random reports are pre-generated in the background and served from a bank
+random_report_bank = ReportBank(generate_banked_random_report)
+# Every served report, indexed by trait and career for the /archive queries (REPORT_ARCHIVE)
+report_archive = ReportArchive()
 
 @app.post("/assessment/random_report")
-def generate_random_report():
+async def generate_random_report(request: Request):
     logger.info("Generating Random Report...")
-    try:
-        messages = [{'role': 'system', 'content': """
-        You are an expert Talent Analyst.
-        Generate a comprehensive "Talent Instruction Manual" for a FICTIONAL user.
-        Create a persona (e.g., a creative writer who thinks they are lazy, or a logical engineer who loves painting).
-        Based on this fictional persona, generate a full report in strict JSON format.
-        
-        The JSON MUST include:
-        {
-            "core_traits": ["Trait1", "Trait2", "Trait3"],
-            "deep_analysis": ">=1000 words analysis of their talent, underlying logic, and potential",
-            "action_guide": "Actionable advice and steps",
-            "careers": [
-                {"title": "Career 1", "reason": "Reason 1"},
-                {"title": "Career 2", "reason": "Reason 2"},
-                {"title": "Career 3", "reason": "Reason 3"},
-                {"title": "Career 4", "reason": "Reason 4"},
-                {"title": "Career 5", "reason": "Reason 5"}
-            ],
-            "not_suitable": "What they should avoid and why (Shadow Integration)"
-        }
-        Ensure content is rich, professional, and empathetic. Language: Simplified Chinese.
-        """}]
-        
-        completion = client.chat.completions.create(
-            model=os.getenv("ALIYUN_MODEL_NAME", "deepseek-v3.2"),
-            messages=messages,
-            temperature=0.8,
-            response_format={ "type": "json_object" }
-        )
-        
-        result_content = completion.choices[0].message.content
-        logger.info(f"Random Report Generated: {result_content[:100]}...")
-        
-        if result_content.startswith("```json"):
-            result_content = result_content.replace("```json", "").replace("```", "")
-        
-        result_content = result_content.strip()
-        
+    check_client_limit("random", request)
+    client_id = request.headers.get("X-Client-Id") or client_ip(request)
+    parsed_json = await random_report_bank.take(client_id)
+    if parsed_json is None:
+        if not random_report_bank.live_fallback:
+            raise HTTPException(
+                status_code=503,
+                detail="No pre-generated report available yet. Please retry shortly.",
+                headers={"Retry-After": str(int(random_report_bank.refill_interval))}
+            )
         try:
-            parsed_json = json.loads(result_content)
-            # Add mock history for the view button
-            parsed_json["full_chat_history"] = [
-                {"role": "system", "content": "Random Report Generation Mode"},
-                {"role": "assistant", "content": "This is a randomly generated report for testing purposes."}
-            ]
-            return parsed_json
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON Decode Error: {e}. Content: {result_content}")
-            return {
-                "core_traits": ["Error", "Retry", "Connection"],
-                "deep_analysis": "Failed to generate random report.",
-                "not_suitable": "Please check logs.",
-                "action_guide": "Please retry.",
-                "careers": [],
-                "full_chat_history": []
-            }
-
-    except Exception as e:
-        logger.error(f"Random Report Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+            parsed_json = await generate_random_report_content()
+        except Exception as e:
+            logger.error(f"Random Report Error: {e}")
+            raise upstream_error(e)
+
+    metrics.inc("reports_built_total", kind="random")
+    if parsed_json is None:
+        metrics.inc("report_fallbacks_total", kind="random")
+        return {
+            "core_traits": ["Error", "Retry", "Connection"],
+            "deep_analysis": "Failed to generate random report.",
+            "not_suitable": "Please check logs.",
+            "action_guide": "Please retry.",
+            "careers": [],
+            "full_chat_history": []
+        }
+    report_archive.add(parsed_json, "random")
+    # Add mock history for the view button
+    parsed_json["full_chat_history"] = [
+        {"role": "system", "content": "Random Report Generation Mode"},
+        {"role": "assistant", "content": "This is a randomly generated report for testing purposes."}
+    ]
+    return parsed_json
 
 if __name__ == "__main__":
+    # Single process for development; serve.py runs the multi-process production setup
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,244 @@
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Upper bounds in seconds; LLM calls here range from ~0.3 s openings to 30 s+ reports
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+# Set by serve.py for multi-process serving: every worker publishes its metrics here and
+# /metrics and /stats add up all of them, so one scrape shows the whole server
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_PUBLISH_SECONDS = float(os.getenv("METRICS_PUBLISH_SECONDS", "2"))
+RETIRED_FILE = "retired.json"
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    inner = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f"{name}{{{inner}}}"
+
+
+def _with_label(key, label):
+    """Add one more label to an already formatted `name{...}` key."""
+    if key.endswith("}"):
+        return f"{key[:-1]},{label}}}"
+    return f"{key}{{{label}}}"
+
+
+def _split(key):
+    name, _, rest = key.partition("{")
+    return name, "{" + rest if rest else ""
+
+
+class Metrics:
+    """Tiny in-process counter/gauge/histogram registry shared by every backend module."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._histograms = {}  # key -> {"buckets", "counts", "sum", "count"}
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[_key(name, labels)] += value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def add_gauge(self, name, value, **labels):
+        with self._lock:
+            key = _key(name, labels)
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        with self._lock:
+            key = _key(name, labels)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    "buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0,
+                }
+            index = bisect.bisect_left(histogram["buckets"], value)
+            if index < len(histogram["counts"]):
+                histogram["counts"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "histograms": {
+                    key: {"count": h["count"], "sum": round(h["sum"], 6)} for key, h in self._histograms.items()
+                },
+            }
+
+    def state(self):
+        """Everything recorded, in a JSON-serialisable form that merge() accepts."""
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "histograms": {key: {**h, "buckets": list(h["buckets"]), "counts": list(h["counts"])}
+                               for key, h in self._histograms.items()},
+            }
+
+    def merge(self, state, gauges=True):
+        """Add another registry's state() to this one (gauges too, unless its process is gone)."""
+        with self._lock:
+            for key, value in state["counters"].items():
+                self._counters[key] += value
+            if gauges:
+                for key, value in state["gauges"].items():
+                    self._gauges[key] = self._gauges.get(key, 0) + value
+            for key, h in state["histograms"].items():
+                mine = self._histograms.get(key)
+                if mine is None:
+                    self._histograms[key] = {**h, "buckets": tuple(h["buckets"]), "counts": list(h["counts"])}
+                    continue
+                mine["counts"] = [a + b for a, b in zip(mine["counts"], h["counts"])]
+                mine["sum"] += h["sum"]
+                mine["count"] += h["count"]
+
+    def publish(self, directory=METRICS_DIR):
+        """Write this process's state() to `directory` for collect() in the other workers."""
+        path = os.path.join(directory, f"worker-{os.getpid()}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.state(), f)
+        os.replace(path + ".tmp", path)  # Readers never see a half-written file
+
+    def start_publishing(self, directory=METRICS_DIR, interval=METRICS_PUBLISH_SECONDS):
+        def loop():
+            while True:
+                try:
+                    self.publish(directory)
+                except OSError:
+                    pass  # Directory removed while the server shuts down
+                time.sleep(interval)
+
+        threading.Thread(target=loop, name="metrics-publisher", daemon=True).start()
+
+    def collect(self, directory=METRICS_DIR):
+        """This process's metrics plus every other worker's, or just this process's outside serve.py."""
+        if not directory:
+            return self
+        combined = Metrics()
+        own = f"worker-{os.getpid()}.json"
+        workers = 1
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            name = os.path.basename(path)
+            if name == own:
+                continue
+            try:
+                with open(path, encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue  # Retired between the listing and the read
+            # Workers that have exited keep their counts but no longer hold any gauge level
+            combined.merge(state, gauges=name != RETIRED_FILE)
+            workers += name != RETIRED_FILE
+        combined.merge(self.state())
+        combined.set_gauge("metrics_workers_reporting", workers)
+        return combined
+
+    def render(self):
+        """Everything in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {key: {**h, "counts": list(h["counts"])} for key, h in self._histograms.items()}
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for key in sorted(counters):
+            declare(_split(key)[0], "counter")
+            lines.append(f"{key} {counters[key]:g}")
+        for key in sorted(gauges):
+            declare(_split(key)[0], "gauge")
+            lines.append(f"{key} {gauges[key]:g}")
+        for key in sorted(histograms):
+            name, labels = _split(key)
+            declare(name, "histogram")
+            h = histograms[key]
+            cumulative = 0
+            bucket = name + "_bucket" + labels
+            for bound, count in zip(h["buckets"], h["counts"]):
+                cumulative += count
+                lines.append(_with_label(bucket, 'le="%g"' % bound) + f" {cumulative}")
+            lines.append(_with_label(bucket, 'le="+Inf"') + f" {h['count']}")
+            lines.append(f"{name}_sum{labels} {h['sum']:g}")
+            lines.append(f"{name}_count{labels} {h['count']}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def retire_worker(pid, directory=METRICS_DIR):
+    """Fold an exited worker's last published metrics into the retired totals."""
+    path = os.path.join(directory, f"worker-{pid}.json")
+    try:
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return
+    retired = Metrics()
+    retired_path = os.path.join(directory, RETIRED_FILE)
+    if os.path.exists(retired_path):
+        with open(retired_path, encoding="utf-8") as f:
+            retired.merge(json.load(f))
+    retired.merge(state, gauges=False)
+    with open(retired_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(retired.state(), f)
+    os.replace(retired_path + ".tmp", retired_path)
+    os.remove(path)
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware timing every HTTP request until its last body chunk is sent.
+
+    Requests are labelled with the route template (`/usage/{session_id}`), not the raw
+    path, so label cardinality stays bounded. Streamed responses count until the stream ends.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        metrics.add_gauge("http_requests_in_flight", 1)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            metrics.add_gauge("http_requests_in_flight", -1)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            if scope.get("client_disconnected"):
+                status = 499  # Client closed the request before the response was complete
+            labels = {"method": scope["method"], "route": route, "status": status}
+            metrics.inc("http_requests_total", **labels)
+            metrics.observe("http_request_seconds", time.perf_counter() - started, method=scope["method"], route=route)
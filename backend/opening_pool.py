@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+OPENING_POOL_DEPTH = int(os.getenv("OPENING_POOL_DEPTH", "3"))
+OPENING_POOL_REFILL_CONCURRENCY = int(os.getenv("OPENING_POOL_REFILL_CONCURRENCY", "2"))
+OPENING_POOL_MAX_AGE = int(os.getenv("OPENING_POOL_MAX_AGE", "3600"))
+# Fill every mode at startup. Off by default: every cold start and serve.py worker would
+# pay for openings before any traffic; the first start of a mode fills its pool instead
+OPENING_POOL_WARM_START = os.getenv("OPENING_POOL_WARM_START", "0") == "1"
+
+
+class OpeningPool:
+    """Keeps a few pre-generated opening messages per mode, refilled in the background.
+
+    A mode's pool is filled by its first take() (that request still generates live),
+    then topped up after every take. Every entry is tagged with a fingerprint of the prompt it was generated from; when
+    the prompt (or model) changes, or an entry is older than `max_age`, it is dropped
+    instead of served.
+    """
+
+    def __init__(self, generate, fingerprint, modes=("normal", "quick"), depth=OPENING_POOL_DEPTH,
+                 concurrency=OPENING_POOL_REFILL_CONCURRENCY, max_age=OPENING_POOL_MAX_AGE):
+        self.generate = generate  # async (mode) -> opening text
+        self.fingerprint = fingerprint  # (mode) -> str
+        self.depth = depth
+        self.max_age = max_age
+        self.concurrency = concurrency
+        self._pools = {mode: deque() for mode in modes}
+        self._refilling = {mode: 0 for mode in modes}
+        self._sem = None
+        self._tasks = set()
+        self._hits = 0
+        self._misses = 0
+        self._refills = 0
+        self._refill_seconds = 0.0
+
+    def take(self, mode):
+        """Pop a fresh opening for this mode, or None when the caller must generate live."""
+        pool = self._pools.get(mode)
+        if pool is None or self.depth <= 0:
+            return None
+        self._drop_stale(mode)
+        reply = pool.popleft()[2] if pool else None
+        if reply is None:
+            self._misses += 1
+            metrics.inc("opening_pool_total", outcome="miss", mode=mode)
+        else:
+            self._hits += 1
+            metrics.inc("opening_pool_total", outcome="hit", mode=mode)
+        self._publish(mode)
+        self.refill(mode)
+        return reply
+
+    def refill(self, mode=None):
+        """Top up one mode (or all of them) to `depth`; safe to call from any request."""
+        if self.depth <= 0:
+            return
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+        for m in ([mode] if mode else list(self._pools)):
+            self._drop_stale(m)
+            missing = self.depth - len(self._pools[m]) - self._refilling[m]
+            for _ in range(max(missing, 0)):
+                self._refilling[m] += 1
+                task = asyncio.get_running_loop().create_task(self._refill_one(m))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _refill_one(self, mode):
+        try:
+            async with self._sem:
+                fingerprint = self.fingerprint(mode)
+                started = time.perf_counter()
+                reply = await self.generate(mode)
+                elapsed = time.perf_counter() - started
+                self._refills += 1
+                self._refill_seconds += elapsed
+                metrics.inc("opening_pool_refill_seconds_total", elapsed, mode=mode)
+                metrics.inc("opening_pool_refills_total", mode=mode)
+                self._pools[mode].append((fingerprint, time.time(), reply))
+                self._publish(mode)
+        except Exception as e:
+            metrics.inc("opening_pool_refill_errors_total", mode=mode)
+            logger.warning(f"Opening pool refill failed ({mode}): {e}")
+        finally:
+            self._refilling[mode] -= 1
+
+    def _drop_stale(self, mode):
+        pool = self._pools[mode]
+        current = self.fingerprint(mode)
+        cutoff = time.time() - self.max_age
+        fresh = [entry for entry in pool if entry[0] == current and entry[1] >= cutoff]
+        if len(fresh) != len(pool):
+            metrics.inc("opening_pool_stale_total", len(pool) - len(fresh), mode=mode)
+            pool.clear()
+            pool.extend(fresh)
+
+    def _publish(self, mode):
+        metrics.set_gauge("opening_pool_size", len(self._pools[mode]), mode=mode)
+
+    def stats(self):
+        total = self._hits + self._misses
+        return {
+            "depth": self.depth,
+            "sizes": {mode: len(pool) for mode, pool in self._pools.items()},
+            "refilling": dict(self._refilling),
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": round(self._hits / total, 3) if total else 0.0,
+            "avg_refill_seconds": round(self._refill_seconds / self._refills, 3) if self._refills else None,
+        }
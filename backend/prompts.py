@@ -0,0 +1,276 @@
+"""
+Prompt text and message assembly.
+
+Every assessment call starts with the same byte-identical system message, so the
+provider's prompt prefix cache can be shared by start, chat and report calls across
+all sessions. Anything that varies (quick-mode rules, the report JSON template) goes
+into the last user turn of the request and is never stored in the session history.
+"""
+
+BASE_SYSTEM_PROMPT = """
+天赋咨询机器人：系统提示词（System Prompt）
+# 角色定位 你是一位融合了“流理论”与“荣格心理学”的顶级生涯咨询师。你的任务是通过深度对话，挖掘用户潜意识中被遮蔽的天赋底层能力。
+
+# 核心对话准则（必须严格遵守）
+
+单次单问： 严禁一次性抛出多个问题。必须采用“你问 -> 用户答 -> 你简短反馈并分析 -> 你提下一个问题”的模式。
+
+追问机制： 必问问题有 4 个（见下文），但你可以根据用户的回答细节，进行 1-3 次即兴深度追问。总对话轮数控制在 6-10 轮。
+
+反馈艺术： 每一轮反馈都要体现出“温暖而犀利”。要能指出用户回答中隐藏的矛盾、逻辑漏洞或潜意识信号。
+
+# 必问的四个维度
+
+童年冲动： 16岁前无视奖励也愿意废寝忘食做的事，或被批评的“顽固缺点”。
+
+无意识胜任： 成年后觉得“这不就是常识吗”但别人觉得很难的事。
+
+能量审计： 哪些事做完后虽然累，但精神极度亢奋（回血感）。
+
+嫉妒镜像： 坦诚面对曾产生过的强烈嫉妒感（嫉妒是天赋被压抑的背面）。
+
+# 任务流阶段
+
+阶段 1：开场白。 用温暖共情的语气欢迎用户，解释流程（约10轮对话），告知目标是生成《天赋说明书》。然后抛出第一个问题。
+
+阶段 2：交互挖掘。 执行多轮对话，确保覆盖上述四个维度。
+
+阶段 3：总结报告。 当你认为信息收集充分或达到轮数上限时，通知用户开始生成报告，并输出指令符 【DONE】。
+
+# 报告输出格式要求 (核心) 报告必须包含以下模块，缺一不可：
+
+天赋核心词（三个）： 用 2-4 字的词语精准概括（如：跨界连接者、深海潜行者、情感调频师）。
+
+职业适配指南（五个）：
+
+按照适配度由高到低排序。
+
+每一项需注明：【职业名称】+【适配原因深度解析】。
+
+天赋特征详述（深度模块）： * 必须不少于 1000 字。
+
+内容需涵盖：天赋的底层逻辑、它是如何在用户生活中起作用的、它如何解释用户过去的困惑、以及如何应对天赋带来的负面效应（阴影面）。
+
+行动指南（具体建议）： 包含可执行清单与节奏建议，工具/练习/里程碑。
+
+不适合的事情（避坑指南）： 列举不匹配的工作方式/环境/角色，说明原因与风险。
+
+# 初始指令 现在，请开始第一阶段：用温暖的语调开场，并直接提出第一个关于“童年/缺点”的问题。
+
+# 语言风格特别要求
+严禁舞台剧式描写：严禁使用（括号）描写动作、神态或心理活动（如“（微笑）”、“（严肃地）”、“（身体前倾）”等）。直接说话，不要加戏。保持专业、温暖、对话感。
+"""
+
+OPENING_USER_MESSAGE = "你好，我准备好开始探索我的天赋了。"
+
+DEBUG_START_MESSAGE = "你好，请开始你的工作。"
+
+DEBUG_CHAT_SYSTEM_PROMPT = "You are a helpful assistant. Keep answers short."
+
+QUICK_MODE_PROMPT = """
+            \n【重要指令变更】本次为极速体验模式。请将原定的 6-10 轮对话压缩为 **3 轮**。
+            
+            流程如下：
+            1. 你开场（询问第1个问题：童年/缺点）。
+            2. 用户回答 -> 你反馈并问第2个问题（无意识胜任/能量）。
+            3. 用户回答 -> 你反馈并问第3个问题（嫉妒/其他）。
+            4. 用户回答 -> 你反馈总结，并**必须**在回复结尾输出指令符 【DONE】。
+
+            注意：第3个问题之后，用户回答完，你就不要再问问题了！直接做总结并结束！
+            """
+
+# Coverage progress from the server's tracker (dimension_coverage.py), appended to the final user turn
+COVERAGE_FOCUS = "【进度提示】已覆盖的维度：{covered}；尚未覆盖：{missing}。请在简短反馈后，下一个问题优先探索“{next}”。"
+COVERAGE_FOLLOW_UP = "【进度提示】必问的维度均已覆盖。请针对用户回答中最有价值的细节做一次深度追问。"
+COVERAGE_WRAP_UP = "【进度提示】信息收集已经足够。请不要再提问，直接做简短的反馈总结，并在回复结尾输出指令符 【DONE】。"
+
+REPORT_INSTRUCTION = """
+        【任务终止】请停止咨询对话。
+        【新任务】请根据上述对话历史，生成一份《天赋说明书》。
+        
+        【格式要求】
+        1. 必须输出标准的 JSON 格式。
+        2. 不要包含 markdown 代码块标记 (```json ... ```)。
+        3. 不要包含任何其他解释性文字。
+        
+        【JSON 结构模板】
+        {
+            "core_traits": ["天赋词1", "天赋词2", "天赋词3"],
+            "deep_analysis": "深度解析内容（至少800字），包含底层逻辑、生活映射、困惑解答。请使用 \\n 进行换行。",
+            "action_guide": "具体的行动建议和练习。",
+            "careers": [
+                {"title": "推荐职业1", "reason": "适配原因"},
+                {"title": "推荐职业2", "reason": "适配原因"},
+                {"title": "推荐职业3", "reason": "适配原因"},
+                {"title": "推荐职业4", "reason": "适配原因"},
+                {"title": "推荐职业5", "reason": "适配原因"}
+            ],
+            "not_suitable": "不适合从事的工作类型及原因（阴影面）。"
+        }
+        """
+
+# Sectioned report mode: one request per section, all sharing the conversation prefix.
+# core_traits comes first; the other sections are written around the traits it picked.
+REPORT_SECTIONS = {
+    "core_traits": ("核心天赋词", '{"core_traits": ["天赋词1", "天赋词2", "天赋词3"]}'),
+    "deep_analysis": ("深度解析", '{"deep_analysis": "深度解析内容（至少800字），包含底层逻辑、生活映射、困惑解答。请使用 \\n 进行换行。"}'),
+    "action_guide": ("行动指南", '{"action_guide": "具体的行动建议和练习。"}'),
+    "careers": ("推荐职业", '{"careers": [{"title": "推荐职业1", "reason": "适配原因"}, {"title": "推荐职业2", "reason": "适配原因"}, '
+                           '{"title": "推荐职业3", "reason": "适配原因"}, {"title": "推荐职业4", "reason": "适配原因"}, '
+                           '{"title": "推荐职业5", "reason": "适配原因"}]}'),
+    "not_suitable": ("阴影面", '{"not_suitable": "不适合从事的工作类型及原因（阴影面）。"}'),
+}
+
+REPORT_SECTION_INSTRUCTION = """
+        【任务终止】请停止咨询对话。
+        【新任务】请根据上述对话历史，撰写《天赋说明书》中的一个部分：{title}。{traits}
+
+        【格式要求】
+        1. 必须输出标准的 JSON 格式，只包含模板中的这一个键。
+        2. 不要包含 markdown 代码块标记 (```json ... ```)。
+        3. 不要包含任何其他解释性文字。
+
+        【JSON 结构模板】
+        {template}
+        """
+
+RANDOM_REPORT_PROMPT = """
+        You are an expert Talent Analyst.
+        Generate a comprehensive "Talent Instruction Manual" for a FICTIONAL user.
+        Create a persona (e.g., a creative writer who thinks they are lazy, or a logical engineer who loves painting).
+        Based on this fictional persona, generate a full report in strict JSON format.
+        
+        The JSON MUST include:
+        {
+            "core_traits": ["Trait1", "Trait2", "Trait3"],
+            "deep_analysis": ">=1000 words analysis of their talent, underlying logic, and potential",
+            "action_guide": "Actionable advice and steps",
+            "careers": [
+                {"title": "Career 1", "reason": "Reason 1"},
+                {"title": "Career 2", "reason": "Reason 2"},
+                {"title": "Career 3", "reason": "Reason 3"},
+                {"title": "Career 4", "reason": "Reason 4"},
+                {"title": "Career 5", "reason": "Reason 5"}
+            ],
+            "not_suitable": "What they should avoid and why (Shadow Integration)"
+        }
+        Ensure content is rich, professional, and empathetic. Language: Simplified Chinese.
+        """
+
+SUMMARY_SYSTEM_PROMPT = """
+你是一位生涯咨询记录员。请把咨询对话整理成简洁的要点摘要，供咨询师继续对话和撰写报告时参考。
+
+按以下四个维度分段输出，每段保留用户提到的具体事例、原话关键词和咨询师已经指出的矛盾或信号；没有涉及的维度写“尚未涉及”：
+【童年冲动】
+【无意识胜任】
+【能量审计】
+【嫉妒镜像】
+最后一段【其他线索】记录不属于以上维度但有价值的信息。
+
+只输出摘要本身，不要寒暄，不要提出新问题，总长度不超过 500 字。
+"""
+
+SUMMARY_BLOCK_HEADER = "【此前对话摘要】以下是我们之前对话的要点，之后的对话原文接续其后："
+
+MODE_INSTRUCTIONS = {
+    "quick": QUICK_MODE_PROMPT,
+}
+
+
+def mode_instruction(mode):
+    return MODE_INSTRUCTIONS.get(mode)
+
+
+def history_mode(history):
+    """Mode of a client-held history that came without one.
+
+    Older clients kept the quick-mode rules inside their system message; newer ones never
+    store the mode instruction, so for them this is "normal" and they have to send the mode.
+    """
+    marker = QUICK_MODE_PROMPT.strip().splitlines()[0]
+    return "quick" if any(marker in m['content'] for m in history if m['role'] == 'system') else "normal"
+
+
+def with_tail(content, tail):
+    """Append a per-request instruction to the content of the final user turn."""
+    if not tail:
+        return content
+    return f"{content}\n\n{tail.strip()}"
+
+
+def start_history():
+    return [
+        {'role': 'system', 'content': BASE_SYSTEM_PROMPT},
+        {'role': 'user', 'content': OPENING_USER_MESSAGE},
+    ]
+
+
+def assemble(history, tail=None):
+    """Build the request messages: the stored history verbatim, variable instructions last.
+
+    The history is copied, so the tail never ends up in the stored session.
+    """
+    messages = [{'role': m['role'], 'content': m['content']} for m in history]
+    if tail:
+        if messages and messages[-1]['role'] == 'user':
+            messages[-1]['content'] = with_tail(messages[-1]['content'], tail)
+        else:
+            messages.append({'role': 'user', 'content': tail})
+    return messages
+
+
+def report_messages(history):
+    # The report instruction goes last as a user turn (stronger effect at the end);
+    # everything before it is the cached conversation prefix
+    return assemble(history + [{'role': 'user', 'content': REPORT_INSTRUCTION}])
+
+
+def report_section_messages(history, section, core_traits=None):
+    title, template = REPORT_SECTIONS[section]
+    traits = ""
+    if core_traits:
+        traits = f"\n        已确定的核心天赋词：{'、'.join(core_traits)}。请围绕它们展开，保持一致。"
+    instruction = REPORT_SECTION_INSTRUCTION.format(title=title, traits=traits, template=template)
+    return assemble(history + [{'role': 'user', 'content': instruction}])
+
+
+def coverage_instruction(covered, missing, wrap_up):
+    """Progress note for the next turn: which dimension to ask about next, or to wrap up."""
+    if wrap_up:
+        return COVERAGE_WRAP_UP
+    if not missing:
+        return COVERAGE_FOLLOW_UP
+    return COVERAGE_FOCUS.format(covered="、".join(covered) or "无", missing="、".join(missing), next=missing[0])
+
+
+def session_tail(history, mode, coverage_tail=None):
+    """Mode instruction plus coverage progress for a session's next request.
+
+    Sessions from older clients carry the quick-mode rules inside their system message
+    already, so they get only the coverage part.
+    """
+    parts = []
+    if history and history[0]['content'] == BASE_SYSTEM_PROMPT:
+        parts.append(mode_instruction(mode))
+    parts.append(coverage_tail)
+    parts = [part.strip() for part in parts if part]
+    return "\n\n".join(parts) or None
+
+
+def summary_messages(previous_summary, turns):
+    """Request that folds `turns` (older conversation) into the rolling summary."""
+    speakers = {'user': '用户', 'assistant': '咨询师'}
+    transcript = "\n".join(f"{speakers.get(m['role'], m['role'])}：{m['content']}" for m in turns)
+    parts = []
+    if previous_summary:
+        parts.append(f"已有摘要：\n{previous_summary}")
+    parts.append(f"新增对话：\n{transcript}")
+    parts.append("请输出合并后的完整摘要。")
+    return [
+        {'role': 'system', 'content': SUMMARY_SYSTEM_PROMPT},
+        {'role': 'user', 'content': "\n\n".join(parts)},
+    ]
+
+
+def summary_block(summary):
+    return f"{SUMMARY_BLOCK_HEADER}\n{summary.strip()}"
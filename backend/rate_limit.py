@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT = os.getenv("RATE_LIMIT", "1") == "1"
+RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH", "/tmp/talent_rate_limit.db")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "50000"))
+
+# Endpoint class -> (tokens refilled per second, bucket size) per client. Assessment turns
+# and reports are counted per session (ids are only handed out by the limited start), so
+# users behind one NAT don't share a bucket. Start and random reports are counted per
+# device when the client sends X-Client-Id, and every IP also has a `*_ip` ceiling sized
+# for a school or office behind one address. Debug endpoints are per IP.
+DEFAULT_RATE_LIMITS = {
+    "assessment": (0.5, 10),  # An answer every couple of seconds, with room for retries
+    "report": (0.1, 5),
+    "start": (0.1, 10),
+    "start_ip": (1, 60),
+    "random": (0.1, 5),
+    "random_ip": (0.5, 30),
+    "debug": (0.1, 5),
+}
+# e.g. RATE_LIMITS='{"random": [0.01, 2]}'
+RATE_LIMITS = {**DEFAULT_RATE_LIMITS, **{k: tuple(v) for k, v in json.loads(os.getenv("RATE_LIMITS", "{}")).items()}}
+
+
+class RateLimited(Exception):
+    def __init__(self, endpoint_class, retry_after):
+        super().__init__(f"Too many {endpoint_class} requests; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class RateLimitBackend:
+    """Token buckets by key. take() spends one token, or returns the seconds until one is available."""
+
+    def take(self, key, rate, burst):
+        raise NotImplementedError
+
+
+def _refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """Per-process buckets; the least recently used keys are dropped past `max_keys`."""
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = _refill(tokens, updated, now, rate, burst)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SQLiteRateLimitBackend(RateLimitBackend):
+    """Buckets in a SQLite file, so every worker process on the machine shares the same limits."""
+
+    def __init__(self, path=RATE_LIMIT_DB_PATH):
+        self.path = path
+        self._connect()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_buckets_updated ON buckets(updated)")
+        self._writes = 0
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._connect)  # Fresh connection per forked worker
+
+    def _connect(self):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+
+    def take(self, key, rate, burst):
+        # Wall-clock time: monotonic clocks are not comparable between processes
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so read-modify-write is atomic across processes
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = _refill(*row, now, rate, burst) if row else burst
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now)
+                )
+                self._writes += 1
+                if self._writes % 1000 == 0:
+                    # A bucket idle this long is full again, so forgetting it changes nothing
+                    self._conn.execute("DELETE FROM buckets WHERE updated < ?", (now - 3600,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait
+
+
+def create_backend(kind=None):
+    kind = kind or os.getenv("RATE_LIMIT_BACKEND", "memory")
+    if kind == "sqlite":
+        logger.info(f"Using SQLite rate limit backend at {RATE_LIMIT_DB_PATH}")
+        return SQLiteRateLimitBackend()
+    return MemoryRateLimitBackend()
+
+
+class RateLimiter:
+    """Token-bucket limits per client (IP or session) for each endpoint class."""
+
+    def __init__(self, backend=None, limits=RATE_LIMITS, enabled=RATE_LIMIT):
+        self.backend = backend or create_backend()
+        self.limits = limits
+        self.enabled = enabled
+        self._rejected = {}
+
+    def check(self, endpoint_class, client_key):
+        """Spend a token from the client's bucket; raises RateLimited when it is empty."""
+        if not self.enabled or endpoint_class not in self.limits:
+            return
+        rate, burst = self.limits[endpoint_class]
+        wait = self.backend.take(f"{endpoint_class}:{client_key}", rate, burst)
+        if wait > 0:
+            self._rejected[endpoint_class] = self._rejected.get(endpoint_class, 0) + 1
+            metrics.inc("rate_limited_total", endpoint_class=endpoint_class)
+            raise RateLimited(endpoint_class, max(wait, 1))
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "limits": {name: {"rate": rate, "burst": burst} for name, (rate, burst) in self.limits.items()},
+            "rejected": dict(self._rejected),
+        }
@@ -0,0 +1,456 @@
+"""
+Append-only archive of generated reports, indexed for aggregate queries.
+
+    python report_archive.py import ../report_result.json reports.jsonl old_reports/
+    python report_archive.py traits --limit 20 --source assessment --days 7
+    python report_archive.py careers --trait 系统直觉
+    python report_archive.py find --trait 系统直觉 --career 产品经理
+    python report_archive.py show 42
+    python report_archive.py stats
+
+/assessment/report and /assessment/random_report add every report they serve, and the
+trait and career counts are exposed under /archive. Individual reports (find, show) are
+only reachable from this CLI: they are users' results, not public data. Each report is stored once, as compressed JSON
+keyed by a digest of its content, so repeated serves and re-imports don't double count.
+Traits and career titles are normalized into their own tables. Their per-label report
+counts are kept up to date on insert, so an unfiltered top-N query reads N rows however
+many reports there are. Filtered and co-occurrence queries go through
+(label, report) indexes.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+REPORT_ARCHIVE = os.getenv("REPORT_ARCHIVE", "1") == "1"
+# /tmp is per instance on Vercel (api/index.py) and is lost between cold starts, so the
+# archive there only covers what one instance served; point this at persistent storage
+REPORT_ARCHIVE_DB_PATH = os.getenv("REPORT_ARCHIVE_DB_PATH", "/tmp/talent_reports.db")
+REPORT_ARCHIVE_BATCH = 500  # Reports written per transaction
+LABEL_MAX_CHARS = 64
+LABEL_CACHE_MAX = 50000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL UNIQUE,
+    source TEXT NOT NULL,
+    mode TEXT,
+    session_id TEXT,
+    created REAL NOT NULL,
+    partial INTEGER NOT NULL DEFAULT 0,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_reports_created ON reports(created);
+CREATE INDEX IF NOT EXISTS idx_reports_source_created ON reports(source, created);
+CREATE INDEX IF NOT EXISTS idx_reports_session ON reports(session_id);
+CREATE TABLE IF NOT EXISTS traits (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    reports INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_traits_reports ON traits(reports);
+CREATE TABLE IF NOT EXISTS report_traits (
+    trait_id INTEGER NOT NULL,
+    report_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (trait_id, report_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_report_traits_report ON report_traits(report_id);
+CREATE TABLE IF NOT EXISTS careers (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL UNIQUE,
+    reports INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_careers_reports ON careers(reports);
+CREATE TABLE IF NOT EXISTS report_careers (
+    career_id INTEGER NOT NULL,
+    report_id INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    PRIMARY KEY (career_id, report_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_report_careers_report ON report_careers(report_id);
+CREATE TABLE IF NOT EXISTS trait_days (
+    day INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    trait_id INTEGER NOT NULL,
+    reports INTEGER NOT NULL,
+    PRIMARY KEY (day, source, trait_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS career_days (
+    day INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    career_id INTEGER NOT NULL,
+    reports INTEGER NOT NULL,
+    PRIMARY KEY (day, source, career_id)
+) WITHOUT ROWID;
+"""
+
+# (label table, label column, link table, link key, link order column, daily rollup table)
+TRAITS = ("traits", "name", "report_traits", "trait_id", "position", "trait_days")
+CAREERS = ("careers", "title", "report_careers", "career_id", "rank", "career_days")
+
+# Wrappers models put around labels: 【职业名称】, 「词」, quotes
+LABEL_STRIP = " \t\r\n【】[]「」『』《》“”‘’\"'`*·.。,，、:："
+
+
+def normalize_label(text):
+    """Canonical form of a trait or career title, so spelling variants count as one label."""
+    text = unicodedata.normalize("NFKC", str(text))
+    text = " ".join(text.split()).strip(LABEL_STRIP)
+    return text[:LABEL_MAX_CHARS]
+
+
+def report_digest(report):
+    """Content key: the report's own sections, without the transcript or salvage flags."""
+    content = {key: value for key, value in report.items() if key not in ("full_chat_history", "partial", "missing_sections")}
+    payload = json.dumps(content, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _labels(report):
+    traits = [normalize_label(t) for t in report.get("core_traits") or [] if isinstance(t, str)]
+    careers = []
+    for career in report.get("careers") or []:
+        title = career.get("title") if isinstance(career, dict) else career
+        if isinstance(title, str):
+            careers.append(normalize_label(title))
+    return [t for t in traits if t], [c for c in careers if c]
+
+
+class ReportArchive:
+    """SQLite archive of reports with normalized trait and career tables.
+
+    add() only queues the report; a writer thread stores queued reports in batches, so
+    the request that served the report never waits on the disk. Imports and queries run
+    on the caller's thread. Every worker process writes to the same file.
+    """
+
+    def __init__(self, path=REPORT_ARCHIVE_DB_PATH, enabled=REPORT_ARCHIVE):
+        self.path = path
+        self.enabled = enabled
+        self._conn = None
+        self._lock = threading.Lock()
+        self._label_ids = {}  # (table, label) -> id, so inserts skip the lookup
+        self._queue = queue.Queue()
+        self._writer = None
+        self._written = 0
+        self._duplicates = 0
+        self._failed = 0
+        if hasattr(os, "register_at_fork"):
+            # Connection and writer thread belong to one process; forked workers open their own
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._conn = None
+        self._queue = queue.Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # Called with the lock held
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def add(self, report, source, session_id=None, mode=None):
+        """Queue a served report for archiving; never blocks or raises."""
+        if not self.enabled or not isinstance(report, dict):
+            return
+        # A copy without the conversation: callers go on to attach full_chat_history to the dict
+        report = {key: value for key, value in report.items() if key != "full_chat_history"}
+        self._queue.put((report, source, session_id, mode, time.time()))
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._write_loop, name="report-archive", daemon=True)
+            self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < REPORT_ARCHIVE_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.insert_many(batch)
+            except Exception as e:
+                self._failed += len(batch)
+                metrics.inc("report_archive_failures_total", len(batch))
+                logger.warning(f"Could not archive {len(batch)} reports: {e}")
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait until every queued report is written."""
+        if self._writer is not None:
+            self._queue.join()
+
+    def insert_many(self, items):
+        """Store (report, source, session_id, mode, created) tuples in one transaction.
+
+        Returns the number of reports that were new.
+        """
+        added = 0
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for report, source, session_id, mode, created in items:
+                    added += self._insert(conn, report, source, session_id, mode, created)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                self._label_ids.clear()  # Ids handed out in the rolled-back transaction
+                raise
+        self._written += added
+        self._duplicates += len(items) - added
+        metrics.inc("report_archive_written_total", added)
+        metrics.inc("report_archive_duplicates_total", len(items) - added)
+        return added
+
+    def _insert(self, conn, report, source, session_id, mode, created):
+        body = {key: value for key, value in report.items() if key != "full_chat_history"}
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO reports (digest, source, mode, session_id, created, partial, body) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (report_digest(report), source, mode, session_id, created, int(bool(report.get("partial"))),
+             zlib.compress(json.dumps(body, ensure_ascii=False).encode("utf-8"))),
+        )
+        if not cursor.rowcount:
+            return 0
+        report_id = cursor.lastrowid
+        day = int(created // 86400)
+        for spec, labels in zip((TRAITS, CAREERS), _labels(report)):
+            table, name, link, key, order, days = spec
+            for index, label in enumerate(labels):
+                label_id = self._label_ids.get((table, label))
+                if label_id is None:
+                    conn.execute(f"INSERT OR IGNORE INTO {table} ({name}) VALUES (?)", (label,))
+                    label_id = conn.execute(f"SELECT id FROM {table} WHERE {name} = ?", (label,)).fetchone()[0]
+                    if len(self._label_ids) >= LABEL_CACHE_MAX:
+                        self._label_ids.clear()
+                    self._label_ids[(table, label)] = label_id
+                linked = conn.execute(
+                    f"INSERT OR IGNORE INTO {link} ({key}, report_id, {order}) VALUES (?, ?, ?)",
+                    (label_id, report_id, index),
+                ).rowcount
+                if not linked:
+                    continue  # A label repeated within one report counts once
+                conn.execute(f"UPDATE {table} SET reports = reports + 1 WHERE id = ?", (label_id,))
+                conn.execute(
+                    f"INSERT INTO {days} (day, source, {key}, reports) VALUES (?, ?, ?, 1) "
+                    f"ON CONFLICT (day, source, {key}) DO UPDATE SET reports = reports + 1",
+                    (day, source, label_id),
+                )
+        return 1
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._connection().execute(sql, params).fetchall()
+
+    def _top(self, spec, limit, source, since):
+        table, name, _, key, _, days = spec
+        if not source and not since:
+            rows = self._query(f"SELECT {name}, reports FROM {table} ORDER BY reports DESC LIMIT ?", (limit,))
+        else:
+            # From the daily rollups: a few rows per label and day, however many reports
+            clauses, params = ["d.day >= ?"], [int(since // 86400) if since else 0]
+            if source:
+                clauses.append("d.source = ?")
+                params.append(source)
+            rows = self._query(
+                f"SELECT l.{name}, SUM(d.reports) AS n FROM {days} d JOIN {table} l ON l.id = d.{key} "
+                f"WHERE {' AND '.join(clauses)} GROUP BY d.{key} ORDER BY n DESC LIMIT ?",
+                (*params, limit),
+            )
+        return [{"label": label, "reports": count} for label, count in rows]
+
+    def top_traits(self, limit=20, source=None, since=None):
+        """Most frequent core traits, optionally for one source or since a time (whole UTC days)."""
+        return self._top(TRAITS, limit, source, since)
+
+    def top_careers(self, limit=20, source=None, since=None):
+        return self._top(CAREERS, limit, source, since)
+
+    def careers_for_trait(self, trait, limit=20, source=None, since=None):
+        """Careers most often recommended in reports that have `trait` among their core traits.
+
+        `source` and `since` filter the reports like top_careers does (whole UTC days).
+        """
+        clauses, params = ["t.name = ?"], [normalize_label(trait)]
+        join = ""
+        if source or since:
+            join = "JOIN reports r ON r.id = rt.report_id "
+            if source:
+                clauses.append("r.source = ?")
+                params.append(source)
+            if since:
+                clauses.append("r.created >= ?")
+                params.append(int(since // 86400) * 86400)
+        rows = self._query(
+            "SELECT c.title, COUNT(*) AS n FROM traits t "
+            "JOIN report_traits rt ON rt.trait_id = t.id "
+            f"{join}"
+            "JOIN report_careers rc ON rc.report_id = rt.report_id "
+            "JOIN careers c ON c.id = rc.career_id "
+            f"WHERE {' AND '.join(clauses)} GROUP BY rc.career_id ORDER BY n DESC LIMIT ?",
+            (*params, limit),
+        )
+        return [{"label": title, "reports": count} for title, count in rows]
+
+    def find(self, trait=None, career=None, limit=20):
+        """Newest reports with the given trait and/or career title: id, metadata and labels, no session ids."""
+        joins, params = [], []
+        if trait:
+            joins.append("JOIN report_traits ft ON ft.report_id = r.id "
+                         "AND ft.trait_id = (SELECT id FROM traits WHERE name = ?)")
+            params.append(normalize_label(trait))
+        if career:
+            joins.append("JOIN report_careers fc ON fc.report_id = r.id "
+                         "AND fc.career_id = (SELECT id FROM careers WHERE title = ?)")
+            params.append(normalize_label(career))
+        rows = self._query(
+            f"SELECT r.id, r.source, r.mode, r.created, r.partial FROM reports r {' '.join(joins)} "
+            "ORDER BY r.id DESC LIMIT ?",
+            (*params, limit),
+        )
+        results = []
+        for report_id, source, mode, created, partial in rows:
+            traits = self._query(
+                "SELECT t.name FROM report_traits rt JOIN traits t ON t.id = rt.trait_id "
+                "WHERE rt.report_id = ? ORDER BY rt.position", (report_id,))
+            careers = self._query(
+                "SELECT c.title FROM report_careers rc JOIN careers c ON c.id = rc.career_id "
+                "WHERE rc.report_id = ? ORDER BY rc.rank", (report_id,))
+            results.append({
+                "id": report_id, "source": source, "mode": mode, "created": created, "partial": bool(partial),
+                "core_traits": [name for (name,) in traits], "careers": [title for (title,) in careers],
+            })
+        return results
+
+    def get(self, report_id):
+        rows = self._query("SELECT body FROM reports WHERE id = ?", (report_id,))
+        return json.loads(zlib.decompress(rows[0][0])) if rows else None
+
+    def stats(self):
+        summary = {
+            "enabled": self.enabled,
+            "path": self.path,
+            "queued": self._queue.qsize(),
+            "written": self._written,
+            "duplicates": self._duplicates,
+            "failed": self._failed,
+        }
+        if self.enabled and os.path.exists(self.path):
+            (reports,), = self._query("SELECT COUNT(*) FROM reports")
+            (traits,), = self._query("SELECT COUNT(*) FROM traits")
+            (careers,), = self._query("SELECT COUNT(*) FROM careers")
+            summary.update(reports=reports, traits=traits, careers=careers, bytes=os.path.getsize(self.path))
+        return summary
+
+
+def read_reports(path):
+    """Yield (report, source, id, created) from a report JSON file, a JSONL file or a directory of them.
+
+    JSONL lines can be bare reports or batch_reports.py output records.
+    """
+    if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                if name.endswith((".json", ".jsonl")):
+                    yield from read_reports(os.path.join(root, name))
+        return
+    created = os.path.getmtime(path)
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            items = (json.loads(line) for line in f if line.strip())
+        else:
+            data = json.load(f)
+            items = data if isinstance(data, list) else [data]
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            if "report" in item:  # batch_reports.py record
+                if item.get("ok"):
+                    yield item["report"], "batch", item.get("id"), created
+            elif item.get("core_traits") is not None:
+                yield item, "import", None, created
+
+
+def import_files(archive, paths):
+    """Bulk import; returns (reports read, reports new to the archive)."""
+    read = added = 0
+    batch = []
+    for path in paths:
+        for report, source, item_id, created in read_reports(path):
+            batch.append((report, source, item_id, None, created))
+            read += 1
+            if len(batch) >= REPORT_ARCHIVE_BATCH * 4:
+                added += archive.insert_many(batch)
+                batch = []
+    if batch:
+        added += archive.insert_many(batch)
+    return read, added
+
+
+if __name__ == "__main__":
+    sys.stdout.reconfigure(encoding='utf-8')
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=REPORT_ARCHIVE_DB_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("import", help="Add report JSON/JSONL files or directories")
+    command.add_argument("paths", nargs="+")
+    for name in ("traits", "careers"):
+        command = commands.add_parser(name, help=f"Most frequent {name}")
+        command.add_argument("--limit", type=int, default=20)
+        command.add_argument("--source", help="assessment, random, batch or import")
+        command.add_argument("--days", type=float, help="Only reports from the last N days")
+        if name == "careers":
+            command.add_argument("--trait", help="Only reports with this core trait")
+    command = commands.add_parser("find", help="Newest reports with a trait and/or career")
+    command.add_argument("--trait")
+    command.add_argument("--career")
+    command.add_argument("--limit", type=int, default=20)
+    command = commands.add_parser("show", help="One archived report")
+    command.add_argument("id", type=int)
+    commands.add_parser("stats")
+    args = parser.parse_args()
+
+    archive = ReportArchive(args.db, enabled=True)
+    started = time.perf_counter()
+    if args.command == "import":
+        read, added = import_files(archive, args.paths)
+        result = {"read": read, "added": added, "duplicates": read - added}
+    elif args.command in ("traits", "careers"):
+        since = time.time() - args.days * 86400 if args.days else None
+        if getattr(args, "trait", None):
+            result = archive.careers_for_trait(args.trait, args.limit, args.source, since)
+        elif args.command == "traits":
+            result = archive.top_traits(args.limit, args.source, since)
+        else:
+            result = archive.top_careers(args.limit, args.source, since)
+    elif args.command == "find":
+        result = archive.find(args.trait, args.career, args.limit)
+    elif args.command == "show":
+        result = archive.get(args.id)
+    else:
+        result = archive.stats()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    print(f"({(time.perf_counter() - started) * 1000:.1f} ms)", file=sys.stderr)
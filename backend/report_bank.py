@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from metrics import metrics
+from report_parser import REPORT_KEYS
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single process, nothing to coordinate with
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+RANDOM_REPORT_BANK_SIZE = int(os.getenv("RANDOM_REPORT_BANK_SIZE", "20"))
+RANDOM_REPORT_BANK_PATH = os.getenv("RANDOM_REPORT_BANK_PATH", "")  # Empty: memory only; serve.py sets it for its workers
+RANDOM_REPORT_REFILL_INTERVAL = float(os.getenv("RANDOM_REPORT_REFILL_INTERVAL", "30"))
+RANDOM_REPORT_MAX_SERVES = int(os.getenv("RANDOM_REPORT_MAX_SERVES", "50"))
+RANDOM_REPORT_LIVE_FALLBACK = os.getenv("RANDOM_REPORT_LIVE_FALLBACK", "1") == "1"
+RANDOM_REPORT_MAX_CLIENTS = 10000
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """Exclusive flock on `path`; yields False when not blocking and another process holds it."""
+    f = open(path, "a")
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+        yield True
+    finally:
+        f.close()  # Releases the lock
+
+
+def is_valid_report(report):
+    """Only complete reports go into the bank; salvaged partial ones are served live only."""
+    if not isinstance(report, dict) or report.get("partial"):
+        return False
+    return all(report.get(key) for key in REPORT_KEYS)
+
+
+class ReportBank:
+    """Bounded bank of pre-generated random reports, filled by a rate-limited background worker.
+
+    Each client is served reports it has not seen yet. A report is retired after
+    `max_serves` serves, which makes room for the worker to add a fresh one. The worker
+    starts with the first take(), so a process that never serves a random report never
+    spends upstream calls on the bank.
+
+    With a `path`, the bank is kept in a JSONL file, so it survives restarts and is shared
+    by every process using the same file (serve.py's workers): each re-reads the file when
+    it changes, and only one of them generates at a time. Serve counts are per process.
+    File reads and writes run in the default executor, never on the event loop.
+    """
+
+    def __init__(self, generate, size=RANDOM_REPORT_BANK_SIZE, path=RANDOM_REPORT_BANK_PATH,
+                 refill_interval=RANDOM_REPORT_REFILL_INTERVAL, max_serves=RANDOM_REPORT_MAX_SERVES,
+                 live_fallback=RANDOM_REPORT_LIVE_FALLBACK):
+        self.generate = generate  # async () -> parsed report dict or None
+        self.size = size
+        self.path = path
+        self.refill_interval = refill_interval
+        self.max_serves = max_serves
+        self.live_fallback = live_fallback
+        self._lock = threading.Lock()
+        self._reports = OrderedDict()  # id -> {"report", "serves"}
+        self._seen = OrderedDict()  # client id -> set of report ids
+        self._worker = None
+        self._mtime = None  # Of the file when last read
+        self._hits = 0
+        self._misses = 0
+
+    async def take(self, client_id):
+        """Return a report this client hasn't seen, or None when the bank can't serve one."""
+        await self._file_io(self._sync)
+        self.ensure_worker()
+        with self._lock:
+            seen = self._seen.setdefault(client_id, set())
+            self._seen.move_to_end(client_id)
+            while len(self._seen) > RANDOM_REPORT_MAX_CLIENTS:
+                self._seen.popitem(last=False)
+            candidates = [rid for rid in self._reports if rid not in seen]
+            if not candidates:
+                self._misses += 1
+                metrics.inc("random_report_bank_total", outcome="miss")
+                return None
+            # Least-served first, so reports wear out evenly
+            report_id = min(candidates, key=lambda rid: self._reports[rid]["serves"])
+            entry = self._reports[report_id]
+            entry["serves"] += 1
+            seen.add(report_id)
+            retired = entry["serves"] >= self.max_serves
+            if retired:
+                del self._reports[report_id]
+            self._hits += 1
+            metrics.inc("random_report_bank_total", outcome="hit")
+            self._publish()
+        if retired:
+            await self._file_io(self._retire, report_id)
+        return json.loads(json.dumps(entry["report"]))
+
+    def ensure_worker(self):
+        if self.size <= 0:
+            return
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._fill())
+
+    async def _fill(self):
+        await self._file_io(self._sync)
+        while len(self._reports) < self.size:
+            with self._filling() as claimed:
+                await self._file_io(self._sync)
+                if claimed and len(self._reports) < self.size:
+                    await self._refill_one()
+            # Rate limit: the bank is a background nicety and must not eat the upstream quota
+            await asyncio.sleep(self.refill_interval)
+            await self._file_io(self._sync)
+
+    async def _file_io(self, method, *args):
+        # Memory-only banks have nothing to wait for
+        if self.path:
+            await asyncio.get_running_loop().run_in_executor(None, method, *args)
+        else:
+            method(*args)
+
+    @contextmanager
+    def _filling(self):
+        """Claim the right to generate; False while another process sharing the file does."""
+        if not self.path:
+            yield True
+            return
+        with file_lock(self.path + ".fill", blocking=False) as claimed:
+            yield claimed
+
+    async def _refill_one(self):
+        started = time.perf_counter()
+        try:
+            report = await self.generate()
+        except Exception as e:
+            logger.warning(f"Random report bank refill failed: {e}")
+            metrics.inc("random_report_bank_refills_total", outcome="error")
+            return
+        finally:
+            metrics.inc("random_report_bank_refill_seconds_total", time.perf_counter() - started)
+        if is_valid_report(report):
+            await self._file_io(self._add, report)
+            metrics.inc("random_report_bank_refills_total", outcome="added")
+        else:
+            metrics.inc("random_report_bank_refills_total", outcome="rejected")
+
+    def _add(self, report):
+        report_id = uuid.uuid4().hex
+        with self._lock:
+            self._reports[report_id] = {"report": report, "serves": 0}
+            self._publish()
+        if self.path:
+            with file_lock(self.path + ".lock"):
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"id": report_id, "report": report}, ensure_ascii=False) + "\n")
+
+    def _read(self):
+        items = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if is_valid_report(item.get("report")):
+                    items.append((item["id"], item["report"]))
+        return items
+
+    def _sync(self, force=False):
+        """Reload the bank from its file when another process (or a restart) changed it."""
+        if not self.path:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime and not force:
+            return
+        first = self._mtime is None
+        self._mtime = mtime
+        items = self._read()
+        with self._lock:
+            serves = {rid: entry["serves"] for rid, entry in self._reports.items()}
+            self._reports = OrderedDict((rid, {"report": report, "serves": serves.get(rid, 0)}) for rid, report in items)
+            while len(self._reports) > self.size:
+                self._reports.popitem(last=False)
+            self._publish()
+        if first:
+            logger.info(f"Loaded {len(self._reports)} random reports from {self.path}")
+
+    def _retire(self, report_id):
+        """Remove a worn-out report from the file, keeping what other processes added meanwhile."""
+        if not self.path:
+            return
+        with file_lock(self.path + ".lock"):
+            items = [(rid, report) for rid, report in self._read() if rid != report_id] if os.path.exists(self.path) else []
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps({"id": rid, "report": report}, ensure_ascii=False) + "\n" for rid, report in items)
+            os.replace(tmp_path, self.path)
+        self._sync(force=True)
+
+    def _publish(self):
+        metrics.set_gauge("random_report_bank_size", len(self._reports))
+
+    def stats(self):
+        total = self._hits + self._misses
+        return {
+            "size": len(self._reports),
+            "capacity": self.size,
+            "refill_interval": self.refill_interval,
+            "live_fallback": self.live_fallback,
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": round(self._hits / total, 3) if total else 0.0,
+        }
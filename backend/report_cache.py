@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import unicodedata
+from collections import OrderedDict
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+REPORT_CACHE = os.getenv("REPORT_CACHE", "1") == "1"
+REPORT_CACHE_TTL = int(os.getenv("REPORT_CACHE_TTL", "3600"))
+REPORT_CACHE_MAX = int(os.getenv("REPORT_CACHE_MAX", "1000"))
+REPORT_CACHE_DIR = os.getenv("REPORT_CACHE_DIR", "")  # Empty: memory only
+
+_CANCELLED = object()  # _wait's result when the shared call was cancelled before it finished
+
+
+def _normalize(text):
+    return unicodedata.normalize("NFC", text.replace("\r\n", "\n")).strip()
+
+
+def cache_key(llm_kwargs, variant=None):
+    """Hash of everything that determines a report: model, temperature, the exact prompt and how it is generated."""
+    fields = {
+        "model": llm_kwargs.get("model"),
+        "temperature": llm_kwargs.get("temperature"),
+        "response_format": llm_kwargs.get("response_format"),
+        "messages": [[m["role"], _normalize(m["content"])] for m in llm_kwargs["messages"]],
+    }
+    if variant:
+        fields["variant"] = variant
+    payload = json.dumps(fields, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ReportCache:
+    """Content-addressed cache of report completions with single-flight generation.
+
+    Entries live in an LRU memory tier for `ttl` seconds and, with a `directory`, in one
+    JSON file per key so they survive restarts and are shared between workers. Concurrent
+    requests for the same key wait on one upstream call; it is only cancelled once every
+    waiter has gone away. Completions rejected by `cacheable` are returned but not stored.
+    """
+
+    def __init__(self, cacheable, ttl=REPORT_CACHE_TTL, max_entries=REPORT_CACHE_MAX,
+                 directory=REPORT_CACHE_DIR, enabled=REPORT_CACHE):
+        self.cacheable = cacheable  # (content) -> bool
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.directory = directory
+        self.enabled = enabled
+        self._entries = OrderedDict()  # key -> (stored_at, content)
+        self._in_flight = {}  # key -> {"task", "waiters"}
+        self._counts = {"hit": 0, "disk_hit": 0, "miss": 0, "coalesced": 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        """Return a cached completion, or None."""
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry and time.time() - entry[0] < self.ttl:
+            self._entries.move_to_end(key)
+            self._count("hit")
+            return entry[1]
+        if entry:
+            del self._entries[key]
+        content = self._read_disk(key)
+        if content is not None:
+            self._count("disk_hit")
+        return content
+
+    async def lookup(self, key):
+        """Return a cached completion, waiting for an identical in-flight call; None if neither."""
+        content = self.get(key)
+        if content is not None:
+            return content
+        if not self._joinable(key):
+            self._count("miss")
+            return None
+        self._count("coalesced")
+        content = await self._wait(key)
+        return None if content is _CANCELLED else content
+
+    async def get_or_create(self, key, generate):
+        """Return the completion for `key`, calling `generate()` at most once at a time per key."""
+        if not self.enabled:
+            return await generate()
+        while True:
+            content = self.get(key)
+            if content is not None:
+                return content
+            if self._joinable(key):
+                self._count("coalesced")
+            else:
+                self._count("miss")
+                task = asyncio.get_running_loop().create_task(generate())
+                task.add_done_callback(lambda t: self._on_done(key, t))
+                self._in_flight[key] = {"task": task, "waiters": 0}
+            content = await self._wait(key)
+            if content is not _CANCELLED:
+                return content
+
+    def put(self, key, content):
+        if not self.enabled or not self.cacheable(content):
+            return
+        self._remember(key, time.time(), content)
+        self._write_disk(key, content)
+
+    def _remember(self, key, stored_at, content):
+        self._entries[key] = (stored_at, content)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        metrics.set_gauge("report_cache_entries", len(self._entries))
+
+    def _joinable(self, key):
+        """Whether an identical call is in flight; a cancelled one is dropped until its done-callback runs."""
+        flight = self._in_flight.get(key)
+        if flight is not None and flight["task"].cancelled():
+            del self._in_flight[key]
+            return False
+        return flight is not None
+
+    async def _wait(self, key):
+        flight = self._in_flight[key]
+        flight["waiters"] += 1
+        try:
+            return await asyncio.shield(flight["task"])
+        except asyncio.CancelledError:
+            if flight["task"].cancelled():
+                # The shared call was cancelled (its last waiter left as this one joined), not
+                # this caller: let it start a fresh one
+                if self._in_flight.get(key) is flight:
+                    del self._in_flight[key]
+                return _CANCELLED
+            # Last interested caller gone: stop paying for the upstream call
+            if flight["waiters"] == 1 and not flight["task"].done():
+                flight["task"].cancel()
+            raise
+        finally:
+            flight["waiters"] -= 1
+
+    def _on_done(self, key, task):
+        flight = self._in_flight.get(key)
+        if flight is not None and flight["task"] is task:
+            del self._in_flight[key]
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result())
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                item = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if time.time() - item["stored_at"] >= self.ttl:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            return None
+        self._remember(key, item["stored_at"], item["content"])
+        return item["content"]
+
+    def _write_disk(self, key, content):
+        if not self.directory:
+            return
+        tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"stored_at": time.time(), "content": content}, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning(f"Could not write report cache entry {key}: {e}")
+
+    def _count(self, outcome):
+        self._counts[outcome] += 1
+        metrics.inc("report_cache_total", outcome=outcome)
+
+    def stats(self):
+        hits = self._counts["hit"] + self._counts["disk_hit"] + self._counts["coalesced"]
+        total = hits + self._counts["miss"]
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "in_flight": len(self._in_flight),
+            "disk": bool(self.directory),
+            **self._counts,
+            "hit_rate": round(hits / total, 3) if total else 0.0,
+        }
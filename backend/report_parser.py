@@ -0,0 +1,290 @@
+import json
+import logging
+import re
+from typing import List, Optional
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+REPORT_KEYS = ["core_traits", "careers", "deep_analysis", "action_guide", "not_suitable"]
+LIST_KEYS = {"core_traits", "careers"}
+
+# Key names the model sometimes falls back to from the old prompt format
+LEGACY_KEYS = {
+    "keywords": "core_traits",
+    "analysis": "deep_analysis",
+    "shadow_transformation": "not_suitable",
+}
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class Career(BaseModel):
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    title: str = Field(min_length=1)
+    reason: str = ""
+
+
+class Report(BaseModel):
+    """Schema of the report sections. Absent sections stay None; present ones must be usable.
+
+    The before-validators coerce shapes the model often produces instead of the template
+    (traits as one string, careers as plain titles, text as a list of paragraphs), so
+    only content that is really wrong counts as invalid.
+    """
+    model_config = ConfigDict(str_strip_whitespace=True)
+
+    core_traits: Optional[List[str]] = Field(None, min_length=1)
+    deep_analysis: Optional[str] = Field(None, min_length=1)
+    action_guide: Optional[str] = Field(None, min_length=1)
+    careers: Optional[List[Career]] = Field(None, min_length=1)
+    not_suitable: Optional[str] = Field(None, min_length=1)
+
+    @field_validator("core_traits", mode="before")
+    @classmethod
+    def _split_traits(cls, value):
+        if isinstance(value, str):
+            return [trait for trait in re.split(r"[、,，;；/\n]", value) if trait.strip()]
+        return value
+
+    @field_validator("careers", mode="before")
+    @classmethod
+    def _career_objects(cls, value):
+        if isinstance(value, dict):
+            value = [value]
+        if isinstance(value, list):
+            return [
+                {"title": item} if isinstance(item, str)
+                else {**item, "title": item.get("title") or item.get("name")} if isinstance(item, dict)
+                else item
+                for item in value
+            ]
+        return value
+
+    @field_validator("deep_analysis", "action_guide", "not_suitable", mode="before")
+    @classmethod
+    def _join_paragraphs(cls, value):
+        if isinstance(value, list) and all(isinstance(item, str) for item in value):
+            return "\n".join(value)
+        return value
+
+
+class ReportStreamParser:
+    """Incremental parser for the report JSON object.
+
+    feed() consumes raw completion text and returns the top-level (key, value) members
+    that became complete in that chunk, so sections can be rendered as they arrive.
+    finish() returns everything that could be salvaged, including a repaired tail if
+    the completion was cut off.
+
+    Anything before the first "{" (a ```json fence, a stray sentence) and after the
+    closing "}" is ignored. Raw newlines inside strings, trailing commas and a missing
+    comma between members are tolerated. Each of these fixes is noted in `repairs`, and
+    the key of a member salvaged from a cut-off tail in `truncated_key`.
+    """
+
+    def __init__(self):
+        self.result = {}
+        self.truncated = False
+        self.truncated_key = None
+        self.repairs = set()
+        self.done = False
+        self._buf = ""
+        self._pos = 0
+        self._started = False
+        self._stack = []  # Open containers below the top-level object
+        self._in_string = False
+        self._escape = False
+        self._member_start = 0
+        self._seen_colon = False
+        self._value_done = False
+
+    def feed(self, chunk):
+        if self.done:
+            return []
+        self._buf += chunk
+        emitted = []
+        buf = self._buf
+        while self._pos < len(buf) and not self.done:
+            ch = buf[self._pos]
+            if not self._started:
+                if ch == "{":
+                    self._started = True
+                    self._member_start = self._pos + 1
+                    if buf[:self._pos].strip():
+                        self.repairs.add("preamble")
+            elif self._in_string:
+                if ch in "\n\r\t":
+                    self.repairs.add("raw_control_char")
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if not self._stack and self._seen_colon:
+                        self._value_done = True
+            elif ch == '"':
+                if not self._stack and self._value_done:
+                    # Missing comma: a new key starts right after a finished value
+                    self.repairs.add("missing_comma")
+                    emitted += self._close_member(self._pos)
+                self._in_string = True
+            elif ch in "{[":
+                self._stack.append(ch)
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                    if not self._stack and self._seen_colon:
+                        self._value_done = True
+                else:
+                    if self.result and not buf[self._member_start:self._pos].strip():
+                        self.repairs.add("trailing_comma")
+                    emitted += self._close_member(self._pos)
+                    self.done = True
+            elif not self._stack:
+                if ch == ",":
+                    emitted += self._close_member(self._pos, skip=1)
+                elif ch == ":":
+                    self._seen_colon = True
+            self._pos += 1
+        return emitted
+
+    def _close_member(self, end, skip=0):
+        segment = self._buf[self._member_start:end]
+        self._member_start = end + skip
+        self._seen_colon = False
+        self._value_done = False
+        member = _parse_member(segment, self.repairs)
+        if member is None:
+            return []
+        key, value = member
+        self.result[key] = value
+        return [member]
+
+    def finish(self):
+        """Return the parsed report, salvaging a truncated trailing member when possible."""
+        if self._started and not self.done:
+            self.truncated = True
+            segment = self._buf[self._member_start:]
+            if self._in_string:
+                segment += "\\" if self._escape else ""
+                segment += '"'
+            segment = segment.rstrip().rstrip(",")
+            segment += "".join(_CLOSERS[c] for c in reversed(self._stack))
+            member = _parse_member(segment, self.repairs)
+            if member is not None:
+                self.result[member[0]] = member[1]
+                self.truncated_key = member[0]
+            self.repairs.add("truncated_tail")
+            self.done = True
+        return self.result
+
+
+def _parse_member(segment, repairs=None):
+    segment = segment.strip()
+    if not segment:
+        return None
+    try:
+        parsed = json.loads("{" + segment + "}", strict=False)
+    except json.JSONDecodeError:
+        # Tolerate a trailing comma inside the value's last container
+        repaired = _strip_trailing_commas(segment)
+        try:
+            parsed = json.loads("{" + repaired + "}", strict=False)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Dropping unparseable report member: {e}. Segment: {segment[:200]}")
+            if repairs is not None:
+                repairs.add("dropped_member")
+            return None
+        if repairs is not None:
+            repairs.add("trailing_comma")
+    if not parsed:
+        return None
+    return next(iter(parsed.items()))
+
+
+def _strip_trailing_commas(text):
+    out = []
+    in_string = escape = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == ",":
+            rest = text[i + 1:].lstrip()
+            if rest[:1] in ("]", "}"):
+                continue
+        out.append(ch)
+    return "".join(out)
+
+
+def parse_report_text(text):
+    """Parse a complete (or truncated) report completion in one go."""
+    parser = ReportStreamParser()
+    parser.feed(text)
+    return parser.finish(), parser.truncated
+
+
+def validate_sections(sections):
+    """Check report sections against the Report schema.
+
+    Returns the coerced values of the usable sections; absent and invalid ones are left out.
+    """
+    candidate = {key: sections[key] for key in REPORT_KEYS if key in sections}
+    try:
+        report = Report.model_validate(candidate)
+    except ValidationError as e:
+        invalid = {error["loc"][0] for error in e.errors()}
+        for key in invalid:
+            logger.warning(f"Invalid report section {key}: {str(candidate[key])[:200]}")
+            metrics.inc("report_invalid_sections_total", section=key)
+        # Fields are validated independently, so the rest passes on its own
+        report = Report.model_validate({key: value for key, value in candidate.items() if key not in invalid})
+    return {key: value for key, value in report.model_dump().items() if value is not None}
+
+
+def normalize_report(parsed_json):
+    """Map legacy keys, coerce sections to the schema and fill the unusable ones so a partial report still renders.
+
+    Returns the list of sections that had to be filled in.
+    """
+    for old, new in LEGACY_KEYS.items():
+        if old in parsed_json and new not in parsed_json:
+            parsed_json[new] = parsed_json[old]
+    valid = validate_sections(parsed_json)
+    missing = [key for key in REPORT_KEYS if key not in valid]
+    parsed_json.update(valid)
+    for key in missing:
+        parsed_json[key] = [] if key in LIST_KEYS else ""
+    return missing
+
+
+def analyze_report(text):
+    """Parse, repair and validate a report completion: the one post-processing path for reports.
+
+    Returns (report, broken, repairs): the normalized report, or None when nothing could
+    be parsed; the sections that are absent, invalid or cut off and so need regenerating;
+    and the syntax repairs that were applied.
+    """
+    parser = ReportStreamParser()
+    parser.feed(text)
+    parsed_json = parser.finish()
+    if not parsed_json:
+        return None, list(REPORT_KEYS), parser.repairs
+    broken = normalize_report(parsed_json)
+    # A member salvaged from a cut-off tail parses, but its text stops mid-sentence
+    cut = LEGACY_KEYS.get(parser.truncated_key, parser.truncated_key)
+    if cut in REPORT_KEYS and cut not in broken:
+        broken.append(cut)
+    return parsed_json, broken, parser.repairs
@@ -0,0 +1,120 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+REPORT_PREFETCH = os.getenv("REPORT_PREFETCH", "1") == "1"
+REPORT_PREFETCH_TTL = int(os.getenv("REPORT_PREFETCH_TTL", "900"))
+REPORT_PREFETCH_MAX = int(os.getenv("REPORT_PREFETCH_MAX", "500"))
+
+
+def history_key(history):
+    payload = json.dumps([[m["role"], m["content"]] for m in history], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ReportPrefetcher:
+    """Starts report generation in the background as soon as a conversation finishes.
+
+    Results are keyed by a hash of the history, so /assessment/report only reuses a
+    prefetch made for exactly the conversation it was asked about. An entry is dropped
+    once its report has been handed out, when its session goes on with another turn
+    (cancel_session), or after `ttl` seconds; a still-running upstream call is cancelled.
+    At most `max_entries` are kept. Each serve.py worker prefetches on its own.
+    """
+
+    def __init__(self, generate, ttl=REPORT_PREFETCH_TTL, max_entries=REPORT_PREFETCH_MAX, enabled=REPORT_PREFETCH):
+        self.generate = generate  # async (history, session_id) -> raw completion text
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._entries = OrderedDict()  # history key -> entry
+        self._by_session = {}  # session id -> history key
+
+    def schedule(self, session_id, history):
+        if not self.enabled:
+            return
+        key = history_key(history)
+        if key in self._entries:
+            return
+        # A newer turn for the same session makes its older prefetch useless
+        previous = self._by_session.get(session_id)
+        if previous:
+            self._drop(previous, reason="superseded")
+
+        loop = asyncio.get_running_loop()
+        task = loop.create_task(self.generate(list(history), session_id))
+        task.add_done_callback(lambda t: self._on_done(key, t))
+        self._entries[key] = {
+            "task": task,
+            "session_id": session_id,
+            "created_at": time.time(),
+            "expiry": loop.call_later(self.ttl, self._drop, key, "expired"),
+        }
+        self._by_session[session_id] = key
+        metrics.inc("report_prefetch_total", outcome="scheduled")
+        logger.info(f"Prefetching report for session {session_id}")
+
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._drop(oldest, reason="evicted")
+
+    async def take(self, history):
+        """Return the prefetched completion for this history, waiting if it is still running.
+
+        Returns None when there is no usable prefetch; the caller then generates normally.
+        """
+        entry = self._entries.get(history_key(history))
+        if entry is None:
+            metrics.inc("report_prefetch_total", outcome="miss")
+            return None
+        task = entry["task"]
+        metrics.inc("report_prefetch_total", outcome="hit" if task.done() else "in_flight_hit")
+        try:
+            # Shield so a disconnecting client doesn't cancel the shared prefetch
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return None
+            raise
+        except Exception as e:
+            logger.warning(f"Prefetched report failed, generating again: {e}")
+            return None
+        # A repeated request for the same report goes through the report cache instead
+        self._drop(history_key(history), reason="served")
+        return result
+
+    def cancel_session(self, session_id, reason="cancelled"):
+        """Drop the session's prefetch, cancelling it if it is still running."""
+        key = self._by_session.get(session_id)
+        if key:
+            self._drop(key, reason=reason)
+
+    def _on_done(self, key, task):
+        if not task.cancelled() and task.exception() is not None:
+            metrics.inc("report_prefetch_total", outcome="failed")
+            self._drop(key, reason="failed")
+
+    def _drop(self, key, reason):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        entry["expiry"].cancel()
+        if self._by_session.get(entry["session_id"]) == key:
+            del self._by_session[entry["session_id"]]
+        if not entry["task"].done():
+            entry["task"].cancel()
+            metrics.inc("report_prefetch_total", outcome="cancelled")
+        if reason != "failed":
+            metrics.inc("report_prefetch_total", outcome=reason)
+
+    def stats(self):
+        running = sum(1 for e in self._entries.values() if not e["task"].done())
+        return {"entries": len(self._entries), "running": running, "enabled": self.enabled}
@@ -0,0 +1,106 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds the client will wait for this response, sent by the client (or its proxy)
+DEADLINE_HEADER = "x-request-timeout"
+# Hard cap per request; on Vercel the function is killed at maxDuration anyway. 0 = none
+REQUEST_MAX_DURATION = float(os.getenv("REQUEST_MAX_DURATION", "60" if os.getenv("VERCEL") else "0"))
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of starting upstream work whose result could no longer be delivered."""
+
+    def __init__(self, endpoint, remaining):
+        super().__init__(f"Request deadline reached ({max(remaining, 0):.1f}s left) before {endpoint} could run")
+        self.remaining = remaining
+
+
+class RequestContext:
+    """Per-request state the LLM layer can see: the delivery deadline and whether the client left."""
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline  # time.monotonic() value, or None
+        self.disconnected = False
+
+    def remaining(self):
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+
+# Set for the duration of each HTTP request; tasks started from it inherit the value
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def request_deadline(headers, now):
+    budgets = [REQUEST_MAX_DURATION] if REQUEST_MAX_DURATION > 0 else []
+    raw = headers.get(DEADLINE_HEADER)
+    if raw:
+        try:
+            budgets.append(max(float(raw), 0.0))
+        except ValueError:
+            logger.warning(f"Ignoring malformed {DEADLINE_HEADER} header: {raw!r}")
+    return now + min(budgets) if budgets else None
+
+
+class RequestContextMiddleware:
+    """ASGI middleware that cancels a request's handler as soon as its client disconnects.
+
+    Uvicorn keeps running a handler whose client has gone away, and a handler awaiting a
+    non-streamed completion never notices. Here the request's receive channel is watched
+    alongside the handler; on http.disconnect before the response is complete the handler
+    task is cancelled, which aborts its in-flight upstream call. The request deadline
+    (X-Request-Timeout, REQUEST_MAX_DURATION) is published through `current_request`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        context = RequestContext(request_deadline(headers, time.monotonic()))
+        messages = asyncio.Queue()
+        response_complete = False
+
+        async def listen():
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    return
+
+        async def send_wrapper(message):
+            nonlocal response_complete
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_complete = True
+            await send(message)
+
+        token = current_request.set(context)
+        try:
+            handler = asyncio.ensure_future(self.app(scope, messages.get, send_wrapper))
+        finally:
+            current_request.reset(token)
+        listener = asyncio.ensure_future(listen())
+        try:
+            await asyncio.wait({handler, listener}, return_when=asyncio.FIRST_COMPLETED)
+            if not handler.done() and not response_complete:
+                context.disconnected = True
+                scope["client_disconnected"] = True
+                metrics.inc("http_client_disconnects_total")
+                handler.cancel()
+            try:
+                await handler
+            except asyncio.CancelledError:
+                if not context.disconnected:
+                    raise
+        finally:
+            listener.cancel()
+            handler.cancel()
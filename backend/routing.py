@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import deque
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+LLM_MODEL = os.getenv("ALIYUN_MODEL_NAME", "deepseek-v3")
+# Model for the short conversational turns; defaults to the main model
+LLM_FAST_MODEL = os.getenv("ALIYUN_FAST_MODEL_NAME", LLM_MODEL)
+
+# Route keys are "endpoint" or "endpoint:mode"; the more specific one wins
+DEFAULT_ROUTES = {
+    "start": LLM_FAST_MODEL,
+    "chat": LLM_FAST_MODEL,
+    "compact": LLM_FAST_MODEL,
+}
+# e.g. LLM_MODEL_ROUTES='{"chat:quick": "qwen-turbo", "report": "deepseek-v3.2"}'
+LLM_MODEL_ROUTES = {**DEFAULT_ROUTES, **json.loads(os.getenv("LLM_MODEL_ROUTES", "{}"))}
+
+# Background work is routed like the endpoint it stands in for
+ROUTE_ALIASES = {"start_pool": "start", "random_report_pool": "random_report", "report_prefetch": "report",
+                 "batch_report": "report"}
+
+# Latency-aware fallback: when a route's model has a p95 above its threshold (seconds),
+# new calls go to the fallback model until the slow samples age out of the window
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "")
+# e.g. LLM_FALLBACK_P95='{"chat": 8, "report": 30}'
+LLM_FALLBACK_P95 = json.loads(os.getenv("LLM_FALLBACK_P95", "{}"))
+LLM_ROUTE_WINDOW = float(os.getenv("LLM_ROUTE_WINDOW", "300"))  # Seconds of latency samples kept
+LLM_ROUTE_MIN_SAMPLES = int(os.getenv("LLM_ROUTE_MIN_SAMPLES", "10"))
+
+# A/B test: sessions hashed into arm "b" use these models instead, e.g. '{"chat": "qwen-turbo"}'
+LLM_AB_MODELS = json.loads(os.getenv("LLM_AB_MODELS", "{}"))
+LLM_AB_RATIO = float(os.getenv("LLM_AB_RATIO", "0.5"))  # Share of sessions in arm "b"
+
+# Price per million tokens, for the cost comparison, e.g. '{"deepseek-v3": {"input": 2, "cached_input": 0.5, "output": 8}}'
+LLM_MODEL_PRICES = json.loads(os.getenv("LLM_MODEL_PRICES", "{}"))
+
+
+class WindowedLatency:
+    """Latency samples from the last `window` seconds."""
+
+    def __init__(self, window=LLM_ROUTE_WINDOW):
+        self.window = window
+        self._samples = deque()  # (recorded_at, seconds)
+
+    def record(self, seconds):
+        self._samples.append((time.monotonic(), seconds))
+        self._prune()
+
+    def percentile(self, q, min_samples=1):
+        self._prune()
+        if len(self._samples) < min_samples or not self._samples:
+            return None
+        ordered = sorted(s for _, s in self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.window
+        while self._samples and self._samples[0][0] < cutoff:
+            self._samples.popleft()
+
+
+def cost(model, usage):
+    """Estimated cost of one call from LLM_MODEL_PRICES, or None when the model has no price."""
+    price = LLM_MODEL_PRICES.get(model)
+    if not price or usage is None:
+        return None
+    cached = usage["cached_tokens"]
+    return (
+        (usage["prompt_tokens"] - cached) * price.get("input", 0)
+        + cached * price.get("cached_input", price.get("input", 0))
+        + usage["completion_tokens"] * price.get("output", 0)
+    ) / 1_000_000
+
+
+class ModelRouter:
+    """Picks the model for each upstream call and keeps per-model latency and cost figures.
+
+    The configured model for an endpoint (and mode) is the primary. Sessions in A/B arm
+    "b" get the arm's model instead, and a primary whose recent p95 is over its
+    threshold is swapped for LLM_FALLBACK_MODEL. Every call is recorded per
+    (endpoint, model, arm) so the arms and models can be compared in /stats.
+    """
+
+    def __init__(self, routes=LLM_MODEL_ROUTES, fallback=LLM_FALLBACK_MODEL, thresholds=LLM_FALLBACK_P95,
+                 ab_models=LLM_AB_MODELS, ab_ratio=LLM_AB_RATIO):
+        self.routes = routes
+        self.fallback = fallback
+        self.thresholds = thresholds
+        self.ab_models = ab_models
+        self.ab_ratio = ab_ratio
+        self._latency = {}  # (route, model) -> WindowedLatency
+        self._figures = {}  # (endpoint, model, arm) -> totals
+        self._degraded = set()  # routes currently sent to the fallback model
+
+    def primary(self, endpoint, mode=None):
+        """The configured model, ignoring A/B arms and latency fallback."""
+        route = ROUTE_ALIASES.get(endpoint, endpoint)
+        return self.routes.get(f"{route}:{mode}") or self.routes.get(route) or LLM_MODEL
+
+    def arm(self, session_id):
+        if not session_id or not self.ab_models:
+            return "a"
+        bucket = int(hashlib.sha1(session_id.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+        return "b" if bucket < self.ab_ratio else "a"
+
+    def choose(self, endpoint, mode=None, session_id=None):
+        route = ROUTE_ALIASES.get(endpoint, endpoint)
+        if self.arm(session_id) == "b" and route in self.ab_models:
+            return self.ab_models[route]
+        model = self.primary(endpoint, mode)
+        if self._is_slow(route, model):
+            return self.fallback
+        return model
+
+    def _is_slow(self, route, model):
+        threshold = self.thresholds.get(route)
+        if not self.fallback or threshold is None or model == self.fallback:
+            return False
+        latency = self._latency.get((route, model))
+        p95 = latency.percentile(0.95, LLM_ROUTE_MIN_SAMPLES) if latency else None
+        slow = p95 is not None and p95 > threshold
+        if slow != (route in self._degraded):
+            # Once the slow samples leave the window the primary gets traffic again
+            if slow:
+                self._degraded.add(route)
+                logger.warning(f"{model} p95 {p95:.1f}s over {threshold}s for {route}; using {self.fallback}")
+            else:
+                self._degraded.discard(route)
+                logger.info(f"{model} is back under {threshold}s for {route}")
+            metrics.set_gauge("llm_route_degraded", int(slow), route=route)
+        return slow
+
+    def record(self, endpoint, model, seconds, usage=None, session_id=None, ok=True):
+        """Account one finished (or failed) call; `usage` is the normalized dict from usage.extract_usage."""
+        route = ROUTE_ALIASES.get(endpoint, endpoint)
+        arm = self.arm(session_id)
+        self._latency.setdefault((route, model), WindowedLatency()).record(seconds)
+        totals = self._figures.setdefault((endpoint, model, arm), {
+            "calls": 0, "errors": 0, "latency": WindowedLatency(),
+            "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0,
+        })
+        totals["calls"] += 1
+        totals["latency"].record(seconds)
+        metrics.observe("llm_route_seconds", seconds, endpoint=endpoint, model=model, arm=arm)
+        if not ok:
+            totals["errors"] += 1
+            metrics.inc("llm_route_errors_total", endpoint=endpoint, model=model, arm=arm)
+        if usage is not None:
+            totals["prompt_tokens"] += usage["prompt_tokens"]
+            totals["completion_tokens"] += usage["completion_tokens"]
+            call_cost = cost(model, usage)
+            if call_cost is not None:
+                totals["cost"] += call_cost
+                metrics.inc("llm_cost_total", call_cost, endpoint=endpoint, model=model, arm=arm)
+
+    def stats(self):
+        figures = []
+        for (endpoint, model, arm), totals in sorted(self._figures.items()):
+            calls = totals["calls"]
+            figures.append({
+                "endpoint": endpoint,
+                "model": model,
+                "arm": arm,
+                "calls": calls,
+                "errors": totals["errors"],
+                "p50_seconds": totals["latency"].percentile(0.5),
+                "p95_seconds": totals["latency"].percentile(0.95),
+                "avg_prompt_tokens": round(totals["prompt_tokens"] / calls),
+                "avg_completion_tokens": round(totals["completion_tokens"] / calls),
+                "cost": round(totals["cost"], 6),
+            })
+        return {
+            "routes": self.routes,
+            "fallback": self.fallback or None,
+            "degraded": sorted(self._degraded),
+            "ab_models": self.ab_models,
+            "ab_ratio": self.ab_ratio if self.ab_models else None,
+            "figures": figures,
+        }
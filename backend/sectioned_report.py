@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from metrics import metrics
+from report_parser import LEGACY_KEYS, parse_report_text, validate_sections
+
+logger = logging.getLogger(__name__)
+
+REPORT_SECTIONED = os.getenv("REPORT_SECTIONED", "0") == "1"
+REPORT_SECTION_ATTEMPTS = int(os.getenv("REPORT_SECTION_ATTEMPTS", "2"))
+
+LEAD_SECTION = "core_traits"
+DEPENDENT_SECTIONS = ["deep_analysis", "careers", "action_guide", "not_suitable"]
+
+
+class SectionedReport:
+    """Generates a report as independent section requests instead of one long completion.
+
+    core_traits is generated first; the other sections then run concurrently with the
+    traits in their prompt, so the wall-clock time is the lead section plus the slowest
+    dependent one. deltas() yields the merged report as JSON text, one member per
+    section in completion order, so the existing report parser, cache and SSE section
+    events work unchanged. A section that fails is retried on its own; one that still
+    fails is left out and the report is salvaged as partial.
+    """
+
+    def __init__(self, generate_section, attempts=REPORT_SECTION_ATTEMPTS):
+        self.generate_section = generate_section  # async (section, core_traits or None) -> completion text
+        self.attempts = attempts
+        self._errors = []
+
+    async def deltas(self):
+        yield "{"
+        emitted = 0
+        core_traits = await self._section(LEAD_SECTION, None)
+        if core_traits is not None:
+            yield _member(LEAD_SECTION, core_traits, emitted)
+            emitted += 1
+        tasks = [asyncio.ensure_future(self._keyed(section, core_traits)) for section in DEPENDENT_SECTIONS]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                section, value = await next_done
+                if value is not None:
+                    yield _member(section, value, emitted)
+                    emitted += 1
+        finally:
+            for task in tasks:
+                task.cancel()
+        if not emitted and self._errors:
+            # Nothing came back at all: an upstream outage, not a formatting problem
+            raise self._errors[-1]
+        yield "}"
+
+    async def fill(self, report, sections):
+        """Regenerate just `sections` of an otherwise usable report, in place.
+
+        Used to repair a single-completion report whose sections came back missing,
+        invalid or cut off, instead of retrying the whole generation. Returns the
+        sections that still could not be generated.
+        """
+        missing = list(sections)
+        if LEAD_SECTION in missing:
+            value = await self._section(LEAD_SECTION, None)
+            if value is not None:
+                report[LEAD_SECTION] = value
+                missing.remove(LEAD_SECTION)
+        core_traits = report.get(LEAD_SECTION) or None
+        results = await asyncio.gather(*[
+            self._keyed(section, core_traits) for section in missing if section != LEAD_SECTION
+        ])
+        for section, value in results:
+            if value is not None:
+                report[section] = value
+                missing.remove(section)
+        return missing
+
+    async def _keyed(self, section, core_traits):
+        return section, await self._section(section, core_traits)
+
+    async def _section(self, section, core_traits):
+        for attempt in range(1, self.attempts + 1):
+            started = time.perf_counter()
+            try:
+                text = await self.generate_section(section, core_traits)
+            except Exception as e:
+                self._errors.append(e)
+                logger.warning(f"Report section {section} failed (attempt {attempt}): {e}")
+                metrics.inc("report_section_total", section=section, outcome="error")
+                continue
+            finally:
+                metrics.observe("report_section_seconds", time.perf_counter() - started, section=section)
+            value = _section_value(text, section)
+            if value:
+                metrics.inc("report_section_total", section=section, outcome="ok")
+                return value
+            logger.warning(f"Report section {section} unusable (attempt {attempt}): {(text or '')[:200]}")
+            metrics.inc("report_section_total", section=section, outcome="unparseable")
+        metrics.inc("report_section_total", section=section, outcome="dropped")
+        return None
+
+
+def _section_value(text, section):
+    parsed, truncated = parse_report_text(text or "")
+    if truncated:
+        return None  # Cut off mid-section; worth another attempt
+    legacy = next((old for old, new in LEGACY_KEYS.items() if new == section and old in parsed), None)
+    if section not in parsed and legacy:
+        parsed[section] = parsed[legacy]
+    return validate_sections(parsed).get(section)
+
+
+def _member(section, value, index):
+    text = f"{json.dumps(section)}: {json.dumps(value, ensure_ascii=False)}"
+    return text if index == 0 else ", " + text
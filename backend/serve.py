@@ -0,0 +1,262 @@
+"""
+Production launcher for self-hosting the backend outside Vercel.
+
+    python serve.py                          # SERVE_WORKERS=auto: one worker per CPU
+    python serve.py --workers 4 --port 8000
+    kill -HUP <master pid>                   # Replace the workers one by one
+    kill -TERM <master pid>                  # Drain and stop
+
+The app, prompts and the deferred SDK imports are loaded once in the master and the
+workers are forked from it, so a worker is serving within milliseconds and shares those
+pages with the others. All workers accept from one listening socket. Each one takes at
+most SERVE_MAX_INFLIGHT connections at once and answers 503 beyond that, so an
+overloaded worker sheds load instead of queueing it.
+
+Stopping or replacing a worker drains it. It stops accepting, and in-flight requests get
+up to SERVE_DRAIN_SECONDS to finish, including report generations and SSE streams. On
+SIGHUP a replacement is started and ready before each old worker is told to drain. With
+--no-preload the workers import the app themselves, so SIGHUP also picks up code and
+prompt changes.
+
+Sessions and rate limits have to be shared between workers, so with more than one worker
+SESSION_STORE and RATE_LIMIT_BACKEND default to sqlite, and the random report bank to a
+shared file (RANDOM_REPORT_BANK_PATH). LLM_MAX_CONCURRENCY, the caches and the usage
+ledger stay per worker. Every worker publishes its metrics to METRICS_DIR,
+and /metrics and /stats in any worker add them all up.
+
+Without os.fork (Windows) this runs a single uvicorn process with the same limits.
+"""
+import argparse
+import glob
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger("serve")
+
+SERVE_WORKERS = os.getenv("SERVE_WORKERS", "auto")
+SERVE_MAX_INFLIGHT = int(os.getenv("SERVE_MAX_INFLIGHT", "200"))  # Connections per worker
+# Longest report generations take ~30 s; streams get the same grace
+SERVE_DRAIN_SECONDS = float(os.getenv("SERVE_DRAIN_SECONDS", "30"))
+SERVE_BACKLOG = int(os.getenv("SERVE_BACKLOG", "2048"))
+SERVE_READY_TIMEOUT = float(os.getenv("SERVE_READY_TIMEOUT", "30"))
+# A worker that dies sooner than this after starting is restarted only after a pause
+CRASH_BACKOFF_SECONDS = 1.0
+
+
+def worker_count(value):
+    if value == "auto":
+        return os.cpu_count() or 1
+    return max(1, int(value))
+
+
+def listen(host, port, backlog):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def server_config(app, args):
+    import uvicorn
+    return uvicorn.Config(
+        app, host=args.host, port=args.port, log_level=args.log_level, lifespan="on",
+        limit_concurrency=args.max_inflight, timeout_graceful_shutdown=args.drain, backlog=SERVE_BACKLOG,
+    )
+
+
+def run_worker(sock, app, args, ready_fd):
+    """Serve from the inherited socket until told to stop; runs in the forked child."""
+    import uvicorn
+    from metrics import metrics
+
+    # Uvicorn re-raises the stop signal once it has drained; let it fall through to here
+    # so the final metrics are published, instead of dying on the default handler
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: None)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    class WorkerServer(uvicorn.Server):
+        async def startup(self, sockets=None):
+            await super().startup(sockets=sockets)
+            os.write(ready_fd, b"1")
+            os.close(ready_fd)
+
+    # Summed over the workers by collect(), this is the server's total capacity
+    metrics.set_gauge("http_inflight_limit", args.max_inflight)
+    metrics.start_publishing()
+    try:
+        WorkerServer(server_config(app, args)).run(sockets=[sock])
+    finally:
+        metrics.publish()
+
+
+class Master:
+    """Forks the workers, restarts ones that die, replaces them on SIGHUP and drains them on exit."""
+
+    def __init__(self, sock, app, args):
+        self.sock = sock
+        self.app = app
+        self.args = args
+        self.workers = {}  # pid -> start time
+        self.draining = set()
+        self.pending = []  # Signals received, handled by the main loop
+        self.stopping = False
+
+    def spawn(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            code = 0
+            try:
+                run_worker(self.sock, self.app, self.args, write_fd)
+            except BaseException:
+                logger.exception("Worker failed")
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        self.workers[pid] = time.monotonic()
+        return pid, read_fd
+
+    def wait_ready(self, pid, read_fd):
+        try:
+            readable, _, _ = select.select([read_fd], [], [], SERVE_READY_TIMEOUT)
+            return bool(readable) and os.read(read_fd, 1) == b"1"
+        finally:
+            os.close(read_fd)
+
+    def reap(self):
+        from metrics import retire_worker
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self.workers.pop(pid, None)
+            if pid in self.draining:
+                self.draining.discard(pid)
+                logger.info(f"Worker {pid} drained")
+            elif not self.stopping:
+                logger.warning(f"Worker {pid} exited unexpectedly (status {status})")
+                if started is not None and time.monotonic() - started < CRASH_BACKOFF_SECONDS:
+                    time.sleep(CRASH_BACKOFF_SECONDS)
+            retire_worker(pid)
+
+    def drain(self, pid):
+        self.workers.pop(pid, None)
+        self.draining.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def reload(self):
+        """Replace every worker, starting each replacement before the old one drains."""
+        logger.info(f"Reloading {len(self.workers)} workers")
+        for old in list(self.workers):
+            pid, ready = self.spawn()
+            if not self.wait_ready(pid, ready):
+                logger.error(f"Replacement worker {pid} did not start; keeping the old workers")
+                self.drain(pid)
+                return
+            self.drain(old)
+
+    def stop(self):
+        self.stopping = True
+        for pid in list(self.workers):
+            self.drain(pid)
+        logger.info(f"Draining {len(self.draining)} workers (up to {self.args.drain:.0f}s)")
+        deadline = time.monotonic() + self.args.drain + 5
+        while self.draining and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.draining):
+            logger.warning(f"Worker {pid} did not drain in time; killing it")
+            os.kill(pid, signal.SIGKILL)
+        while self.draining:
+            self.reap()
+            time.sleep(0.05)
+
+    def run(self):
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, lambda sig, _: self.pending.append(sig))
+        started = [self.spawn() for _ in range(self.args.workers)]
+        ready = sum(self.wait_ready(pid, fd) for pid, fd in started)
+        logger.info(f"{ready}/{self.args.workers} workers serving on {self.args.host}:{self.args.port}, "
+                    f"up to {self.args.max_inflight} connections each (master pid {os.getpid()})")
+        while True:
+            self.reap()
+            while self.pending:
+                sig = self.pending.pop(0)
+                if sig == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.stop()
+                    return
+            for _ in range(self.args.workers - len(self.workers)):
+                self.spawn()  # Replaces a worker that died; the socket keeps accepting meanwhile
+            time.sleep(0.2)
+
+
+def prepare_environment(args):
+    """Settings the workers need to cooperate; set before anything reads them at import time."""
+    if args.workers > 1:
+        for name in ("SESSION_STORE", "RATE_LIMIT_BACKEND"):
+            os.environ.setdefault(name, "sqlite")
+            if os.environ[name] != "sqlite":
+                logger.warning(f"{name}={os.environ[name]} is per process; with {args.workers} workers "
+                               f"a client's requests see different state depending on the worker")
+        # One bank in a shared file instead of one per worker, each paying for its own fills
+        os.environ.setdefault("RANDOM_REPORT_BANK_PATH", os.path.join(tempfile.gettempdir(), "talent_random_reports.jsonl"))
+    directory = os.environ.setdefault("METRICS_DIR", tempfile.mkdtemp(prefix="talent-metrics-"))
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        os.remove(path)  # Counts from an earlier run
+
+
+def preload():
+    """Import the app and the SDKs its first request would import, so forked workers share them."""
+    import main
+    import httpx  # noqa: F401
+    import openai  # noqa: F401
+    return main.app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", default=SERVE_WORKERS, help="Worker processes, or auto for one per CPU")
+    parser.add_argument("--max-inflight", type=int, default=SERVE_MAX_INFLIGHT, help="Connections per worker")
+    parser.add_argument("--drain", type=float, default=SERVE_DRAIN_SECONDS, help="Seconds to let requests finish")
+    parser.add_argument("--no-preload", action="store_true", help="Import the app in each worker, so SIGHUP reloads code")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    args.workers = worker_count(args.workers)
+    logging.basicConfig(level=logging.INFO)
+
+    if not hasattr(os, "fork"):
+        import uvicorn
+        logger.warning("os.fork is not available here; serving from a single process")
+        uvicorn.Server(server_config(preload(), args)).run()
+        sys.exit(0)
+
+    prepare_environment(args)
+    app = "main:app" if args.no_preload else preload()
+    Master(listen(args.host, args.port, SERVE_BACKLOG), app, args).run()
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "7200"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "/tmp/talent_sessions.db")
+
+
+def new_session(history, mode="normal"):
+    return {
+        "id": uuid.uuid4().hex,
+        "mode": mode,
+        "history": history,
+        "meta": {},
+    }
+
+
+class SessionStore:
+    """Keeps assessment sessions server-side so clients only send a session id.
+
+    Request handlers use get_async()/save_async(), which a store doing I/O runs off the
+    event loop; the plain methods are for scripts and tests.
+    """
+
+    def get(self, session_id):
+        raise NotImplementedError
+
+    def save(self, session):
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    async def get_async(self, session_id):
+        return self.get(session_id)
+
+    async def save_async(self, session):
+        self.save(session)
+
+
+class MemorySessionStore(SessionStore):
+    """Per-process LRU with TTL eviction; the default for the standalone backend."""
+
+    def __init__(self, max_sessions=SESSION_MAX, ttl=SESSION_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # id -> (expires_at, session)
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            expires_at, session = entry
+            if expires_at < time.time():
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def save(self, session):
+        with self._lock:
+            self._sessions[session["id"]] = (time.time() + self.ttl, session)
+            self._sessions.move_to_end(session["id"])
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class SQLiteSessionStore(SessionStore):
+    """File-backed store so sessions survive across serverless invocations of one instance."""
+
+    def __init__(self, path=SESSION_DB_PATH, ttl=SESSION_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self._connect()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)")
+        if hasattr(os, "register_at_fork"):
+            # A SQLite connection must not be shared across fork (serve.py preloads, then forks workers)
+            os.register_at_fork(after_in_child=self._connect)
+
+    def _connect(self):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+
+    def get(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM sessions WHERE id = ? AND expires_at >= ?",
+                (session_id, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, session):
+        self._write(session["id"], json.dumps(session, ensure_ascii=False))
+
+    def _write(self, session_id, data):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                (session_id, data, now + self.ttl),
+            )
+            self._conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+
+    def delete(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    async def get_async(self, session_id):
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, session_id)
+
+    async def save_async(self, session):
+        # Serialized now, so later changes to the dict can't race the write
+        data = json.dumps(session, ensure_ascii=False)
+        await asyncio.get_running_loop().run_in_executor(None, self._write, session["id"], data)
+
+
+def create_store(kind=None):
+    kind = kind or os.getenv("SESSION_STORE", "memory")
+    if kind == "sqlite":
+        logger.info(f"Using SQLite session store at {SESSION_DB_PATH}")
+        return SQLiteSessionStore()
+    return MemorySessionStore()
@@ -0,0 +1,45 @@
+import json
+
+DONE_MARKER = "【DONE】"
+
+
+def sse_event(event, data):
+    """Format one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # Stop proxies from buffering the stream
+}
+
+
+class DoneMarkerFilter:
+    """Strips the 【DONE】 marker from a token stream, even when it is split across chunks.
+
+    Text that could still be the start of the marker is held back until the next chunk
+    decides it one way or the other.
+    """
+
+    def __init__(self, marker=DONE_MARKER):
+        self.marker = marker
+        self.found = False
+        self._pending = ""
+
+    def feed(self, chunk):
+        text = self._pending + chunk
+        if self.marker in text:
+            self.found = True
+            text = text.replace(self.marker, "")
+        # Hold back the longest tail that is a proper prefix of the marker
+        hold = 0
+        for size in range(min(len(self.marker) - 1, len(text)), 0, -1):
+            if self.marker.startswith(text[-size:]):
+                hold = size
+                break
+        self._pending = text[len(text) - hold:] if hold else ""
+        return text[:len(text) - hold] if hold else text
+
+    def flush(self):
+        text, self._pending = self._pending, ""
+        return text
@@ -0,0 +1,134 @@
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+# Before main is imported: no upstream, no background work, per-process state only
+os.environ.setdefault("ALIYUN_API_KEY", "test")
+os.environ["SESSION_STORE"] = "memory"
+os.environ["RATE_LIMIT"] = "0"
+os.environ["REPORT_PREFETCH"] = "0"
+os.environ["REPORT_ARCHIVE"] = "0"
+os.environ["OPENING_POOL_DEPTH"] = "0"
+
+import main
+import rate_limit
+from rate_limit import MemoryRateLimitBackend, RateLimited, RateLimiter, SQLiteRateLimitBackend
+
+
+class Clock:
+    """Stands in for the time module in rate_limit, so refills don't need real waiting."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+def with_clock(test):
+    def run():
+        clock = Clock()
+        real, rate_limit.time = rate_limit.time, clock
+        try:
+            test(clock)
+        finally:
+            rate_limit.time = real
+    run.__name__ = test.__name__
+    return run
+
+
+def rejected(limiter, endpoint_class, key):
+    try:
+        limiter.check(endpoint_class, key)
+    except RateLimited as e:
+        return e.retry_after
+    return None
+
+
+@with_clock
+def test_burst_then_retry_after(clock):
+    for backend in (MemoryRateLimitBackend(), SQLiteRateLimitBackend(os.path.join(tempfile.mkdtemp(), "rl.db"))):
+        limiter = RateLimiter(backend, limits={"report": (0.1, 3)}, enabled=True)
+        assert [rejected(limiter, "report", "session:a") for _ in range(3)] == [None, None, None]
+        assert rejected(limiter, "report", "session:a") == 10  # One token at 0.1/s
+        assert rejected(limiter, "report", "session:b") is None  # Buckets are per key
+        clock.now += 1  # Reset for the next backend
+
+
+@with_clock
+def test_refill_is_gradual_and_capped(clock):
+    backend = MemoryRateLimitBackend()
+    for _ in range(2):
+        assert backend.take("k", 0.5, 2) == 0
+    assert backend.take("k", 0.5, 2) == 2
+    clock.now += 1  # Half a token
+    assert backend.take("k", 0.5, 2) == 1
+    clock.now += 3600  # Idle for an hour: back to the burst, not more
+    assert [backend.take("k", 0.5, 2) for _ in range(3)] == [0, 0, 2]
+
+
+@with_clock
+def test_retry_after_is_at_least_a_second(clock):
+    limiter = RateLimiter(MemoryRateLimitBackend(), limits={"assessment": (5, 1)}, enabled=True)
+    limiter.check("assessment", "session:a")
+    assert rejected(limiter, "assessment", "session:a") == 1
+
+
+@with_clock
+def test_least_recently_used_keys_are_evicted(clock):
+    backend = MemoryRateLimitBackend(max_keys=2)
+    backend.take("a", 0.1, 1)
+    backend.take("b", 0.1, 1)
+    backend.take("a", 0.1, 1)  # "a" is now the most recent
+    backend.take("c", 0.1, 1)
+    assert list(backend._buckets) == ["a", "c"]
+    assert backend.take("b", 0.1, 1) == 0  # Forgotten, so it starts with a full bucket
+
+
+def request(ip, client_id=None):
+    headers = {"X-Client-Id": client_id} if client_id else {}
+    return SimpleNamespace(headers=headers, client=SimpleNamespace(host=ip))
+
+
+@with_clock
+def test_devices_share_an_ip_ceiling(clock):
+    real, main.limiter = main.limiter, RateLimiter(
+        MemoryRateLimitBackend(), limits={"start": (0.1, 2), "start_ip": (0.1, 3)}, enabled=True)
+    try:
+        main.check_client_limit("start", request("10.0.0.1", "device-a"))
+        main.check_client_limit("start", request("10.0.0.1", "device-a"))
+        try:
+            main.check_client_limit("start", request("10.0.0.1", "device-a"))
+        except RateLimited:
+            pass
+        else:
+            raise AssertionError("device burst not enforced")
+        # The per-device refusal didn't spend from the IP ceiling; another device gets the rest
+        main.check_client_limit("start", request("10.0.0.1", "device-b"))
+        try:
+            main.check_client_limit("start", request("10.0.0.1"))
+        except RateLimited:
+            pass
+        else:
+            raise AssertionError("IP ceiling not enforced")
+        main.check_client_limit("start", request("10.0.0.2", "device-a"))  # Other address, own ceiling
+    finally:
+        main.limiter = real
+
+
+def test_disabled_limiter_never_refuses():
+    limiter = RateLimiter(MemoryRateLimitBackend(), limits={"debug": (0.0001, 1)}, enabled=False)
+    for _ in range(5):
+        limiter.check("debug", "ip:1.2.3.4")
+
+
+if __name__ == "__main__":
+    sys.stdout.reconfigure(encoding='utf-8')
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
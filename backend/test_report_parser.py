@@ -0,0 +1,110 @@
+import json
+import sys
+
+from report_parser import REPORT_KEYS, ReportStreamParser, analyze_report, parse_report_text
+
+REPORT = {
+    "core_traits": ["系统直觉", "视觉思维"],
+    "deep_analysis": "你习惯先看清整体结构。",
+    "action_guide": "每周做一个小项目。",
+    "careers": [{"title": "产品经理", "reason": "把零散需求变成系统"}],
+    "not_suitable": "重复的流水线工作。",
+}
+TEXT = json.dumps(REPORT, ensure_ascii=False, indent=2)
+
+
+def feed_in_chunks(text, size):
+    parser = ReportStreamParser()
+    emitted = []
+    for i in range(0, len(text), size):
+        emitted += parser.feed(text[i:i + size])
+    return parser, emitted
+
+
+def test_members_are_emitted_as_they_complete():
+    for size in (1, 7, len(TEXT)):
+        parser, emitted = feed_in_chunks(TEXT, size)
+        assert [key for key, _ in emitted] == list(REPORT)
+        assert parser.finish() == REPORT
+        assert not parser.truncated and not parser.repairs
+
+
+def test_code_fence_is_stripped():
+    parser, _ = feed_in_chunks(f"```json\n{TEXT}\n```", 5)
+    assert parser.finish() == REPORT
+    assert parser.repairs == {"preamble"}
+
+
+def test_missing_comma_between_members():
+    text = '{"deep_analysis": "第一段"\n "action_guide": "第二段"}'
+    report, truncated = parse_report_text(text)
+    assert report == {"deep_analysis": "第一段", "action_guide": "第二段"}
+    assert not truncated
+
+
+def test_missing_comma_is_noted():
+    parser = ReportStreamParser()
+    parser.feed('{"deep_analysis": "第一段" "action_guide": "第二段"}')
+    assert parser.finish() == {"deep_analysis": "第一段", "action_guide": "第二段"}
+    assert "missing_comma" in parser.repairs
+
+
+def test_trailing_commas():
+    parser = ReportStreamParser()
+    parser.feed('{"core_traits": ["系统直觉", "视觉思维",], "deep_analysis": "分析",}')
+    assert parser.finish() == {"core_traits": ["系统直觉", "视觉思维"], "deep_analysis": "分析"}
+    assert "trailing_comma" in parser.repairs
+
+
+def test_raw_newline_inside_string():
+    parser = ReportStreamParser()
+    parser.feed('{"deep_analysis": "第一段\n第二段", "action_guide": "行动"}')
+    assert parser.finish() == {"deep_analysis": "第一段\n第二段", "action_guide": "行动"}
+    assert "raw_control_char" in parser.repairs
+
+
+def test_truncated_final_chunk_is_salvaged():
+    cut = TEXT[:TEXT.index("重复的流水线")]
+    parser, emitted = feed_in_chunks(cut, 9)
+    assert [key for key, _ in emitted] == list(REPORT)[:-1]
+    report = parser.finish()
+    assert parser.truncated
+    assert parser.truncated_key == "not_suitable"
+    assert report["not_suitable"] == ""
+    assert "truncated_tail" in parser.repairs
+
+
+def test_truncated_inside_a_list():
+    parser = ReportStreamParser()
+    parser.feed('{"deep_analysis": "分析", "core_traits": ["系统直觉", "视觉')
+    assert parser.finish() == {"deep_analysis": "分析", "core_traits": ["系统直觉", "视觉"]}
+    assert parser.truncated_key == "core_traits"
+
+
+def test_text_after_the_object_is_ignored():
+    parser = ReportStreamParser()
+    parser.feed(TEXT)
+    assert parser.feed("\n希望对你有帮助！{}") == []
+    assert parser.finish() == REPORT
+
+
+def test_analyze_report_flags_the_cut_section_for_regeneration():
+    report, broken, repairs = analyze_report(TEXT[:TEXT.index("每周")])
+    assert report["core_traits"] == REPORT["core_traits"]
+    # Cut off mid-string, so action_guide is an empty (invalid) section
+    assert sorted(broken) == sorted(["action_guide", "careers", "not_suitable"])
+    assert "truncated_tail" in repairs
+
+
+def test_analyze_report_without_an_object():
+    report, broken, _ = analyze_report("抱歉，我无法生成报告。")
+    assert report is None
+    assert broken == REPORT_KEYS
+
+
+if __name__ == "__main__":
+    sys.stdout.reconfigure(encoding='utf-8')
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,115 @@
+import os
+import sys
+from types import SimpleNamespace
+
+# Before main is imported: no upstream, no background work, per-process state only
+os.environ.setdefault("ALIYUN_API_KEY", "test")
+os.environ["SESSION_STORE"] = "memory"
+os.environ["RATE_LIMIT"] = "0"
+os.environ["REPORT_PREFETCH"] = "0"
+os.environ["REPORT_ARCHIVE"] = "0"
+os.environ["OPENING_POOL_DEPTH"] = "0"
+
+from fastapi.testclient import TestClient
+
+import llm
+import main
+from wire import history_version
+
+QUESTIONS = ["第二个问题：哪些事做完后让你精神亢奋？", "第三个问题：你曾经嫉妒过谁？", "第四个问题：还有什么想补充的？"]
+
+
+async def fake_completion(endpoint, session_id=None, **kwargs):
+    # One question per assistant turn already in the conversation
+    asked = sum(1 for m in kwargs["messages"] if m["role"] == "assistant")
+    content = QUESTIONS[asked % len(QUESTIONS)] if endpoint != "start" else "欢迎！第一个问题：小时候你最爱做什么？"
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+
+
+llm.chat_completion = fake_completion
+client = TestClient(main.app)
+
+
+def start(mode="normal"):
+    response = client.post("/assessment/start", json={"mode": mode, "include_history": True})
+    assert response.status_code == 200, response.text
+    data = response.json()
+    return data["session_id"], data["history"], data["history_version"]
+
+
+def chat(payload):
+    return client.post("/assessment/chat", json=payload)
+
+
+def test_resync_adopts_the_clients_newer_history():
+    session_id, history, _ = start()
+    # A turn that went through another instance: the server still holds the 3-message start
+    history = history + [
+        {"role": "user", "content": "答案一：小时候我总是废寝忘食地画画"},
+        {"role": "assistant", "content": QUESTIONS[0]},
+    ]
+    payload = {"session_id": session_id, "history_version": history_version(history), "user_message": "答案二：写代码让我回血"}
+
+    response = chat(payload)
+    assert response.status_code == 409
+    assert response.json()["detail"]["code"] == "history_resync"
+
+    response = chat({**payload, "history": history})
+    assert response.status_code == 200, response.text
+    data = response.json()
+    assert data["session_id"] == session_id
+    history = history + data["history_delta"]
+    assert [m["content"] for m in history[-2:]] == ["答案二：写代码让我回血", QUESTIONS[2]]
+    assert data["history_version"] == history_version(history)
+
+    # The server now holds the client's copy, so the next turn needs no resync
+    stored = main.sessions.get(session_id)["history"]
+    assert stored == history
+    assert any(m["content"].startswith("答案一") for m in stored)
+    response = chat({"session_id": session_id, "history_version": data["history_version"], "user_message": "答案三：我嫉妒会写小说的朋友"})
+    assert response.status_code == 200, response.text
+    assert len(main.sessions.get(session_id)["history"]) == len(history) + 2
+
+
+def test_resync_after_the_session_was_lost_keeps_the_mode():
+    session_id, history, version = start(mode="quick")
+    main.sessions.delete(session_id)  # As if the request reached an instance without it
+    payload = {"session_id": session_id, "history_version": version, "user_message": "答案一：小时候我总是废寝忘食地画画"}
+
+    response = chat(payload)
+    assert response.status_code == 409
+
+    response = chat({**payload, "history": history, "mode": "quick"})
+    assert response.status_code == 200, response.text
+    data = response.json()
+    new_id = data["session_id"]
+    assert new_id != session_id  # Ids are issued by the server, never taken from the client
+    assert main.sessions.get(new_id)["mode"] == "quick"
+
+    history = history + data["history_delta"]
+    response = chat({"session_id": new_id, "history_version": history_version(history), "user_message": "答案二：写代码让我回血"})
+    assert response.status_code == 200, response.text
+
+
+def test_stale_or_unknown_version_gets_a_resync():
+    session_id, history, version = start()
+    stale = history_version(history[:-1])
+    response = chat({"session_id": session_id, "history_version": stale, "user_message": "答案一"})
+    assert response.status_code == 409
+    detail = response.json()["detail"]
+    assert detail["code"] == "history_resync"
+    assert detail["history_version"] == version  # So the client can tell how far behind it is
+
+    response = chat({"session_id": "not-a-session", "history_version": version, "user_message": "答案一"})
+    assert response.status_code == 409
+    assert response.json()["detail"]["history_version"] is None
+    # Session-only clients can't resync and are told to start over
+    assert chat({"session_id": "not-a-session", "user_message": "答案一"}).status_code == 404
+
+
+if __name__ == "__main__":
+    sys.stdout.reconfigure(encoding='utf-8')
+    for test in (test_resync_adopts_the_clients_newer_history, test_resync_after_the_session_was_lost_keeps_the_mode,
+                 test_stale_or_unknown_version_gets_a_resync):
+        test()
+        print(f"{test.__name__}: ok")
@@ -0,0 +1,47 @@
+import sys
+
+from streaming import DONE_MARKER, DoneMarkerFilter
+
+
+def run(chunks):
+    done_filter = DoneMarkerFilter()
+    out = [done_filter.feed(chunk) for chunk in chunks]
+    out.append(done_filter.flush())
+    return "".join(out), done_filter.found
+
+
+def test_text_without_the_marker_passes_through():
+    assert run(["你好，", "第一个问题：", "小时候你最爱做什么？"]) == ("你好，第一个问题：小时候你最爱做什么？", False)
+
+
+def test_marker_in_one_chunk():
+    assert run(["谢谢你的分享！", DONE_MARKER]) == ("谢谢你的分享！", True)
+
+
+def test_marker_split_across_chunks():
+    text = f"谢谢你的分享！{DONE_MARKER}"
+    for size in range(1, len(DONE_MARKER) + 1):
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        assert run(chunks) == ("谢谢你的分享！", True), size
+
+
+def test_possible_marker_start_is_held_back_until_decided():
+    done_filter = DoneMarkerFilter()
+    assert done_filter.feed("好的【") == "好的"
+    assert done_filter.feed("重点】") == "【重点】"
+    assert not done_filter.found
+
+
+def test_unfinished_marker_prefix_is_flushed():
+    done_filter = DoneMarkerFilter()
+    assert done_filter.feed("结尾【DO") == "结尾"
+    assert done_filter.flush() == "【DO"
+    assert not done_filter.found
+
+
+if __name__ == "__main__":
+    sys.stdout.reconfigure(encoding='utf-8')
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,122 @@
+import gzip
+import json
+import sys
+import zlib
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+import wire
+from wire import CompressionMiddleware, _StreamEncoder, decode_body, history_delta, history_version, version_matches
+
+HISTORY = [
+    {"role": "system", "content": "你是一位天赋发现师。"},
+    {"role": "assistant", "content": "欢迎！第一个问题：小时候你最爱做什么？"},
+    {"role": "user", "content": "画画"},
+    {"role": "assistant", "content": "第二个问题：哪些事做完后让你精神亢奋？"},
+]
+
+app = FastAPI()
+app.add_middleware(CompressionMiddleware, enabled=True)
+
+
+@app.get("/big")
+def big():
+    return {"history": HISTORY * 20}
+
+
+@app.get("/small")
+def small():
+    return {"ok": True}
+
+
+@app.post("/echo")
+async def echo(request: Request):
+    return await request.json()
+
+
+@app.get("/events")
+def events():
+    return StreamingResponse((f"data: {i}\n\n" for i in range(3)), media_type="text/event-stream")
+
+
+client = TestClient(app)
+
+
+def test_history_delta_after_a_version():
+    version = history_version(HISTORY[:2])
+    assert version.startswith("2-")
+    assert version_matches(HISTORY, version)
+    assert history_delta(HISTORY, version) == HISTORY[2:]
+    assert history_delta(HISTORY, history_version(HISTORY)) == []
+
+
+def test_version_of_a_different_history_does_not_match():
+    edited = [*HISTORY[:2], {"role": "user", "content": "写代码"}]
+    assert not version_matches(HISTORY, history_version(edited))
+    assert not version_matches(HISTORY[:2], history_version(HISTORY))  # Longer than the server's copy
+    assert not version_matches(HISTORY, "garbled")
+
+
+def test_large_json_is_compressed():
+    response = client.get("/big", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) < len(json.dumps({"history": HISTORY * 20}))
+    assert response.json() == {"history": HISTORY * 20}
+
+
+def test_small_json_and_identity_clients_are_left_alone():
+    assert "content-encoding" not in client.get("/small", headers={"Accept-Encoding": "gzip"}).headers
+    assert "content-encoding" not in client.get("/big", headers={"Accept-Encoding": "identity"}).headers
+
+
+def test_streamed_events_are_compressed():
+    response = client.get("/events", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.text == "data: 0\n\ndata: 1\n\ndata: 2\n\n"
+
+
+def test_each_streamed_chunk_is_flushed():
+    encoder = _StreamEncoder("gzip")
+    decoder = zlib.decompressobj(31)
+    assert decoder.decompress(encoder.encode(b"data: 0\n\n", final=False)) == b"data: 0\n\n"
+    assert decoder.decompress(encoder.encode(b"data: 1\n\n", final=True)) == b"data: 1\n\n"
+    assert decoder.eof
+
+
+def test_compressed_request_body():
+    payload = {"session_id": "abc", "user_message": "画画" * 100}
+    response = client.post("/echo", content=gzip.compress(json.dumps(payload).encode("utf-8")),
+                           headers={"Content-Encoding": "gzip", "Content-Type": "application/json"})
+    assert response.status_code == 200
+    assert response.json() == payload
+
+
+def test_bad_request_bodies_are_refused():
+    response = client.post("/echo", content=b"{}", headers={"Content-Encoding": "zstd"})
+    assert response.status_code == 415
+    response = client.post("/echo", content=b"not gzip", headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 400
+    bomb = gzip.compress(b"0" * (wire.WIRE_MAX_BODY + 1))
+    response = client.post("/echo", content=bomb, headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 413
+
+
+def test_decode_body_stops_at_the_limit():
+    assert decode_body(zlib.compress(b"{}"), "deflate") == b"{}"
+    try:
+        decode_body(gzip.compress(b"0" * (wire.WIRE_MAX_BODY + 1)), "gzip")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("oversized body was decoded")
+
+
+if __name__ == "__main__":
+    sys.stdout.reconfigure(encoding='utf-8')
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,467 @@
+"""
+Span tracing for requests, correlated by session across start -> chat -> report.
+
+    TRACE_SAMPLE=0.05 python -m uvicorn main:app          # Trace 5% of sessions
+    curl -H "X-Trace: 1" ...                               # Trace this request (TRACE_HEADER=1)
+    curl -H "X-Trace: profile" ...                         # ...and sample its stacks
+    python tracing.py summary /tmp/talent_traces/spans-*.jsonl
+    python tracing.py chrome /tmp/talent_traces/spans-*.jsonl --session <id> -o trace.json
+
+Every traced request is split into spans:
+- `parse`: the body read, decompression, JSON and Pydantic validation before the handler runs.
+- `handler`, with nested spans for the session store, prompt assembly, the LLM queue wait
+  and upstream call, and report parsing.
+- `serialize`: from the handler's return to the response start.
+- `send`: the response body, which is where streamed completions run.
+
+A request is kept when its session falls in the TRACE_SAMPLE fraction, so a sampled
+session is traced across all of its requests, or when it asked with X-Trace. Kept
+requests are appended as one JSON line each to TRACE_DIR/spans-<pid>.jsonl. The
+`chrome` command turns those lines into a Chrome trace (chrome://tracing, Perfetto)
+with one row per session.
+
+X-Trace: profile also samples the Python stacks of every thread every
+TRACE_PROFILE_INTERVAL while the request runs. The counts are written as folded
+stacks (flamegraph.pl, speedscope) to TRACE_DIR/profile-<request>.folded. Other
+requests running at the same time show up in those samples too. Only one request is
+profiled at a time.
+
+Background work that a request starts (report prefetch, history compaction, opening pool
+refills) calls detach() and is not part of its trace.
+With TRACE_SAMPLE=0 and no X-Trace header, span() costs one context variable lookup.
+"""
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "0"))  # Fraction of sessions traced
+TRACE_HEADER = os.getenv("TRACE_HEADER", "0") == "1"  # Honour X-Trace from clients
+TRACE_DIR = os.getenv("TRACE_DIR", "/tmp/talent_traces")
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(100 * 1024 * 1024)))  # Per file, then rotated once
+TRACE_PROFILE_INTERVAL = float(os.getenv("TRACE_PROFILE_INTERVAL", "0.005"))
+
+TRACE_REQUEST_HEADER = "x-trace"
+TRACE_ID_HEADER = b"x-trace-id"
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_span = contextvars.ContextVar("current_span", default=0)
+
+
+def sampled(session_id):
+    """Whether a session is in the sample; the same answer for every request of the session."""
+    if TRACE_SAMPLE <= 0:
+        return False
+    if session_id is None:
+        return random.random() < TRACE_SAMPLE
+    return int(hashlib.sha1(session_id.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF < TRACE_SAMPLE
+
+
+class Trace:
+    """Spans of one HTTP request. Span 0 is the request itself."""
+
+    def __init__(self, method, path, forced=False):
+        self.request_id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.forced = forced
+        self.session_id = None
+        self.route = None
+        self.status = None
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.handler_start = None
+        self.handler_end = None
+        self.response_start = None
+        self.spans = []
+        self.closed = False
+        self._next_id = 1
+        self._lanes = {}
+
+    def next_id(self):
+        span_id = self._next_id
+        self._next_id += 1
+        return span_id
+
+    def lane(self):
+        """Row for concurrent spans: one per asyncio task (or thread) that recorded spans."""
+        try:
+            owner = asyncio.current_task()
+        except RuntimeError:
+            owner = None
+        owner = id(owner) if owner is not None else threading.get_ident()
+        return self._lanes.setdefault(owner, len(self._lanes))
+
+    def add(self, span_id, name, start, end, parent, attrs, lane=None):
+        if self.closed:
+            return  # From background work that outlived the request
+        self.spans.append({
+            "id": span_id, "parent": parent, "name": name, "lane": self.lane() if lane is None else lane,
+            "ts": round((start - self.start) * 1e6), "dur": round((end - start) * 1e6), **({"attrs": attrs} if attrs else {}),
+        })
+
+    def record(self):
+        self.closed = True
+        end = time.perf_counter()
+        spans = [{"id": 0, "parent": None, "name": "request", "lane": 0, "ts": 0,
+                  "dur": round((end - self.start) * 1e6), "attrs": {"status": self.status}}]
+        phases = [("parse", self.start, self.handler_start), ("serialize", self.handler_end, self.response_start),
+                  ("send", self.response_start, end)]
+        for name, start, stop in phases:
+            if start is not None and stop is not None and stop >= start:
+                spans.append({"id": self.next_id(), "parent": 0, "name": name, "lane": 0,
+                              "ts": round((start - self.start) * 1e6), "dur": round((stop - start) * 1e6)})
+        return {
+            "request": self.request_id, "session": self.session_id, "method": self.method,
+            "route": self.route or self.path, "status": self.status, "start": self.wall_start,
+            "spans": spans + self.spans,
+        }
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time a block as a child of the current span, when the request is traced."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = trace.next_id()
+    parent = current_span.get()
+    token = current_span.set(span_id)
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        current_span.reset(token)
+        trace.add(span_id, name, start, time.perf_counter(), parent, attrs)
+
+
+def record(name, start, **attrs):
+    """Add a span that started at perf_counter() value `start` and ends now.
+
+    For code that can't hold a context manager open, such as an async generator whose
+    iteration is driven from elsewhere.
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(trace.next_id(), name, start, time.perf_counter(), current_span.get(), attrs)
+
+
+def tag_session(session_id):
+    """Attach the request to its session, which is also what the sampling decision is keyed on."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.session_id = session_id
+
+
+def detach():
+    """Stop recording into the current request's trace; first thing in a background task it started."""
+    current_trace.set(None)
+
+
+def traced(endpoint):
+    """Wrap a route endpoint so the trace knows when the handler ran (see TracedRoute)."""
+    def enter(trace):
+        trace.handler_start = time.perf_counter()
+        return current_span.set(trace.next_id())
+
+    def leave(trace, token):
+        span_id = current_span.get()
+        current_span.reset(token)
+        trace.handler_end = time.perf_counter()
+        trace.add(span_id, "handler", trace.handler_start, trace.handler_end, 0, {"endpoint": endpoint.__name__}, lane=0)
+
+    if asyncio.iscoroutinefunction(endpoint):
+        @wraps(endpoint)
+        async def traced_endpoint(*args, **kwargs):
+            trace = current_trace.get()
+            if trace is None:
+                return await endpoint(*args, **kwargs)
+            token = enter(trace)
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                leave(trace, token)
+    else:
+        @wraps(endpoint)
+        def traced_endpoint(*args, **kwargs):
+            trace = current_trace.get()
+            if trace is None:
+                return endpoint(*args, **kwargs)
+            token = enter(trace)
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                leave(trace, token)
+    return traced_endpoint
+
+
+try:
+    from fastapi.routing import APIRoute
+
+    class TracedRoute(APIRoute):
+        """Route class that times every endpoint: app.router.route_class = TracedRoute."""
+
+        def __init__(self, path, endpoint, **kwargs):
+            super().__init__(path, traced(endpoint), **kwargs)
+except ImportError:  # The CLI below doesn't need FastAPI
+    TracedRoute = None
+
+
+class SpanExporter:
+    """Appends kept requests to TRACE_DIR/spans-<pid>.jsonl; each worker process has its own file.
+
+    export() only queues the line; a writer thread appends it (and writes profiles), so
+    the request being traced never waits on the disk.
+    """
+
+    def __init__(self, directory=TRACE_DIR, max_bytes=TRACE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._queue = queue.Queue()
+        self._writer = None
+        self._exported = 0
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._queue = queue.Queue()
+        self._writer = None
+
+    def export(self, trace):
+        self.submit(self._append, json.dumps(trace.record(), ensure_ascii=False) + "\n", trace.request_id)
+        metrics.inc("traces_exported_total")
+
+    def submit(self, job, *args):
+        """Run job(*args) on the writer thread."""
+        self._queue.put((job, args))
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._write_loop, name="trace-export", daemon=True)
+            self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            job, args = self._queue.get()
+            try:
+                job(*args)
+            except Exception as e:
+                logger.warning(f"Trace export failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait until every queued trace is written."""
+        if self._writer is not None:
+            self._queue.join()
+
+    def _append(self, line, request_id):
+        path = os.path.join(self.directory, f"spans-{os.getpid()}.jsonl")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if os.path.exists(path) and os.path.getsize(path) > self.max_bytes:
+                os.replace(path, path + ".1")
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line)
+            self._exported += 1
+        except OSError as e:
+            logger.warning(f"Could not export trace {request_id}: {e}")
+
+    def stats(self):
+        return {"sample": TRACE_SAMPLE, "header": TRACE_HEADER, "directory": self.directory, "exported": self._exported}
+
+
+exporter = SpanExporter()
+
+
+class StackSampler:
+    """Counts folded Python stacks of all threads at a fixed interval, from a background thread."""
+
+    _busy = threading.Lock()
+
+    def __init__(self, interval=TRACE_PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not StackSampler._busy.acquire(blocking=False):
+            return False  # Another request is being profiled
+        self._thread = threading.Thread(target=self._run, name="trace-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self, path):
+        self._stop.set()
+        self._thread.join()
+        StackSampler._busy.release()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            logger.warning(f"Could not write profile {path}: {e}")
+
+
+class TraceMiddleware:
+    """ASGI middleware that opens a Trace per request and exports the kept ones.
+
+    Outermost, so `parse` includes reading and decompressing the body, and `send`
+    includes the whole streamed response.
+    """
+
+    def __init__(self, app, sample=TRACE_SAMPLE, header=TRACE_HEADER):
+        self.app = app
+        self.sample = sample
+        self.header = header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        mode = None
+        if self.header:
+            for key, value in scope["headers"]:
+                if key.lower() == TRACE_REQUEST_HEADER.encode("latin-1"):
+                    mode = value.decode("latin-1").strip().lower()
+        if self.sample <= 0 and not mode:
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(scope["method"], scope["path"], forced=bool(mode))
+        sampler = StackSampler() if mode == "profile" else None
+        profiling = sampler is not None and sampler.start()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                trace.response_start = time.perf_counter()
+                trace.status = message["status"]
+                if trace.forced:
+                    headers = list(message.get("headers", [])) + [(TRACE_ID_HEADER, trace.request_id.encode("latin-1"))]
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        token = current_trace.set(trace)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_trace.reset(token)
+            trace.route = getattr(scope.get("route"), "path", None)
+            if trace.session_id is None:
+                trace.session_id = scope.get("path_params", {}).get("session_id")  # e.g. /usage/{session_id}
+            if profiling:
+                # Joins the sampler thread and writes the profile, so not on the event loop
+                exporter.submit(sampler.stop, os.path.join(exporter.directory, f"profile-{trace.request_id}.folded"))
+            if trace.forced or sampled(trace.session_id):
+                exporter.export(trace)
+
+
+def read_records(paths, session=None):
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Cut off when the process was killed
+                if session is None or record.get("session") == session:
+                    yield record
+
+
+def chrome_trace(records):
+    """Trace Event Format: one process row per session, one thread row per request lane."""
+    events = []
+    sessions = {}
+    for record in records:
+        key = record.get("session") or f"request {record['request']}"
+        if key not in sessions:
+            sessions[key] = len(sessions) + 1
+            events.append({"name": "process_name", "ph": "M", "pid": sessions[key], "args": {"name": key}})
+        pid = sessions[key]
+        base = record["start"] * 1e6
+        lanes = set()
+        for s in record["spans"]:
+            tid = f"{record['method']} {record['route']} {record['request'][:6]}" + (f" #{s['lane']}" if s["lane"] else "")
+            if tid not in lanes:
+                lanes.add(tid)
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": tid}})
+            events.append({"name": s["name"], "cat": "talent", "ph": "X", "pid": pid, "tid": tid,
+                           "ts": base + s["ts"], "dur": s["dur"], "args": s.get("attrs", {})})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def summary(records):
+    """Per route and span name: count, total, p50 and p95 in milliseconds."""
+    durations = defaultdict(list)
+    for record in records:
+        for s in record["spans"]:
+            durations[(record["route"], s["name"])].append(s["dur"] / 1000)
+    rows = []
+    for (route, name), values in sorted(durations.items()):
+        values.sort()
+        rows.append({
+            "route": route, "span": name, "count": len(values), "total_ms": round(sum(values), 1),
+            "p50_ms": round(values[len(values) // 2], 2), "p95_ms": round(values[min(len(values) - 1, int(len(values) * 0.95))], 2),
+        })
+    return rows
+
+
+if __name__ == "__main__":
+    sys.stdout.reconfigure(encoding='utf-8')
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("chrome", help="Convert span files to a Chrome trace")
+    command.add_argument("paths", nargs="+")
+    command.add_argument("--session", help="Only this session's requests")
+    command.add_argument("-o", "--output", required=True)
+    command = commands.add_parser("summary", help="Time per route and span")
+    command.add_argument("paths", nargs="+")
+    command.add_argument("--session")
+    args = parser.parse_args()
+
+    records = read_records(args.paths, args.session)
+    if args.command == "chrome":
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(chrome_trace(records), f, ensure_ascii=False)
+    else:
+        print(f"{'route':<28} {'span':<22} {'count':>6} {'total_ms':>10} {'p50_ms':>8} {'p95_ms':>8}")
+        for row in summary(records):
+            print(f"{row['route']:<28} {row['span']:<22} {row['count']:>6} {row['total_ms']:>10} "
+                  f"{row['p50_ms']:>8} {row['p95_ms']:>8}")
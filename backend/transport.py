@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Connection pool shared by every upstream call in this process
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "256"))
+LLM_KEEPALIVE = int(os.getenv("LLM_KEEPALIVE", "64"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+
+# Per-endpoint deadlines (seconds). Everything must finish inside Vercel's 60 s maxDuration.
+DEFAULT_TIMEOUTS = {
+    "default": {"connect": 5, "read": 30},
+    "start": {"connect": 5, "read": 20},
+    "chat": {"connect": 5, "read": 30},
+    "report": {"connect": 5, "read": 50},
+    "random_report": {"connect": 5, "read": 50},
+}
+# Background work shares the deadline of the endpoint it stands in for
+DEFAULT_TIMEOUTS["start_pool"] = DEFAULT_TIMEOUTS["start"]
+DEFAULT_TIMEOUTS["random_report_pool"] = DEFAULT_TIMEOUTS["random_report"]
+DEFAULT_TIMEOUTS["report_prefetch"] = DEFAULT_TIMEOUTS["report"]
+DEFAULT_TIMEOUTS["batch_report"] = DEFAULT_TIMEOUTS["report"]
+# e.g. LLM_TIMEOUTS='{"report": {"connect": 3, "read": 45}}'
+LLM_TIMEOUTS = {**DEFAULT_TIMEOUTS, **json.loads(os.getenv("LLM_TIMEOUTS", "{}"))}
+
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "4"))
+# Retries (and hedges) may add at most this fraction on top of first attempts
+LLM_RETRY_BUDGET_RATIO = float(os.getenv("LLM_RETRY_BUDGET_RATIO", "0.2"))
+
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+_retryable_errors = None
+
+
+def retryable_errors():
+    # The SDK is imported lazily (see llm.get_client), so the tuple is built on first use
+    global _retryable_errors
+    if _retryable_errors is None:
+        import openai
+        _retryable_errors = (
+            openai.APIConnectionError,  # Includes APITimeoutError
+            openai.RateLimitError,
+            openai.InternalServerError,
+        )
+    return _retryable_errors
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling upstream while the circuit breaker is open."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Upstream LLM unavailable; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def build_http_client():
+    import httpx
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=LLM_POOL_SIZE,
+            max_keepalive_connections=LLM_KEEPALIVE,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=endpoint_timeout("default"),
+    )
+
+
+def endpoint_timeout(endpoint, deadline=None):
+    """The endpoint's timeouts, cut down to what is left before `deadline` (time.monotonic())."""
+    import httpx
+    config = LLM_TIMEOUTS.get(endpoint) or LLM_TIMEOUTS["default"]
+    read, connect = config["read"], config["connect"]
+    if deadline is not None:
+        remaining = max(deadline - time.monotonic(), 0.1)
+        read, connect = min(read, remaining), min(connect, remaining)
+    return httpx.Timeout(read, connect=connect)
+
+
+class RetryBudget:
+    """Token bucket: each first attempt earns `ratio` tokens, each retry or hedge spends one."""
+
+    def __init__(self, ratio=LLM_RETRY_BUDGET_RATIO, cap=10.0):
+        self.ratio = ratio
+        self.cap = cap
+        self.tokens = cap
+
+    def earn(self):
+        self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def spend(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures; after `cooldown` lets one trial call through."""
+
+    def __init__(self, threshold=LLM_BREAKER_THRESHOLD, cooldown=LLM_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        state = self.state
+        if state == "open" or (state == "half_open" and self.trial_in_flight):
+            metrics.inc("llm_breaker_rejections_total")
+            remaining = self.cooldown - (time.monotonic() - self.opened_at)
+            raise CircuitOpenError(max(remaining, 1))
+        if state == "half_open":
+            self.trial_in_flight = True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("LLM circuit breaker closed")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        metrics.set_gauge("llm_breaker_open", 0)
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(f"LLM circuit breaker opened after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+            metrics.set_gauge("llm_breaker_open", 1)
+
+
+class LatencyTracker:
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+
+    def record(self, endpoint, seconds):
+        self._samples.setdefault(endpoint, deque(maxlen=self.window)).append(seconds)
+
+    def p95(self, endpoint):
+        samples = self._samples.get(endpoint)
+        if not samples or len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+class Transport:
+    """Timeouts, jittered retries within a budget, optional hedging and a circuit breaker."""
+
+    def __init__(self, max_attempts=LLM_MAX_ATTEMPTS, hedge=LLM_HEDGE):
+        self.max_attempts = max_attempts
+        self.hedge = hedge
+        self.budget = RetryBudget()
+        self.breaker = CircuitBreaker()
+        self.latency = LatencyTracker()
+
+    async def call(self, endpoint, request, hedgeable=True, deadline=None):
+        """Run `request(timeout)` (a coroutine factory) with the resilience policies applied.
+
+        With a `deadline`, each attempt's timeout ends there and no retry starts after it.
+        """
+        self.breaker.before_call()
+        self.budget.earn()
+        attempt = 1
+        while True:
+            timeout = endpoint_timeout(endpoint, deadline)
+            started = time.perf_counter()
+            try:
+                if self.hedge and hedgeable:
+                    result = await self._hedged(endpoint, request, timeout)
+                else:
+                    result = await request(timeout)
+            except retryable_errors() as e:
+                self.breaker.record_failure()
+                if attempt >= self.max_attempts or not self.budget.spend():
+                    raise
+                delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+                if deadline is not None and time.monotonic() + delay + 1 > deadline:
+                    metrics.inc("llm_retries_skipped_total", endpoint=endpoint, reason="deadline")
+                    raise
+                metrics.inc("llm_retries_total", endpoint=endpoint)
+                logger.warning(f"LLM call failed ({endpoint}, attempt {attempt}): {e}; retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                self.breaker.before_call()
+                continue
+            except BaseException:
+                # Not an upstream outage (bad request, cancellation): just free a half-open trial
+                self.breaker.trial_in_flight = False
+                raise
+            self.breaker.record_success()
+            self.latency.record(endpoint, time.perf_counter() - started)
+            return result
+
+    async def _hedged(self, endpoint, request, timeout):
+        threshold = self.latency.p95(endpoint)
+        first = asyncio.ensure_future(request(timeout))
+        pending = {first}
+        try:
+            if threshold is None:
+                return await first
+            done, _ = await asyncio.wait(pending, timeout=threshold)
+            if done or not self.budget.spend():
+                return await first
+            metrics.inc("llm_hedges_total", endpoint=endpoint)
+            second = asyncio.ensure_future(request(timeout))
+            pending.add(second)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            metrics.inc("llm_hedge_wins_total", endpoint=endpoint)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Also when the caller is cancelled or out of time: no upstream call is left unowned
+            for task in pending:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self):
+        return {
+            "breaker": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "retry_budget": round(self.budget.tokens, 2),
+            "hedge": self.hedge,
+        }
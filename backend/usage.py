@@ -0,0 +1,68 @@
+import threading
+from collections import OrderedDict
+
+from metrics import TOKEN_BUCKETS, metrics
+
+USAGE_MAX_SESSIONS = 10000
+
+
+def extract_usage(usage):
+    """Normalize a completion's usage block, including the provider's cached-prefix count."""
+    if usage is None:
+        return None
+    cached = 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is not None and getattr(details, "cached_tokens", None):
+        cached = details.cached_tokens
+    # DeepSeek reports prefix cache hits as a top-level extra field
+    extra = getattr(usage, "model_extra", None) or {}
+    if not cached and extra.get("prompt_cache_hit_tokens"):
+        cached = extra["prompt_cache_hit_tokens"]
+    return {
+        "prompt_tokens": usage.prompt_tokens or 0,
+        "cached_tokens": cached or 0,
+        "completion_tokens": usage.completion_tokens or 0,
+    }
+
+
+class UsageLedger:
+    """Token usage per endpoint (in metrics) and per session (bounded LRU)."""
+
+    def __init__(self, max_sessions=USAGE_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    def record(self, endpoint, usage, session_id=None):
+        """Account one call's usage; returns it normalized (see extract_usage)."""
+        usage = extract_usage(usage)
+        if usage is None:
+            return None
+        metrics.inc("llm_calls_with_usage_total", endpoint=endpoint)
+        for field, value in usage.items():
+            metrics.inc(f"llm_{field}_total", value, endpoint=endpoint)
+        metrics.observe("llm_prompt_tokens", usage["prompt_tokens"], buckets=TOKEN_BUCKETS, endpoint=endpoint)
+        metrics.observe("llm_completion_tokens", usage["completion_tokens"], buckets=TOKEN_BUCKETS, endpoint=endpoint)
+        if not session_id:
+            return usage
+        with self._lock:
+            totals = self._sessions.setdefault(session_id, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0})
+            totals["calls"] += 1
+            for field, value in usage.items():
+                totals[field] += value
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return usage
+
+    def session(self, session_id):
+        with self._lock:
+            totals = self._sessions.get(session_id)
+            if totals is None:
+                return None
+            totals = dict(totals)
+        totals["cache_hit_ratio"] = round(totals["cached_tokens"] / totals["prompt_tokens"], 3) if totals["prompt_tokens"] else 0.0
+        return totals
+
+
+usage_ledger = UsageLedger()
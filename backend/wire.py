@@ -0,0 +1,232 @@
+import hashlib
+import json
+import logging
+import os
+import zlib
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli  # Optional; without it only gzip/deflate are offered
+except ImportError:
+    brotli = None
+
+WIRE_COMPRESSION = os.getenv("WIRE_COMPRESSION", "1") == "1"
+WIRE_MIN_SIZE = int(os.getenv("WIRE_MIN_SIZE", "512"))  # Smaller single-chunk bodies go out as is
+WIRE_GZIP_LEVEL = int(os.getenv("WIRE_GZIP_LEVEL", "6"))
+WIRE_BROTLI_QUALITY = int(os.getenv("WIRE_BROTLI_QUALITY", "5"))
+# Decompressed request bodies larger than this are refused, so a tiny gzip bomb can't eat the memory
+WIRE_MAX_BODY = int(os.getenv("WIRE_MAX_BODY", str(2 * 1024 * 1024)))
+
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+
+def history_version(history):
+    """Version tag of a conversation: its message count plus a hash of the messages.
+
+    Delta clients send the tag of the history they hold and get back only the messages
+    after it, so the payload per turn stays constant instead of growing with the history.
+    """
+    payload = json.dumps([[m["role"], m["content"]] for m in history], ensure_ascii=False)
+    return f"{len(history)}-{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]}"
+
+
+def history_delta(history, version):
+    """Messages appended since `version`, which must be a version of a prefix of `history`."""
+    count = int(version.split("-", 1)[0])
+    return history[count:]
+
+
+def version_matches(history, version):
+    try:
+        count = int(version.split("-", 1)[0])
+    except ValueError:
+        return False
+    return 0 <= count <= len(history) and history_version(history[:count]) == version
+
+
+def accepted_encoding(header):
+    """Pick the best encoding from an Accept-Encoding header, or None for identity."""
+    offered = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            offered[name] = q
+    for name in ("br", "gzip"):
+        if name == "br" and brotli is None:
+            continue
+        if offered.get(name, offered.get("*", 0)) > 0:
+            return name
+    return None
+
+
+class _StreamEncoder:
+    """Compresses a body chunk by chunk, flushing after each so streamed events aren't held back."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=WIRE_BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(WIRE_GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: gzip container
+
+    def encode(self, data, final):
+        if self.encoding == "br":
+            out = self._compressor.process(data)
+            return out + (self._compressor.finish() if final else self._compressor.flush())
+        out = self._compressor.compress(data)
+        return out + self._compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+def decode_body(body, encoding):
+    """Decompress a request body; raises ValueError for unknown encodings or oversized bodies."""
+    if encoding == "gzip":
+        decoder = zlib.decompressobj(31)
+    elif encoding == "deflate":
+        decoder = zlib.decompressobj()
+    elif encoding == "br":
+        if brotli is None:
+            raise ValueError("Unsupported Content-Encoding: br (brotli is not installed)")
+        data = brotli.decompress(body)
+        if len(data) > WIRE_MAX_BODY:
+            raise ValueError(f"Decompressed request body is over {WIRE_MAX_BODY} bytes")
+        return data
+    else:
+        raise ValueError(f"Unsupported Content-Encoding: {encoding}")
+    data = decoder.decompress(body, WIRE_MAX_BODY + 1)
+    if len(data) > WIRE_MAX_BODY or decoder.unconsumed_tail:
+        raise ValueError(f"Decompressed request body is over {WIRE_MAX_BODY} bytes")
+    return data
+
+
+class CompressionMiddleware:
+    """ASGI middleware for compressed request and response bodies.
+
+    Request bodies sent with Content-Encoding gzip, deflate or br are decompressed before
+    FastAPI sees them. Responses are compressed with the best of br/gzip the client
+    accepts. Single-chunk JSON bodies under WIRE_MIN_SIZE go out as is; streamed (SSE)
+    bodies are compressed chunk by chunk with a flush after each, so events still arrive
+    as soon as they are sent.
+    """
+
+    def __init__(self, app, enabled=WIRE_COMPRESSION):
+        self.app = app
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled:
+            await self.app(scope, receive, send)
+            return
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+
+        content_encoding = headers.get("content-encoding", "identity").strip().lower()
+        if content_encoding != "identity":
+            body = b""
+            while True:
+                message = await receive()
+                body += message.get("body", b"")
+                if not message.get("more_body"):
+                    break
+            encoded_size = len(body)
+            try:
+                body = decode_body(body, content_encoding)
+            except ValueError as e:
+                await _reject(send, 415 if str(e).startswith("Unsupported") else 413, str(e))
+                return
+            except Exception as e:  # zlib.error, brotli.error
+                logger.warning(f"Undecodable {content_encoding} request body: {e}")
+                await _reject(send, 400, f"Could not decode {content_encoding} request body: {e}")
+                return
+            metrics.inc("wire_request_bytes_total", encoded_size, encoding=content_encoding)
+            metrics.inc("wire_request_bytes_total", len(body), encoding="identity")
+            scope = {**scope, "headers": [
+                (k, v) for k, v in scope["headers"] if k.lower() not in (b"content-encoding", b"content-length")
+            ] + [(b"content-length", str(len(body)).encode("latin-1"))]}
+            receive = _replay(body, receive)
+
+        encoding = accepted_encoding(headers.get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSend(send, encoding))
+
+
+def _replay(body, receive):
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()  # Disconnect notifications
+
+    return replay
+
+
+async def _reject(send, status, detail):
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode("latin-1")),
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
+
+class _CompressingSend:
+    """Wraps the ASGI send of one response; the start message is held until the first body chunk."""
+
+    def __init__(self, send, encoding):
+        self.send = send
+        self.encoding = encoding
+        self.start = None
+        self.encoder = None
+        self.passthrough = False
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            headers = {k.lower(): v for k, v in message.get("headers", [])}
+            content_type = headers.get(b"content-type", b"").decode("latin-1")
+            self.passthrough = (
+                b"content-encoding" in headers
+                or not content_type.startswith(COMPRESSIBLE_TYPES)
+            )
+            if self.passthrough:
+                await self.send(message)
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.encoder is None:
+            if not more_body and len(body) < WIRE_MIN_SIZE:
+                # Small and complete: compressing would only add headers and CPU
+                self.passthrough = True
+                await self.send(self.start)
+                await self.send(message)
+                return
+            self.encoder = _StreamEncoder(self.encoding)
+            headers = [(k, v) for k, v in self.start.get("headers", []) if k.lower() != b"content-length"]
+            headers.append((b"content-encoding", self.encoding.encode("latin-1")))
+            headers.append((b"vary", b"Accept-Encoding"))
+            encoded = self.encoder.encode(body, final=not more_body)
+            if not more_body:
+                headers.append((b"content-length", str(len(encoded)).encode("latin-1")))
+            await self.send({**self.start, "headers": headers})
+        else:
+            encoded = self.encoder.encode(body, final=not more_body)
+        metrics.inc("wire_response_bytes_total", len(body), encoding="identity")
+        metrics.inc("wire_response_bytes_total", len(encoded), encoding=self.encoding)
+        await self.send({"type": "http.response.body", "body": encoded, "more_body": more_body})
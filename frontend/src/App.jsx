@@ -5,6 +5,7 @@ import Assessment from './components/Assessment';
 import Loading from './components/Loading';
 import Report from './components/Report';
 import DebugChat from './components/DebugChat';
+import { postSession, visibleHistory } from './session';
 
 function App() {
   const [step, setStep] = useState('landing');
@@ -71,15 +72,12 @@ function App() {
 
   const updateProgress = (val) => setProgress(val);
 
-  const handleComplete = async (chatHistory) => {
+  const handleComplete = async (session) => {
     setProgress(90);
     setStep('loading');
     try {
-      // Call backend API to generate report based on full chat history
-      const response = await axios.post(`${import.meta.env.VITE_API_URL}/assessment/report`, { 
-        user_message: "", // Not needed for report generation
-        history: chatHistory 
-      });
+      // Call backend API to generate report; our copy of the history is resent only if the server lost it
+      const response = await postSession('/assessment/report', session);
       console.log("Report Data Received:", response.data);
       
       const finalData = response.data;
@@ -107,7 +105,7 @@ function App() {
         deep_analysis: "生成报告时发生错误，请检查网络连接或重试。",
         not_suitable: "技术故障也是一种提醒，让我们停下来深呼吸。",
         action_guide: "请刷新页面重新开始。",
-        full_chat_history: chatHistory // Pass chat history even on error so user can inspect it
+        full_chat_history: visibleHistory(session) // Pass chat history even on error so user can inspect it
       });
       setTimeout(() => {
         setProgress(100);
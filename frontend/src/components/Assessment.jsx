@@ -2,9 +2,10 @@ import { useState, useEffect } from 'react';
 import { motion, AnimatePresence } from 'framer-motion';
 import { ArrowRight, Loader2 } from 'lucide-react';
 import axios from 'axios';
+import { applyReply, postSession, sessionFromStart } from '../session';
 
 export default function Assessment({ mode = "normal", onComplete, onProgress }) {
-  const [history, setHistory] = useState([]);
+  const [session, setSession] = useState(null);
   const [currentQuestion, setCurrentQuestion] = useState("");
   const [input, setInput] = useState("");
   const [isLoading, setIsLoading] = useState(true);
@@ -15,9 +16,10 @@ export default function Assessment({ mode = "normal", onComplete, onProgress })
   useEffect(() => {
     const startAssessment = async () => {
       try {
-        const response = await axios.post(`${import.meta.env.VITE_API_URL}/assessment/start`, { mode });
+        // The server keeps the history too; our copy is only sent again if it loses track
+        const response = await axios.post(`${import.meta.env.VITE_API_URL}/assessment/start`, { mode, include_history: true });
         setCurrentQuestion(response.data.message);
-        setHistory(response.data.history);
+        setSession(sessionFromStart(response.data, mode));
         setIsLoading(false);
       } catch (error) {
         console.error("Failed to start assessment:", error);
@@ -44,19 +46,17 @@ export default function Assessment({ mode = "normal", onComplete, onProgress })
     
     try {
       // Send user response to AI
-      const response = await axios.post(`${import.meta.env.VITE_API_URL}/assessment/chat`, {
-        user_message: userMsg,
-        history: history
-      });
+      const response = await postSession('/assessment/chat', session, { user_message: userMsg });
+      const updated = applyReply(session, response.data);
+      setSession(updated);
 
       if (response.data.is_finished) {
         // If AI signals completion, trigger report generation
         if (onProgress) onProgress(95);
-        // We pass the full history to onComplete so App.jsx can call /assessment/report
-        onComplete(response.data.history);
+        // We pass the session to onComplete so App.jsx can call /assessment/report
+        onComplete(updated);
       } else {
         // Continue to next question
-        setHistory(response.data.history);
         setCurrentQuestion(response.data.message);
         setRound(prev => prev + 1);
         setShowFeedback(false);
@@ -0,0 +1,66 @@
+import axios from 'axios';
+
+// A stable id per browser, so the server rate-limits this device rather than everyone
+// sharing its IP (a school or office network)
+function clientId() {
+  try {
+    let id = localStorage.getItem('clientId');
+    if (!id) {
+      id = crypto.randomUUID();
+      localStorage.setItem('clientId', id);
+    }
+    return id;
+  } catch {
+    return undefined;
+  }
+}
+
+const id = clientId();
+if (id) axios.defaults.headers.common['X-Client-Id'] = id;
+
+// The server keeps the conversation behind a session id, but a serverless request can
+// land on an instance that doesn't have it (404) or holds an older copy (409). We keep
+// our own copy of the history and its version, and resend it in full when that happens.
+
+export function sessionFromStart(data, mode) {
+  return {
+    id: data.session_id,
+    mode,
+    history: data.history || [],
+    version: data.history_version || null,
+  };
+}
+
+// Apply a chat reply: the new messages (delta) or, after a resync, the full history
+export function applyReply(session, data) {
+  let history = session.history;
+  if (data.history) {
+    history = data.history;
+  } else if (data.history_delta) {
+    history = [...history, ...data.history_delta];
+  }
+  return {
+    ...session,
+    id: data.session_id || session.id,
+    history,
+    version: data.history_version || session.version,
+  };
+}
+
+export async function postSession(path, session, extra = {}) {
+  const url = `${import.meta.env.VITE_API_URL}${path}`;
+  const body = { session_id: session.id, history_version: session.version, ...extra };
+  try {
+    return await axios.post(url, body);
+  } catch (error) {
+    const status = error.response?.status;
+    if (status !== 404 && status !== 409) throw error;
+    console.warn(`Session ${session.id} unavailable (${status}); resending the full history`);
+    return axios.post(url, { ...body, history: session.history, mode: session.mode });
+  }
+}
+
+// The conversation as the report view shows it, without the system prompt
+export function visibleHistory(session) {
+  return (session?.history || []).filter(m => m.role !== 'system');
+}